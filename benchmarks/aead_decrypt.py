@@ -0,0 +1,100 @@
+"""
+AEAD TCP 流解密 benchmark
+
+对比旧的 `del buffer[:n]` 解密方式和现在基于游标 + memoryview 的解密方式
+
+    python -m benchmarks.aead_decrypt
+"""
+
+import os
+import time
+
+from shadowsocks.ciphers import SUPPORT_METHODS, BaseAEADCipher, BaseSS2022Cipher
+
+PASSWORD = "i am password"
+READ_SIZES = [16 * 1024, 256 * 1024]
+TOTAL_SIZE = 32 * 1024 * 1024
+
+
+class LegacyDecoder:
+    """旧版本 BaseAEADCipher.decrypt 的实现, 只用来做对比"""
+
+    def __init__(self, cipher: BaseAEADCipher):
+        self.cipher = cipher
+        self._buffer = bytearray()
+        self._payload_len = None
+
+    def _decrypt(self, ciphertext, tag):
+        c = self.cipher
+        if not c._cipher:
+            c._cipher = c.new_cipher(c._subkey)
+        return c._cipher.decrypt(c.nonce, bytes(ciphertext + tag), None)
+
+    def decrypt(self, data: bytes) -> bytes:
+        c = self.cipher
+        ret = bytearray()
+        if c._subkey is None:
+            salt, data = data[: c.SALT_SIZE], data[c.SALT_SIZE :]
+            c._subkey = c._derive_subkey(salt)
+
+        self._buffer.extend(data)
+        while True:
+            if not self._payload_len:
+                if len(self._buffer) < 2 + c.TAG_SIZE:
+                    break
+                self._payload_len = int.from_bytes(
+                    self._decrypt(self._buffer[:2], self._buffer[2 : 2 + c.TAG_SIZE]),
+                    "big",
+                )
+                del self._buffer[: 2 + c.TAG_SIZE]
+            else:
+                if len(self._buffer) < self._payload_len + c.TAG_SIZE:
+                    break
+                ret.extend(
+                    self._decrypt(
+                        self._buffer[: self._payload_len],
+                        self._buffer[
+                            self._payload_len : self._payload_len + c.TAG_SIZE
+                        ],
+                    )
+                )
+                del self._buffer[: self._payload_len + c.TAG_SIZE]
+                self._payload_len = None
+        return bytes(ret)
+
+
+def _reads(cipher_cls, read_size):
+    plain_text = os.urandom(TOTAL_SIZE)
+    enc_text = cipher_cls(PASSWORD).encrypt(plain_text)
+    return plain_text, [
+        enc_text[i : i + read_size] for i in range(0, len(enc_text), read_size)
+    ]
+
+
+def _run(decoder, reads):
+    t = time.perf_counter()
+    out = [decoder.decrypt(r) for r in reads]
+    return time.perf_counter() - t, b"".join(out)
+
+
+def main():
+    mb = TOTAL_SIZE / 1024 / 1024
+    for method, cipher_cls in SUPPORT_METHODS.items():
+        # NOTE 2022的流格式不一样, 不和旧实现对比
+        if not cipher_cls.AEAD_CIPHER or issubclass(cipher_cls, BaseSS2022Cipher):
+            continue
+        for read_size in READ_SIZES:
+            plain_text, reads = _reads(cipher_cls, read_size)
+            legacy_cost, legacy_out = _run(LegacyDecoder(cipher_cls(PASSWORD)), reads)
+            cost, out = _run(cipher_cls(PASSWORD), reads)
+            assert out == legacy_out == plain_text
+            print(
+                f"{method:<24} read={read_size // 1024:>4}KiB "
+                f"legacy={mb / legacy_cost:8.1f}MB/s "
+                f"cursor={mb / cost:8.1f}MB/s "
+                f"speedup={legacy_cost / cost:.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
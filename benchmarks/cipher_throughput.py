@@ -0,0 +1,309 @@
+"""
+加解密吞吐 benchmark, 结果输出为json, 方便对比不同commit和机器上的数据
+
+- tcp: 每种加密方式在不同read size下的加密/解密MB/s, 分别测cipher和CipherMan两层
+- udp: pack/unpack 和同样大小的tcp chunk的单包耗时
+
+    python -m benchmarks.cipher_throughput --output result.json
+    python -m benchmarks.cipher_throughput --methods aes-128-gcm --total-mb 4
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import cryptography
+from cryptography.hazmat.backends.openssl.backend import backend as openssl_backend
+
+from shadowsocks.cipherman import CipherMan
+from shadowsocks.ciphers import (
+    SUPPORT_METHODS,
+    BaseAEADCipher,
+    BaseSS2022Cipher,
+    aes_ecb_encrypt,
+)
+from shadowsocks.mdb.models import User
+
+READ_SIZES = [512, 1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024]
+PACKET_SIZES = [64, 512, 1400]
+PACKET_COUNT = 2000
+MAX_READS = 8192
+PASSWORD = "i am password"
+PORT = 10086
+# NOTE 2022的请求里要带socks addr, 解密出来的数据里会多出这一段
+SOCKS_ADDR = b"\x01\x7f\x00\x00\x01\x00\x50"
+
+
+def _password(cipher_cls):
+    if issubclass(cipher_cls, BaseSS2022Cipher):
+        return base64.b64encode(os.urandom(cipher_cls.KEY_SIZE)).decode()
+    return PASSWORD
+
+
+def _is_2022(cipher_cls):
+    return issubclass(cipher_cls, BaseSS2022Cipher)
+
+
+def _server_encryptor(cipher_cls, password):
+    cipher = cipher_cls(password)
+    # NOTE 2022的响应里要带上请求的salt
+    cipher.request_salt = os.urandom(getattr(cipher_cls, "SALT_SIZE", 0))
+    return cipher
+
+
+def _client_stream(cipher_cls, password, reads):
+    """
+    模拟客户端发过来的tcp流, 返回(前缀, 每次read的密文)
+
+    NOTE 2022的请求和响应格式不同, 客户端的头部需要手动构造
+    """
+    cipher = cipher_cls(password)
+    if not _is_2022(cipher_cls):
+        chunks = [cipher.encrypt(r) for r in reads]
+        return b"", chunks
+    salt = os.urandom(cipher_cls.SALT_SIZE)
+    cipher._subkey = cipher._derive_subkey(salt)
+    variable_header = SOCKS_ADDR + b"\x00\x00"
+    fixed_header = (
+        b"\x00"
+        + int(time.time()).to_bytes(8, "big")
+        + len(variable_header).to_bytes(2, "big")
+    )
+    prefix = salt + cipher._encrypt(fixed_header) + cipher._encrypt(variable_header)
+    chunks = [b"".join(BaseAEADCipher.encrypt_chunks(cipher, r)) for r in reads]
+    return prefix, chunks
+
+
+def _client_udp_packets(cipher_cls, password, data, count):
+    """模拟客户端发过来的udp包"""
+    cipher = cipher_cls(password)
+    if not _is_2022(cipher_cls):
+        return [cipher_cls(password).pack(data) for _ in range(count)]
+    session_id = os.urandom(8)
+    subkey = cipher.new_cipher(cipher._derive_subkey(session_id))
+    body = b"\x00" + int(time.time()).to_bytes(8, "big") + b"\x00\x00" + data
+    packets = []
+    for packet_id in range(count):
+        header = session_id + packet_id.to_bytes(8, "big")
+        packets.append(
+            aes_ecb_encrypt(cipher.key, header) + subkey.encrypt(header[4:], body, None)
+        )
+    return packets
+
+
+def _bench_user(method, password):
+    """CipherMan会给用户记流量, 需要一个真实的用户"""
+    User.delete().execute()
+    User.create_or_update_by_user_data_list(
+        [dict(user_id=1, port=PORT, method=method, password=password, enable=True)]
+    )
+    return User.registry.get(1)
+
+
+def _timeit(fn, repeat):
+    """跑repeat次, 返回每次的耗时"""
+    costs = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        costs.append(time.perf_counter() - t)
+    return costs
+
+
+def _throughput(total, costs):
+    mb = total / 1024 / 1024
+    return {
+        "best_mbps": round(mb / min(costs), 2),
+        "median_mbps": round(mb / statistics.median(costs), 2),
+    }
+
+
+def bench_tcp(method, read_size, total_size, repeat, max_reads=MAX_READS):
+    cipher_cls = SUPPORT_METHODS[method]
+    password = _password(cipher_cls)
+    # NOTE 小read size下CipherMan每次都要记流量, 限制一下次数不然太慢了
+    count = min(max(total_size // read_size, 1), max_reads)
+    reads = [os.urandom(read_size)] * count
+    total = read_size * count
+    prefix, client_chunks = _client_stream(cipher_cls, password, reads)
+    # NOTE 第一次read至少要包含salt和头部
+    client_chunks[0] = prefix + client_chunks[0]
+    user = _bench_user(method, password)
+
+    def cipher_encrypt():
+        enc = _server_encryptor(cipher_cls, password)
+        for r in reads:
+            enc.encrypt_chunks(r) if cipher_cls.AEAD_CIPHER else enc.encrypt(r)
+
+    def cipher_decrypt():
+        dec = cipher_cls(password)
+        for c in client_chunks:
+            dec.decrypt(c)
+
+    def cipherman_encrypt():
+        cm = CipherMan(
+            access_user=user,
+            request_salt=os.urandom(getattr(cipher_cls, "SALT_SIZE", 0)),
+        )
+        for r in reads:
+            cm.encrypt_chunks(r)
+
+    def cipherman_decrypt():
+        cm = CipherMan(access_user=user)
+        for c in client_chunks:
+            cm.decrypt(c)
+
+    ret = {"bytes": total}
+    for name, fn in [
+        ("cipher_encrypt", cipher_encrypt),
+        ("cipher_decrypt", cipher_decrypt),
+        ("cipherman_encrypt", cipherman_encrypt),
+        ("cipherman_decrypt", cipherman_decrypt),
+    ]:
+        ret[name] = _throughput(total, _timeit(fn, repeat))
+    return ret
+
+
+def bench_udp(method, packet_size, repeat):
+    cipher_cls = SUPPORT_METHODS[method]
+    password = _password(cipher_cls)
+    data = os.urandom(packet_size)
+    packets = _client_udp_packets(cipher_cls, password, data, PACKET_COUNT)
+
+    # NOTE 和CipherMan一样: 2022整个session共用一个cipher, 其他的每个包都新建一个
+    if _is_2022(cipher_cls):
+
+        def udp_cipher(server):
+            return server
+
+    else:
+
+        def udp_cipher(server):
+            return cipher_cls(password)
+
+    def udp_unpack():
+        # NOTE 同一个session里的packet id不能重复, 每轮都换一个server端cipher
+        server = cipher_cls(password)
+        for p in packets:
+            udp_cipher(server).unpack(p)
+
+    def udp_pack():
+        server = cipher_cls(password)
+        server.unpack(packets[0])
+        for _ in range(PACKET_COUNT):
+            udp_cipher(server).pack(data)
+
+    def tcp_encrypt():
+        enc = _server_encryptor(cipher_cls, password)
+        for _ in range(PACKET_COUNT):
+            enc.encrypt(data)
+
+    prefix, client_chunks = _client_stream(cipher_cls, password, [data] * PACKET_COUNT)
+
+    def tcp_decrypt():
+        dec = cipher_cls(password)
+        dec.decrypt(prefix + client_chunks[0])
+        for c in client_chunks[1:]:
+            dec.decrypt(c)
+
+    ret = {}
+    for name, fn in [
+        ("udp_unpack", udp_unpack),
+        ("udp_pack", udp_pack),
+        ("tcp_encrypt", tcp_encrypt),
+        ("tcp_decrypt", tcp_decrypt),
+    ]:
+        best = min(_timeit(fn, repeat))
+        ret[name] = {"us_per_packet": round(best / PACKET_COUNT * 1e6, 3)}
+    return ret
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metadata(args):
+    try:
+        import blake3
+
+        blake3_version = blake3.__version__
+    except AttributeError:
+        blake3_version = None
+    return {
+        "commit": _git_commit(),
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": sys.version.split()[0],
+        "cryptography": cryptography.__version__,
+        "openssl": openssl_backend.openssl_version_text(),
+        "blake3": blake3_version,
+        "time": int(time.time()),
+        "total_size": args.total_mb * 1024 * 1024,
+        "max_reads": args.max_reads,
+        "repeat": args.repeat,
+        "packet_count": PACKET_COUNT,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--methods", nargs="*", default=list(SUPPORT_METHODS))
+    parser.add_argument("--read-sizes", nargs="*", type=int, default=READ_SIZES)
+    parser.add_argument("--packet-sizes", nargs="*", type=int, default=PACKET_SIZES)
+    parser.add_argument("--total-mb", type=int, default=16)
+    parser.add_argument("--max-reads", type=int, default=MAX_READS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="默认输出到stdout")
+    args = parser.parse_args()
+
+    User.create_table()
+    total_size = args.total_mb * 1024 * 1024
+    result = {"meta": _metadata(args), "tcp": [], "udp": []}
+    for method in args.methods:
+        # NOTE 预热一下, 避免第一次加载openssl等的开销算进去
+        bench_tcp(method, 4096, 64 * 1024, 1)
+        for read_size in args.read_sizes:
+            result["tcp"].append(
+                {
+                    "method": method,
+                    "read_size": read_size,
+                    **bench_tcp(
+                        method, read_size, total_size, args.repeat, args.max_reads
+                    ),
+                }
+            )
+            print(f"tcp {method} read_size={read_size} done", file=sys.stderr)
+        for packet_size in args.packet_sizes:
+            result["udp"].append(
+                {
+                    "method": method,
+                    "packet_size": packet_size,
+                    **bench_udp(method, packet_size, args.repeat),
+                }
+            )
+        print(f"udp {method} done", file=sys.stderr)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+用户很多的端口并行试解密 benchmark
+
+模拟一批新连接陆续到达同一个端口, 对比串行find_access_user,
+find_access_user_async在事件循环里分批跑和丢到线程池并行跑
+在建连耗时(p50/p99)和事件循环卡顿上的差别
+
+    python -m benchmarks.parallel_lookup
+    python -m benchmarks.parallel_lookup --users 5000 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from shadowsocks import protocol_flag as flag
+from shadowsocks.ciphers import SUPPORT_METHODS
+from shadowsocks.mdb.models import User
+
+METHOD = "aes-128-gcm"
+PORT = 10086
+HEADER = b"\x01\x7f\x00\x00\x01\x00\x50"
+
+
+def _setup_users(user_count):
+    User.delete().execute()
+    passwords = [f"password-{i}" for i in range(user_count)]
+    User.create_or_update_by_user_data_list(
+        [
+            {
+                "user_id": i,
+                "port": PORT,
+                "method": METHOD,
+                "password": password,
+                "enable": True,
+            }
+            for i, password in enumerate(passwords, 1)
+        ]
+    )
+    return passwords
+
+
+def _first_data(password):
+    cipher_cls = SUPPORT_METHODS[METHOD]
+    return cipher_cls(password).encrypt(HEADER)[: cipher_cls.tcp_first_data_len()]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def _watch_loop_lag(lags, stop, interval=0.001):
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - t - interval)
+
+
+async def bench(first_datas, interval, lookup):
+    latencies, lags = [], []
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(_watch_loop_lag(lags, stop))
+
+    async def connection(first_data, arrive_at):
+        user, _ = await lookup(first_data)
+        assert user
+        latencies.append(time.perf_counter() - arrive_at)
+
+    # NOTE 按固定的时间表到达, 事件循环被卡住时排队的时间也要算进建连耗时
+    start = time.perf_counter()
+    tasks = []
+    for i, first_data in enumerate(first_datas):
+        arrive_at = start + i * interval
+        await asyncio.sleep(max(arrive_at - time.perf_counter(), 0))
+        tasks.append(asyncio.create_task(connection(first_data, arrive_at)))
+    await asyncio.gather(*tasks)
+    stop.set()
+    await watcher
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_loop_lag_ms": max(lags) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--interval-ms", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    User.create_table()
+    passwords = _setup_users(args.users)
+    targets = random.choices(passwords, k=args.connections)
+    first_datas = [_first_data(p) for p in targets]
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    async def sync_lookup(first_data):
+        return User.find_access_user(PORT, METHOD, flag.TRANSPORT_TCP, first_data)
+
+    async def cooperative_lookup(first_data):
+        return await User.find_access_user_async(
+            PORT, METHOD, flag.TRANSPORT_TCP, first_data
+        )
+
+    async def parallel_lookup(first_data):
+        return await User.find_access_user_async(
+            PORT,
+            METHOD,
+            flag.TRANSPORT_TCP,
+            first_data,
+            executor=executor,
+            partitions=args.workers,
+        )
+
+    for name, lookup in [
+        ("serial", sync_lookup),
+        ("coop", cooperative_lookup),
+        ("parallel", parallel_lookup),
+    ]:
+        # NOTE 找到用户会调整查找顺序, 每轮都重建一下保证顺序一致
+        _setup_users(args.users)
+        ret = asyncio.run(bench(first_datas, args.interval_ms / 1000, lookup))
+        print(
+            f"{name:<8} users={args.users} workers={args.workers} "
+            f"p50={ret['p50_ms']:8.2f}ms p99={ret['p99_ms']:8.2f}ms "
+            f"max_loop_lag={ret['max_loop_lag_ms']:8.2f}ms"
+        )
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
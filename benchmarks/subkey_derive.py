@@ -0,0 +1,89 @@
+"""
+AEAD subkey 派生(HKDF-SHA1) benchmark
+
+每个tcp连接、每个udp包、find_access_user里的每个候选用户都要派生一次subkey
+顺便对比找用户时一个候选用户完整试解密和probe的开销
+
+    python -m benchmarks.subkey_derive
+"""
+import base64
+import hashlib
+import os
+import time
+
+from cryptography.exceptions import InvalidTag
+
+from shadowsocks.ciphers import SUPPORT_METHODS, BaseSS2022Cipher
+
+try:
+    # NOTE 旧的纯python实现, 装了的话顺便对比一下
+    import hkdf
+except ImportError:
+    hkdf = None
+
+PASSWORD = "i am password"
+ROUNDS = 50000
+
+
+def _derivations_per_second(derive, salts):
+    t = time.perf_counter()
+    for salt in salts:
+        derive(salt)
+    return len(salts) / (time.perf_counter() - t)
+
+
+def _candidate_per_second(cipher_cls, probe):
+    """
+    找用户时一个对不上的候选用户每秒能试多少个
+
+    probe=False 是以前的做法: 创建完整的cipher, 跑一遍decrypt
+    """
+    if issubclass(cipher_cls, BaseSS2022Cipher):
+        password = base64.b64encode(os.urandom(cipher_cls.KEY_SIZE)).decode()
+    else:
+        password = "wrong password"
+    # NOTE tag对不上就行, 随机数据也可以
+    first_data = os.urandom(cipher_cls.tcp_first_data_len())
+    cipher_cls.get_master_key(password)
+    rounds = ROUNDS // 10
+    t = time.perf_counter()
+    for _ in range(rounds):
+        if probe:
+            cipher_cls.probe(password, first_data)
+        else:
+            try:
+                cipher_cls(password).decrypt(first_data)
+            except InvalidTag:
+                pass
+    return rounds / (time.perf_counter() - t)
+
+
+def main():
+    for method, cipher_cls in SUPPORT_METHODS.items():
+        if not cipher_cls.AEAD_CIPHER:
+            continue
+        is_2022 = issubclass(cipher_cls, BaseSS2022Cipher)
+        if is_2022:
+            cipher = cipher_cls(
+                base64.b64encode(os.urandom(cipher_cls.KEY_SIZE)).decode()
+            )
+        else:
+            cipher = cipher_cls(PASSWORD)
+        salts = [os.urandom(cipher_cls.SALT_SIZE) for _ in range(ROUNDS)]
+        line = f"{method:<24} native={_derivations_per_second(cipher._derive_subkey, salts):10.0f}/s"
+        if hkdf and not is_2022:
+
+            def legacy(salt):
+                return hkdf.Hkdf(salt, cipher.key, hashlib.sha1).expand(
+                    cipher.INFO, cipher.KEY_SIZE
+                )
+
+            assert legacy(salts[0]) == cipher._derive_subkey(salts[0])
+            line += f" hkdf={_derivations_per_second(legacy, salts):10.0f}/s"
+        line += f" trial_decrypt={_candidate_per_second(cipher_cls, False):10.0f}/s"
+        line += f" probe={_candidate_per_second(cipher_cls, True):10.0f}/s"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+tcp转发 benchmark
+
+节点(LocalTCP/RemoteTCP)跑在当前进程, 客户端和上游服务器跑在子进程里,
+只统计节点进程的CPU时间. 分别测下载(上游 -> 客户端)和上传(客户端 -> 上游)
+
+- cpu_s_per_gb: 节点每转发1GB数据消耗的CPU秒数
+- reads: LocalTCP/RemoteTCP收到数据的回调次数
+- recv_allocs: 接收数据分配的buffer数, asyncio.Protocol每次read都会新分配一个bytes
+
+    python -m benchmarks.tcp_relay
+    python -m benchmarks.tcp_relay --method chacha20-ietf-poly1305 --mb 512
+"""
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import struct
+import threading
+import time
+
+from shadowsocks.ciphers import SUPPORT_METHODS
+from shadowsocks.core import LocalTCP, RemoteTCP
+from shadowsocks.mdb.models import User
+
+NODE_PORT = 10086
+PASSWORD = "i am password"
+CHUNK_SIZE = 64 * 1024
+
+
+def _upstream(listener, mode, total, connected):
+    conn, _ = listener.accept()
+    connected.set()
+    with conn:
+        if mode == "download":
+            data = bytes(CHUNK_SIZE)
+            for _ in range(total // CHUNK_SIZE):
+                conn.sendall(data)
+        else:
+            received = 0
+            while received < total:
+                received += len(conn.recv(1024 * 1024))
+
+
+def _client(method, mode, total, pipe):
+    """子进程: 先把密文准备好, 节点那边准备好之后开始计时"""
+    listener = socket.create_server(("127.0.0.1", 0))
+    upstream_port = listener.getsockname()[1]
+    header = b"\x01" + socket.inet_aton("127.0.0.1") + struct.pack("!H", upstream_port)
+    cipher = SUPPORT_METHODS[method](PASSWORD)
+    if mode == "download":
+        chunks = [cipher.encrypt(header)]
+    else:
+        chunks = [cipher.encrypt(header + bytes(CHUNK_SIZE))]
+        chunks.extend(
+            cipher.encrypt(bytes(CHUNK_SIZE)) for _ in range(total // CHUNK_SIZE - 1)
+        )
+
+    pipe.send("ready")
+    pipe.recv()
+    # NOTE 上游服务器用线程跑就够了
+    connected = threading.Event()
+    upstream = threading.Thread(
+        target=_upstream, args=(listener, mode, total, connected)
+    )
+    upstream.start()
+    with socket.create_connection(("127.0.0.1", NODE_PORT)) as sock:
+        sock.sendall(chunks[0])
+        # NOTE 节点连上游期间收到的数据先放在_connect_buffer里, 等连上再发, 只测转发
+        connected.wait()
+        time.sleep(0.05)
+        for chunk in chunks[1:]:
+            sock.sendall(chunk)
+        if mode == "download":
+            while sock.recv(1024 * 1024):
+                pass
+        else:
+            upstream.join()
+    upstream.join()
+    pipe.send("done")
+
+
+def _count_reads(counter):
+    """把LocalTCP/RemoteTCP收数据的回调包一层, 记下回调次数"""
+    for cls in (LocalTCP, RemoteTCP):
+        for name in ("data_received", "buffer_updated"):
+            fn = cls.__dict__.get(name)
+            if fn is None:
+                continue
+
+            def wrapper(self, arg, fn=fn):
+                counter[0] += 1
+                return fn(self, arg)
+
+            setattr(cls, name, wrapper)
+
+
+def _recv_allocs(counter):
+    if not issubclass(LocalTCP, asyncio.BufferedProtocol):
+        return counter[0]
+    from shadowsocks.metrics import RECEIVE_BUFFER_ALLOC_COUNT
+
+    return int(
+        sum(
+            s.value
+            for m in RECEIVE_BUFFER_ALLOC_COUNT.collect()
+            for s in m.samples
+            if s.name.endswith("_total")
+        )
+    )
+
+
+async def bench(method, mode, total_mb, counter):
+    total = total_mb * 1024 * 1024
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(LocalTCP(NODE_PORT), "127.0.0.1", NODE_PORT)
+    ctx = multiprocessing.get_context("spawn")
+    pipe, child_pipe = ctx.Pipe()
+    child = ctx.Process(target=_client, args=(method, mode, total, child_pipe))
+    child.start()
+    await loop.run_in_executor(None, pipe.recv)
+
+    allocs, reads = _recv_allocs(counter), counter[0]
+    cpu, t = time.process_time(), time.perf_counter()
+    pipe.send("go")
+    await loop.run_in_executor(None, pipe.recv)
+    cpu, cost = time.process_time() - cpu, time.perf_counter() - t
+    reads = counter[0] - reads
+    child.join()
+    server.close()
+    await asyncio.sleep(0.1)
+
+    print(
+        "{:<24} {:<8} {:8.1f}MB/s cpu_s_per_gb={:.2f} reads={} recv_allocs={}".format(
+            method,
+            mode,
+            total_mb / cost,
+            cpu / (total_mb / 1024),
+            reads,
+            _recv_allocs(counter) - allocs,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--method", default="aes-128-gcm")
+    parser.add_argument("--mb", type=int, default=256)
+    parser.add_argument("--modes", nargs="*", default=["download", "upload"])
+    args = parser.parse_args()
+
+    User.create_table()
+    User.delete().execute()
+    User.create_or_update_by_user_data_list(
+        [
+            dict(
+                user_id=1,
+                port=NODE_PORT,
+                method=args.method,
+                password=PASSWORD,
+                enable=True,
+            )
+        ]
+    )
+    counter = [0]
+    _count_reads(counter)
+    for mode in args.modes:
+        asyncio.run(bench(args.method, mode, args.mb, counter))
+
+
+if __name__ == "__main__":
+    main()
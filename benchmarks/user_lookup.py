@@ -0,0 +1,108 @@
+"""
+多用户端口新连接找用户(find_access_user) benchmark
+
+对比AEAD逐个用户试解密和2022通过EIH直接定位用户的建连开销
+
+    python -m benchmarks.user_lookup
+"""
+import base64
+import os
+import random
+import time
+
+from blake3 import blake3
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from shadowsocks import protocol_flag as flag
+from shadowsocks.ciphers import SUPPORT_METHODS
+from shadowsocks.mdb.models import User
+
+USER_COUNTS = [10, 1000, 10000]
+CONNECTIONS = 20
+PORT = 10086
+HEADER = b"\x01\x7f\x00\x00\x01\x00\x50"
+
+
+def _aead_users(method, user_count):
+    return [f"{method}-password-{i}" for i in range(user_count)]
+
+
+def _ss2022_users(method, user_count):
+    cipher_cls = SUPPORT_METHODS[method]
+    ipsk = base64.b64encode(os.urandom(cipher_cls.KEY_SIZE)).decode()
+    return [
+        f"{ipsk}:{base64.b64encode(os.urandom(cipher_cls.KEY_SIZE)).decode()}"
+        for _ in range(user_count)
+    ]
+
+
+def _aead_first_data(method, password):
+    cipher_cls = SUPPORT_METHODS[method]
+    data = cipher_cls(password).encrypt(HEADER)
+    return data[: cipher_cls.tcp_first_data_len()]
+
+
+def _ss2022_first_data(method, password):
+    cipher_cls = SUPPORT_METHODS[method]
+    cipher = cipher_cls(password)
+    salt = os.urandom(cipher_cls.SALT_SIZE)
+    cipher._subkey = cipher._derive_subkey(salt)
+    subkey = blake3(
+        cipher.identity_key + salt,
+        derive_key_context=cipher_cls.IDENTITY_SUBKEY_CONTEXT,
+    ).digest(length=cipher_cls.KEY_SIZE)
+    encryptor = Cipher(algorithms.AES(subkey), modes.ECB()).encryptor()
+    eih = encryptor.update(cipher_cls.identity_hash(password)) + encryptor.finalize()
+    variable_header = HEADER + b"\x00\x00"
+    fixed_header = (
+        b"\x00"
+        + int(time.time()).to_bytes(8, "big")
+        + len(variable_header).to_bytes(2, "big")
+    )
+    return salt + eih + cipher._encrypt(fixed_header)
+
+
+def _setup_users(method, passwords):
+    User.delete().execute()
+    User.create_or_update_by_user_data_list(
+        [
+            {
+                "user_id": i,
+                "port": PORT,
+                "method": method,
+                "password": password,
+                "enable": True,
+            }
+            for i, password in enumerate(passwords, 1)
+        ]
+    )
+
+
+def bench(method, make_users, make_first_data, user_count):
+    passwords = make_users(method, user_count)
+    _setup_users(method, passwords)
+    targets = random.sample(passwords, min(CONNECTIONS, user_count))
+    first_datas = [make_first_data(method, p) for p in targets]
+    # NOTE 预热一次, 2022的identity索引在第一次查找时建立
+    User.find_access_user(PORT, method, flag.TRANSPORT_TCP, first_datas[0])
+    t = time.perf_counter()
+    for password, first_data in zip(targets, first_datas):
+        user, _ = User.find_access_user(PORT, method, flag.TRANSPORT_TCP, first_data)
+        assert user.password == password
+    return (time.perf_counter() - t) / len(targets)
+
+
+def main():
+    User.create_table()
+    cases = [
+        ("aes-128-gcm", _aead_users, _aead_first_data),
+        ("2022-blake3-aes-128-gcm", _ss2022_users, _ss2022_first_data),
+    ]
+    for user_count in USER_COUNTS:
+        for method, make_users, make_first_data in cases:
+            cost = bench(method, make_users, make_first_data, user_count)
+            print(f"{method:<24} users={user_count:>6} setup={cost * 1000:10.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
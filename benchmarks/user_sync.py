@@ -0,0 +1,112 @@
+"""
+用户同步 benchmark
+
+每种用户数下分别测: 首次全量导入, 没有变化的重复同步, 全部用户改密码,
+删掉10%同时新增10%.
+legacy是以前逐个get_or_create+save改密码的写法, 用来和rotate对比
+memory对比json.load整个解析和流式解析的首次导入, 除去同步完留下来的内存之外的峰值
+
+    python -m benchmarks.user_sync
+    python -m benchmarks.user_sync --users 1000 10000 100000 --legacy-max 10000
+"""
+import argparse
+import io
+import json
+import time
+import tracemalloc
+
+from shadowsocks.mdb.models import User
+from shadowsocks.proxyman import ProxyMan
+
+METHOD = "aes-128-gcm"
+PORTS = 100
+
+
+def _user_data(user_ids, password_version=0):
+    return [
+        {
+            "user_id": i,
+            "port": 10000 + i % PORTS,
+            "method": METHOD,
+            "password": f"password-{i}-{password_version}",
+            "enable": True,
+        }
+        for i in user_ids
+    ]
+
+
+def _timeit(fn):
+    t = time.perf_counter()
+    ret = fn()
+    return (time.perf_counter() - t) * 1000, ret
+
+
+def _legacy_sync(user_data_list):
+    for user_data in user_data_list:
+        User._create_or_update_user_from_data(dict(user_data))
+
+
+def bench(user_count, legacy):
+    User.delete().execute()
+    user_ids = range(1, user_count + 1)
+    cases = [
+        ("initial", _user_data(user_ids)),
+        ("noop", _user_data(user_ids)),
+        ("rotate", _user_data(user_ids, 1)),
+        (
+            "churn",
+            _user_data(
+                range(user_count // 10 + 1, user_count + user_count // 10 + 1), 1
+            ),
+        ),
+    ]
+    for name, data in cases:
+        cost, report = _timeit(lambda: User.create_or_update_by_user_data_list(data))
+        print(f"users={user_count:<7} {name:<8} {cost:9.1f}ms {report}")
+    if legacy:
+        # NOTE 和rotate一样是全部用户改密码
+        legacy_data = [
+            dict(u, password=u["password"] + "-legacy") for u in cases[-1][1]
+        ]
+        cost, _ = _timeit(lambda: _legacy_sync(legacy_data))
+        print(f"users={user_count:<7} {'legacy':<8} {cost:9.1f}ms rotate one by one")
+
+
+def _json_load_sync(fp):
+    User.create_or_update_by_user_data_list(json.load(fp)["users"])
+
+
+def bench_memory(user_count):
+    raw = json.dumps({"users": _user_data(range(1, user_count + 1))}).encode()
+    for name, fn in (
+        ("json.load", _json_load_sync),
+        ("stream", ProxyMan.sync_users_from_json),
+    ):
+        User.delete().execute()
+        User.registry.clear()
+        tracemalloc.start()
+        fn(io.BytesIO(raw))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"users={user_count:<7} {name:<9} peak={(peak - current) / 2 ** 20:.1f}MB"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", nargs="*", type=int, default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--legacy-max", type=int, default=10000, help="超过这个用户数不跑legacy, 太慢了"
+    )
+    parser.add_argument("--memory", action="store_true", help="同时测解析的内存峰值")
+    args = parser.parse_args()
+
+    User.create_table()
+    for user_count in args.users:
+        bench(user_count, user_count <= args.legacy_max)
+        args.memory and bench_memory(user_count)
+
+
+if __name__ == "__main__":
+    main()
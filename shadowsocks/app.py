@@ -3,6 +3,7 @@ import inspect
 import logging
 import os
 import signal
+from concurrent.futures import ThreadPoolExecutor
 
 import sentry_sdk
 from aiohttp import web
@@ -11,10 +12,14 @@ from grpclib.server import Server
 from prometheus_async import aio
 from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 
+from shadowsocks.cipherman import CipherMan
+from shadowsocks.core import LocalHandler
 from shadowsocks.mdb import BaseModel, models
+from shadowsocks.offload import CryptoOffloader
 from shadowsocks.proxyman import ProxyMan
 from shadowsocks.rpc_clients import SSClient
 from shadowsocks.services import AioShadowsocksServicer
+from shadowsocks.timer import TimerWheel
 
 
 async def logging_grpc_request(event: RecvRequest) -> None:
@@ -38,20 +43,58 @@ class App:
             "STREAM_DNS_SERVER": os.getenv("SS_STREAM_DNS_SERVER"),
             "METRICS_PORT": os.getenv("SS_METRICS_PORT"),
             "TIME_OUT_LIMIT": int(os.getenv("SS_TIME_OUT_LIMIT", 60)),
+            "CONN_MAX_LIFETIME": int(os.getenv("SS_CONN_MAX_LIFETIME", 0)),
+            "HANDSHAKE_TIMEOUT": int(os.getenv("SS_HANDSHAKE_TIMEOUT", 10)),
             "USER_TCP_CONN_LIMIT": int(os.getenv("SS_TCP_CONN_LIMIT", 60)),
+            # NOTE reject: 拒绝新连接 evict: 关掉这个用户最久没有数据的连接
+            "TCP_CONN_LIMIT_POLICY": os.getenv(
+                "SS_TCP_CONN_LIMIT_POLICY", CipherMan.TCP_CONN_LIMIT_REJECT
+            ),
+            "CRYPTO_OFFLOAD_WORKERS": int(os.getenv("SS_CRYPTO_OFFLOAD_WORKERS", 0)),
+            "CRYPTO_OFFLOAD_THRESHOLD": int(
+                os.getenv("SS_CRYPTO_OFFLOAD_THRESHOLD", 0)
+            ),
+            "METRICS_FLUSH_TIME": int(os.getenv("SS_METRICS_FLUSH_TIME", 5)),
+            "SNAPSHOT_PATH": os.getenv("SS_SNAPSHOT_PATH"),
+            "SNAPSHOT_TIME": int(os.getenv("SS_SNAPSHOT_TIME", 60)),
+            "LOOKUP_WORKERS": int(os.getenv("SS_LOOKUP_WORKERS", 0)),
+            "LOOKUP_PARALLEL_THRESHOLD": int(
+                os.getenv("SS_LOOKUP_PARALLEL_THRESHOLD", 500)
+            ),
+            "WRITE_BUFFER_HIGH": int(os.getenv("SS_WRITE_BUFFER_HIGH", 64 * 1024)),
+            "WRITE_BUFFER_LOW": int(os.getenv("SS_WRITE_BUFFER_LOW", 16 * 1024)),
+            # NOTE 格式: port:high:low,port:high:low
+            "PORT_WRITE_BUFFER_LIMITS": os.getenv("SS_PORT_WRITE_BUFFER_LIMITS", ""),
+            "CONNECT_BUFFER_LIMIT": int(
+                os.getenv("SS_CONNECT_BUFFER_LIMIT", 64 * 1024)
+            ),
         }
 
         self.grpc_host = self.config["GRPC_HOST"]
         self.grpc_port = self.config["GRPC_PORT"]
         self.log_level = self.config["LOG_LEVEL"]
         self.sync_time = self.config["SYNC_TIME"]
+        self.metrics_flush_time = self.config["METRICS_FLUSH_TIME"]
+        self.snapshot_path = self.config["SNAPSHOT_PATH"]
+        self.snapshot_time = self.config["SNAPSHOT_TIME"]
         self.sentry_dsn = self.config["SENTRY_DSN"]
         self.listen_host = self.config["LISTEN_HOST"]
         self.api_endpoint = self.config["API_ENDPOINT"]
         self.timeout_limit = self.config["TIME_OUT_LIMIT"]
+        self.conn_max_lifetime = self.config["CONN_MAX_LIFETIME"]
+        self.handshake_timeout = self.config["HANDSHAKE_TIMEOUT"]
         self.stream_dns_server = self.config["STREAM_DNS_SERVER"]
         self.user_tcp_conn_limit = self.config["USER_TCP_CONN_LIMIT"]
+        self.tcp_conn_limit_policy = self.config["TCP_CONN_LIMIT_POLICY"]
         self.metrics_port = self.config["METRICS_PORT"]
+        self.crypto_offload_workers = self.config["CRYPTO_OFFLOAD_WORKERS"]
+        self.crypto_offload_threshold = self.config["CRYPTO_OFFLOAD_THRESHOLD"]
+        self.lookup_workers = self.config["LOOKUP_WORKERS"]
+        self.lookup_parallel_threshold = self.config["LOOKUP_PARALLEL_THRESHOLD"]
+        self.write_buffer_high = self.config["WRITE_BUFFER_HIGH"]
+        self.write_buffer_low = self.config["WRITE_BUFFER_LOW"]
+        self.port_write_buffer_limits = self.config["PORT_WRITE_BUFFER_LIMITS"]
+        self.connect_buffer_limit = self.config["CONNECT_BUFFER_LIMIT"]
 
         self.use_sentry = bool(self.sentry_dsn)
         self.use_json = not self.api_endpoint
@@ -89,6 +132,74 @@ class App:
         sentry_sdk.init(dsn=self.sentry_dsn, integrations=[AioHttpIntegration()])
         logging.info("Init Sentry Client...")
 
+    def _init_crypto_offload(self):
+        if not self.crypto_offload_workers:
+            return
+        # NOTE threshold为0的时候启动时自动校准
+        CipherMan.offloader = CryptoOffloader(
+            self.crypto_offload_workers, self.crypto_offload_threshold or None
+        )
+        logging.info(f"Init Crypto Offload workers={self.crypto_offload_workers}")
+
+    def _init_parallel_lookup(self):
+        if not self.lookup_workers:
+            return
+        CipherMan.lookup_executor = ThreadPoolExecutor(
+            max_workers=self.lookup_workers, thread_name_prefix="ss-lookup"
+        )
+        CipherMan.lookup_partitions = self.lookup_workers
+        CipherMan.lookup_parallel_threshold = self.lookup_parallel_threshold
+        logging.info(
+            f"Init Parallel Lookup workers={self.lookup_workers} threshold={self.lookup_parallel_threshold}"
+        )
+
+    def _init_flow_control(self):
+        LocalHandler.write_buffer_limits = (
+            self.write_buffer_high,
+            self.write_buffer_low,
+        )
+        for item in self.port_write_buffer_limits.split(","):
+            if not item.strip():
+                continue
+            port, high, low = map(int, item.split(":"))
+            LocalHandler.port_write_buffer_limits[port] = (high, low)
+        LocalHandler.connect_buffer_limit = self.connect_buffer_limit
+        logging.info(
+            "Init Flow Control write_buffer={} ports={} connect_buffer={}".format(
+                LocalHandler.write_buffer_limits,
+                LocalHandler.port_write_buffer_limits,
+                LocalHandler.connect_buffer_limit,
+            )
+        )
+
+    def _init_timeouts(self):
+        if not (self.timeout_limit or self.conn_max_lifetime or self.handshake_timeout):
+            return
+        LocalHandler.timer_wheel = TimerWheel()
+        LocalHandler.idle_timeout = self.timeout_limit
+        LocalHandler.max_lifetime = self.conn_max_lifetime
+        LocalHandler.handshake_timeout = self.handshake_timeout
+        logging.info(
+            f"Init Timeouts idle={self.timeout_limit}s "
+            f"max_lifetime={self.conn_max_lifetime}s "
+            f"handshake={self.handshake_timeout}s"
+        )
+
+    def _init_conn_limit(self):
+        policies = (CipherMan.TCP_CONN_LIMIT_REJECT, CipherMan.TCP_CONN_LIMIT_EVICT)
+        if self.tcp_conn_limit_policy not in policies:
+            raise ValueError(
+                f"unknown SS_TCP_CONN_LIMIT_POLICY: {self.tcp_conn_limit_policy}"
+            )
+        CipherMan.tcp_conn_limit = self.user_tcp_conn_limit
+        CipherMan.tcp_conn_limit_policy = self.tcp_conn_limit_policy
+        if self.tcp_conn_limit_policy == CipherMan.TCP_CONN_LIMIT_EVICT:
+            CipherMan.conn_evictor = LocalHandler.evict_idle_conn
+        logging.info(
+            f"Init TCP Conn Limit limit={self.user_tcp_conn_limit} "
+            f"policy={self.tcp_conn_limit_policy}"
+        )
+
     def _prepare(self):
         if self._prepared:
             return
@@ -97,8 +208,19 @@ class App:
         self._init_logger()
         self._init_memory_db()
         self._init_sentry()
+        self._init_crypto_offload()
+        self._init_parallel_lookup()
+        self._init_flow_control()
+        self._init_timeouts()
+        self._init_conn_limit()
         self.proxyman = ProxyMan(
-            self.use_json, self.sync_time, self.listen_host, self.api_endpoint
+            self.use_json,
+            self.sync_time,
+            self.listen_host,
+            self.api_endpoint,
+            self.metrics_flush_time,
+            self.snapshot_path,
+            self.snapshot_time,
         )
 
         signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
@@ -114,6 +236,11 @@ class App:
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         [task.cancel() for task in tasks]
         self.proxyman.close_server()
+        self.proxyman.snapshot and self.proxyman.snapshot.save_sync()
+        CipherMan.offloader and CipherMan.offloader.close()
+        CipherMan.lookup_executor and CipherMan.lookup_executor.shutdown(wait=False)
+        if LocalHandler.timer_wheel is not None:
+            LocalHandler.timer_wheel.stop()
         if self.grpc_server:
             self.grpc_server.close()
             logging.info(f"grpc server closed!")
@@ -148,6 +275,9 @@ class App:
         if self.grpc_host and self.grpc_port:
             await self._start_grpc_server()
 
+        self.loop.create_task(self.proxyman.flush_metrics_cron())
+        if self.proxyman.snapshot:
+            self.loop.create_task(self.proxyman.snapshot_cron())
         await self.proxyman.start_and_check_ss_server()
 
     def run_ss_server(self):
@@ -0,0 +1,69 @@
+from shadowsocks.metrics import (
+    RECEIVE_BUFFER_BYTES,
+    RECEIVE_BUFFER_GROW_COUNT,
+    RECEIVE_BUFFER_NEW_COUNT,
+    RECEIVE_BUFFER_SHRINK_COUNT,
+)
+
+
+class ReceiveBuffer:
+    """
+    BufferedProtocol的接收buffer, 每个连接一份, 每次read都读进同一块内存
+
+    NOTE 大小跟着这个连接的读取情况走: 一次读满说明socket里还有数据, 直接翻倍;
+    连续SHRINK_AFTER次只用到不到1/4就减半. 空闲连接只占INITIAL_SIZE
+    """
+
+    __slots__ = ("_buf", "_view", "_small_reads")
+
+    MIN_SIZE = 2 * 1024
+    INITIAL_SIZE = 4 * 1024
+    # NOTE 和asyncio.Protocol每次recv的上限一样
+    MAX_SIZE = 256 * 1024
+    SHRINK_AFTER = 8
+
+    def __init__(self, size=INITIAL_SIZE):
+        self._buf = None
+        self._view = None
+        self._small_reads = 0
+        self._alloc(size)
+        RECEIVE_BUFFER_NEW_COUNT.inc()
+
+    def __len__(self):
+        return len(self._buf) if self._buf is not None else 0
+
+    def _alloc(self, size):
+        RECEIVE_BUFFER_BYTES.inc(size - len(self))
+        # NOTE 不在原来的bytearray上resize, 上一次返回的view还可能被引用着
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+
+    def get_buffer(self) -> memoryview:
+        return self._view
+
+    def updated(self, nbytes: int) -> memoryview:
+        """
+        返回这次读到的数据
+
+        NOTE 返回的view只在这次回调里有效, 下次read会覆盖, 要留着用必须先拷贝
+        """
+        data = self._view[:nbytes]
+        size = len(self._buf)
+        if nbytes == size:
+            self._small_reads = 0
+            if size < self.MAX_SIZE:
+                self._alloc(min(size * 2, self.MAX_SIZE))
+                RECEIVE_BUFFER_GROW_COUNT.inc()
+        elif nbytes < size // 4 and size > self.MIN_SIZE:
+            self._small_reads += 1
+            if self._small_reads >= self.SHRINK_AFTER:
+                self._small_reads = 0
+                self._alloc(max(size // 2, self.MIN_SIZE))
+                RECEIVE_BUFFER_SHRINK_COUNT.inc()
+        else:
+            self._small_reads = 0
+        return data
+
+    def release(self):
+        RECEIVE_BUFFER_BYTES.dec(len(self))
+        self._buf = self._view = None
@@ -1,46 +1,78 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
 from shadowsocks import protocol_flag as flag
 from shadowsocks.ciphers import SUPPORT_METHODS
 from shadowsocks.mdb.models import User
+from shadowsocks.mdb.registry import UserRecord
 from shadowsocks.metrics import (
     DECRYPT_DATA_TIME,
     ENCRYPT_DATA_TIME,
     NETWORK_TRANSMIT_BYTES,
+    TCP_CONN_LIMIT_EVICT_COUNT,
+    TCP_CONN_LIMIT_REJECT_COUNT,
 )
+from shadowsocks.offload import CryptoLane, CryptoOffloader
 from shadowsocks.utils import AutoResetBloomFilter
 
 
 class CipherMan:
     bf = AutoResetBloomFilter()
+    # NOTE 由App根据配置决定是否开启, 所有连接共用一个线程池
+    offloader: CryptoOffloader = None
+    # NOTE 用户很多的端口找用户时并行试解密, 也是由App根据配置决定是否开启
+    lookup_executor: ThreadPoolExecutor = None
+    lookup_partitions = 1
+    lookup_parallel_threshold = 500
+    # NOTE 每个用户的tcp连接数上限, 用户数据里的tcp_conn_limit优先, 0表示不限制
+    tcp_conn_limit = 0
+    TCP_CONN_LIMIT_REJECT = "reject"
+    TCP_CONN_LIMIT_EVICT = "evict"
+    tcp_conn_limit_policy = TCP_CONN_LIMIT_REJECT
+    # NOTE evict的时候由App设置, 关掉这个用户最久没有数据的连接, 关掉了返回True
+    conn_evictor: Callable[[UserRecord], bool] = None
 
-    # TODO 流量、链接数限速
+    # TODO 流量限速
 
     def __init__(
         self,
         user_port=None,
-        access_user: User = None,
+        access_user: UserRecord = None,
         ts_protocol=flag.TRANSPORT_TCP,
         peername=None,
+        request_salt=None,
+        cipher=None,
     ):
         self.user_port = user_port
         self.access_user = access_user
         self.ts_protocol = ts_protocol
         self.peername = peername
+        # NOTE 2022的响应里需要带上请求的salt
+        self.request_salt = request_salt
 
-        self.cipher = None
+        # NOTE udp session的cipher可以和RemoteUDP共用
+        self.cipher = cipher
         self._buffer = bytearray()
+        self._lane = None
+        # NOTE 第一次解密的时候才检查用户和计数, 单用户端口不用找用户也要走一遍
+        self._authenticated = False
+        self._tcp_conn_counted = False
 
         if self.access_user:
             self.method = access_user.method
         else:
-            self.method = (
-                User.list_by_port(self.user_port).first().method
-            )  # NOTE 所有的user用的加密方式必须是一种
+            self.method = User.registry.first_by_port(
+                self.user_port
+            ).method  # NOTE 所有的user用的加密方式必须是一种
 
         self.cipher_cls = SUPPORT_METHODS.get(self.method)
         if not self.cipher_cls:
             raise Exception(f"暂时不支持这种加密方式:{self.method}")
+        self.udp_session = (
+            self.ts_protocol == flag.TRANSPORT_UDP and self.cipher_cls.UDP_SESSION
+        )
         if self.cipher_cls.AEAD_CIPHER and self.ts_protocol == flag.TRANSPORT_TCP:
             self._first_data_len = self.cipher_cls.tcp_first_data_len()
         else:
@@ -48,8 +80,10 @@ class CipherMan:
 
     @classmethod
     def get_cipher_by_port(cls, port, ts_protocol, peername) -> CipherMan:
-        user_query = User.list_by_port(port)
-        access_user = user_query.first() if user_query.count() == 1 else None
+        registry = User.registry
+        access_user = (
+            registry.first_by_port(port) if registry.count_by_port(port) == 1 else None
+        )
         return cls(
             port, access_user=access_user, ts_protocol=ts_protocol, peername=peername
         )
@@ -58,69 +92,262 @@ class CipherMan:
     def encrypt(self, data: bytes):
         self.record_user_traffic(0, len(data))
 
+        if self.udp_session:
+            return self.cipher.pack(data)
         if self.ts_protocol == flag.TRANSPORT_UDP:
             cipher = self.cipher_cls(self.access_user.password)
             return cipher.pack(data)
 
         if not self.cipher:
-            self.cipher = self.cipher_cls(self.access_user.password)
+            self.cipher = self._new_cipher()
         return self.cipher.encrypt(data)
 
+    @ENCRYPT_DATA_TIME.time()
+    def encrypt_chunks(self, data: bytes) -> List[bytes]:
+        """只用于tcp, 返回的chunk直接交给transport.writelines"""
+        self.record_user_traffic(0, len(data))
+
+        if not self.cipher:
+            self.cipher = self._new_cipher()
+        return self.cipher.encrypt_chunks(data)
+
+    def encrypt_chunks_then(self, data: bytes, callback, errback):
+        """加密之后回调callback, 开启offload的时候大块数据会丢到线程池里加密"""
+        if not self._can_offload():
+            try:
+                chunks = self.encrypt_chunks(data)
+            except Exception as e:
+                errback(e)
+            else:
+                callback(chunks)
+            return
+
+        # NOTE UserRecord只能在事件循环的线程里修改, 流量在这里记好再丢到线程池
+        self.record_user_traffic(0, len(data))
+        if not self.cipher:
+            self.cipher = self._new_cipher()
+        self._get_lane().submit(self._encrypt_tcp_chunks, data, callback, errback)
+
+    def decrypt_then(self, data: bytes, callback, errback):
+        """
+        解密之后回调callback, 开启offload的时候大块数据会丢到线程池里解密
+
+        NOTE 找用户之前的数据还是在事件循环的线程里解密
+        """
+        if not (self._can_offload() and self._authenticated and self.cipher):
+            try:
+                data = self.decrypt(data)
+            except Exception as e:
+                errback(e)
+            else:
+                callback(data)
+            return
+
+        self.record_user_traffic(len(data), 0)
+        self._get_lane().submit(self._decrypt_tcp, data, callback, errback)
+
+    def _can_offload(self):
+        return self.offloader is not None and self.ts_protocol == flag.TRANSPORT_TCP
+
+    def _get_lane(self) -> CryptoLane:
+        if not self._lane:
+            self._lane = CryptoLane(self.offloader, self.cipher_cls)
+        return self._lane
+
+    @ENCRYPT_DATA_TIME.time()
+    def _encrypt_tcp_chunks(self, data: bytes) -> List[bytes]:
+        return self.cipher.encrypt_chunks(data)
+
+    @DECRYPT_DATA_TIME.time()
+    def _decrypt_tcp(self, data: bytes) -> bytes:
+        return self.cipher.decrypt(data)
+
     @DECRYPT_DATA_TIME.time()
     def decrypt(self, data: bytes):
-        if (
-            self.access_user is None
-            and len(data) + len(self._buffer) < self._first_data_len
-        ):
-            self._buffer.extend(data)
-            return
+        if self.access_user and not self._authenticated:
+            return self._decrypt_first_data(data)
+        if not self.access_user:
+            first_data = self._feed_first_data(data)
+            if first_data is None:
+                return
+            self._set_access_user(
+                *User.find_access_user(
+                    self.user_port,
+                    self.method,
+                    self.ts_protocol,
+                    first_data,
+                    peer_ip=self.peername and self.peername[0],
+                )
+            )
+            data = self._take_buffer(len(first_data))
+        return self._decrypt_data(data)
 
+    async def decrypt_async(self, data: bytes):
+        """
+        找用户的时候不阻塞事件循环, 只用于tcp
+
+        NOTE 找用户期间收到的数据要用feed放进buffer, 找到之后一起解密
+        """
+        if self.access_user and not self._authenticated:
+            return self._decrypt_first_data(data)
         if not self.access_user:
-            self._buffer.extend(data)
-            if self.ts_protocol == flag.TRANSPORT_TCP:
-                first_data = self._buffer[: self._first_data_len]
-            else:
-                first_data = self._buffer
-            salt = first_data[: self.cipher_cls.SALT_SIZE]
-            if salt in self.bf:
-                raise RuntimeError(f"repeated salt founded!,peer:{self.peername}")
-            else:
-                self.bf.add(salt)
+            first_data = self._feed_first_data(data)
+            if first_data is None:
+                return
+            access_user, cipher = await User.find_access_user_async(
+                self.user_port,
+                self.method,
+                self.ts_protocol,
+                first_data,
+                peer_ip=self.peername and self.peername[0],
+                executor=self.lookup_executor,
+                partitions=self.lookup_partitions,
+                parallel_threshold=self.lookup_parallel_threshold,
+            )
+            self._set_access_user(access_user, cipher)
+            data = self._take_buffer(len(first_data))
+        return self._decrypt_data(data)
+
+    def _decrypt_first_data(self, data: bytes):
+        """
+        单用户端口不用找用户, 但也要等首包校验通过之后才认证
 
-            access_user = User.find_access_user(
-                self.user_port, self.method, self.ts_protocol, first_data
+        NOTE 没解开的数据不能占用户的连接数, 也不能记到用户的ip里
+        """
+        if not (self.ts_protocol == flag.TRANSPORT_TCP and self.cipher_cls.AEAD_CIPHER):
+            # NOTE udp整个包解开了才算认证通过, 不加密的方式没有可以校验的东西
+            data = self._decrypt_data(data)
+            self._authenticate()
+            return data
+        first_data = self._feed_first_data(data)
+        if first_data is None:
+            return
+        cipher = self.cipher_cls.probe(self.access_user.password, first_data)
+        if not cipher:
+            raise RuntimeError(
+                f"first data decrypt failed: {self.access_user} peer={self.peername}"
             )
+        self._set_access_user(self.access_user, cipher)
+        return self._decrypt_data(self._take_buffer(len(first_data)))
 
-            if not access_user:
-                raise RuntimeError(
-                    f"can not find enable access user: {self.user_port}-{self.ts_protocol}-{self.cipher_cls}"
-                )
-            if not access_user.enable:
-                raise RuntimeError(f"access user not have traffic: {access_user}")
-            self.access_user = access_user
-            self.record_user_ip(self.peername)
-            self.incr_user_tcp_num()
+    @property
+    def needs_lookup(self):
+        """tcp还没找到用户, 需要走LocalHandler的STAGE_LOOKUP"""
+        return self.access_user is None and self.ts_protocol == flag.TRANSPORT_TCP
+
+    def feed(self, data: bytes):
+        self._buffer.extend(data)
+
+    def _feed_first_data(self, data: bytes):
+        """数据够找用户了才返回首包"""
+        self._buffer.extend(data)
+        if len(self._buffer) < self._first_data_len:
+            return
+        if self.ts_protocol == flag.TRANSPORT_TCP:
+            first_data = self._buffer[: self._first_data_len]
+        else:
+            first_data = self._buffer
+        salt = first_data[: self.cipher_cls.SALT_SIZE]
+        if salt in self.bf:
+            raise RuntimeError(f"repeated salt founded!,peer:{self.peername}")
+        else:
+            self.bf.add(salt)
+        return first_data
+
+    def _set_access_user(self, access_user: UserRecord, cipher=None):
+        if not access_user:
+            raise RuntimeError(
+                f"can not find enable access user: {self.user_port}-{self.ts_protocol}-{self.cipher_cls}"
+            )
+        self.access_user = access_user
+        self._authenticate()
+        # NOTE 找用户的时候tcp首包的长度块已经解过了, 直接用那个cipher接着解
+        if cipher:
+            self.cipher = cipher
+
+    def _authenticate(self):
+        """每个连接只做一次: 检查用户状态和连接数上限, 记下ip和tcp连接数"""
+        access_user = self.access_user
+        if not access_user.enable:
+            raise RuntimeError(f"access user not have traffic: {access_user}")
+        if self.ts_protocol == flag.TRANSPORT_TCP:
+            self._check_tcp_conn_limit(access_user)
+        self._authenticated = True
+        self.record_user_ip(self.peername)
+        self.incr_user_tcp_num()
+
+    def _check_tcp_conn_limit(self, access_user: UserRecord):
+        """在access_user计数之前检查, 超过上限的时候按策略拒绝或者踢掉旧连接"""
+        limit = access_user.tcp_conn_limit
+        if limit is None:
+            limit = self.tcp_conn_limit
+        if not limit or access_user.tcp_conn_num < limit:
+            return
+        if (
+            self.tcp_conn_limit_policy == self.TCP_CONN_LIMIT_EVICT
+            and self.conn_evictor
+            and self.conn_evictor(access_user)
+            and access_user.tcp_conn_num < limit
+        ):
+            TCP_CONN_LIMIT_EVICT_COUNT.inc()
+            return
+        TCP_CONN_LIMIT_REJECT_COUNT.inc()
+        raise RuntimeError(
+            f"too many tcp connections: {access_user} num={access_user.tcp_conn_num} limit={limit}"
+        )
+
+    def _take_buffer(self, first_data_len: int) -> bytes:
+        if self.cipher and self.ts_protocol == flag.TRANSPORT_TCP:
+            data = bytes(self._buffer[first_data_len:])
+        else:
             data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def _decrypt_data(self, data: bytes):
         if not self.cipher:
             self.cipher = self.cipher_cls(self.access_user.password)
 
         self.record_user_traffic(len(data), 0)
         if self.ts_protocol == flag.TRANSPORT_TCP:
             return self.cipher.decrypt(data)
+        elif self.udp_session:
+            return self.cipher.unpack(data)
         else:
             return self.cipher_cls(self.access_user.password).unpack(data)
 
-    def incr_user_tcp_num(self, num: int = 1):
-        self.ts_protocol == flag.TRANSPORT_TCP and self.access_user and self.access_user.incr_tcp_conn_num(
-            num
-        )
+    @property
+    def salt(self):
+        return self.cipher and self.cipher.salt
+
+    def _new_cipher(self):
+        cipher = self.cipher_cls(self.access_user.password)
+        cipher.request_salt = self.request_salt
+        return cipher
+
+    def incr_user_tcp_num(self):
+        if self.ts_protocol != flag.TRANSPORT_TCP or self._tcp_conn_counted:
+            return
+        self._tcp_conn_counted = True
+        self.access_user.incr_tcp_conn_num(1)
+
+    def decr_user_tcp_num(self):
+        """只有计过数的连接才减, tcp_conn_num不会变成负数"""
+        if not self._tcp_conn_counted:
+            return
+        self._tcp_conn_counted = False
+        self.access_user.incr_tcp_conn_num(-1)
 
     def record_user_ip(self, peername):
         self.access_user and self.access_user.record_ip(peername)
 
     def record_user_traffic(self, ut_data_len: int, dt_data_len: int):
-        self.access_user and self.access_user.record_traffic(ut_data_len, dt_data_len)
+        access_user = self.access_user
+        if access_user:
+            access_user.upload_traffic += ut_data_len
+            access_user.download_traffic += dt_data_len
         NETWORK_TRANSMIT_BYTES.inc(ut_data_len + dt_data_len)
 
     def close(self):
-        self.incr_user_tcp_num(-1)
+        self.decr_user_tcp_num()
+        self._lane and self._lane.close()
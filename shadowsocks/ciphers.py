@@ -1,9 +1,23 @@
 import abc
+import base64
 import hashlib
 import os
+import time
+from typing import Iterable, List
 
-import hkdf
+from blake3 import blake3
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from shadowsocks import protocol_flag as flag
+from shadowsocks.metrics import MASTER_KEY_CACHE_HIT_COUNT, MASTER_KEY_CACHE_MISS_COUNT
+from shadowsocks.utils import LRUCache, SlidingWindowFilter, parse_header
+
+# NOTE {(cipher_cls, password): master_key} 所有cipher实例共享
+MASTER_KEY_CACHE = LRUCache(max_size=20000)
 
 
 def evp_bytestokey(password: bytes, key_size: int):
@@ -20,12 +34,54 @@ def evp_bytestokey(password: bytes, key_size: int):
     return b"".join(m)
 
 
+def aes_ecb_encrypt(key: bytes, block: bytes) -> bytes:
+    encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+    return encryptor.update(block) + encryptor.finalize()
+
+
+def aes_ecb_decrypt(key: bytes, block: bytes) -> bytes:
+    decryptor = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+    return decryptor.update(block) + decryptor.finalize()
+
+
+def invalidate_master_keys(passwords: Iterable[str]):
+    """用户的密码变了或者被删除了, 清掉旧密码的master key"""
+    passwords = set(passwords)
+    if not passwords:
+        return
+    for cache_key in MASTER_KEY_CACHE.keys():
+        if cache_key[1] in passwords:
+            MASTER_KEY_CACHE.pop(cache_key)
+
+
 class BaseCipher(metaclass=abc.ABCMeta):
     KEY_SIZE = -1
     AEAD_CIPHER = False
+    IDENTITY_HEADER = False
+    # NOTE udp包里带了session, 同一个session可以一直用同一个cipher
+    UDP_SESSION = False
+
+    salt = None
+    request_salt = None
 
     def __init__(self, password: str):
-        self.key = evp_bytestokey(password.encode(), self.KEY_SIZE)
+        self.key = self.get_master_key(password)
+
+    @classmethod
+    def derive_master_key(cls, password: str) -> bytes:
+        return evp_bytestokey(password.encode(), cls.KEY_SIZE)
+
+    @classmethod
+    def get_master_key(cls, password: str) -> bytes:
+        cache_key = (cls, password)
+        key = MASTER_KEY_CACHE.get(cache_key)
+        if key is None:
+            MASTER_KEY_CACHE_MISS_COUNT.inc()
+            key = cls.derive_master_key(password)
+            MASTER_KEY_CACHE.set(cache_key, key)
+        else:
+            MASTER_KEY_CACHE_HIT_COUNT.inc()
+        return key
 
     @abc.abstractmethod
     def new_cipher(self, *arg, **kwargs):
@@ -39,6 +95,10 @@ class BaseCipher(metaclass=abc.ABCMeta):
     def decrypt(self, data: bytes):
         return
 
+    def encrypt_chunks(self, data: bytes) -> List[bytes]:
+        """加密后的数据按chunk返回, 用来给transport.writelines"""
+        return [self.encrypt(data)]
+
     @abc.abstractmethod
     def unpack(self, data: bytes) -> bytes:
         return
@@ -56,6 +116,7 @@ class BaseAEADCipher(BaseCipher):
 
     INFO = b"ss-subkey"
     PACKET_LIMIT = 16 * 1024 - 1
+    COMPACT_THRESHOLD = 64 * 1024
     SALT_SIZE = -1
     NONCE_SIZE = -1
     TAG_SIZE = -1
@@ -64,13 +125,24 @@ class BaseAEADCipher(BaseCipher):
     def __init__(self, password: str):
         super().__init__(password)
         self._buffer = bytearray()
+        self._read_pos = 0
         self._payload_len = None
         self._subkey = None
         self._counter = 0
         self._cipher = None
 
+    @classmethod
+    def derive_subkey(cls, key: bytes, salt: bytes) -> bytes:
+        # NOTE HKDF-SHA1 走openssl, 比纯python实现的hkdf快
+        return HKDF(
+            algorithm=hashes.SHA1(),
+            length=cls.KEY_SIZE,
+            salt=bytes(salt),
+            info=cls.INFO,
+        ).derive(key)
+
     def _derive_subkey(self, salt: bytes):
-        return hkdf.Hkdf(salt, self.key, hashlib.sha1).expand(self.INFO, self.KEY_SIZE)
+        return self.derive_subkey(self.key, salt)
 
     def _make_random_salt(self):
         return os.urandom(self.SALT_SIZE)
@@ -80,10 +152,11 @@ class BaseAEADCipher(BaseCipher):
             self._cipher = self.new_cipher(self._subkey)
         return self._cipher.encrypt(self.nonce, plaintext, None)
 
-    def _decrypt(self, ciphertext: bytes, tag: bytes):
+    def _decrypt(self, data):
+        """data: ciphertext + tag, bytes or memoryview"""
         if not self._cipher:
             self._cipher = self.new_cipher(self._subkey)
-        return self._cipher.decrypt(self.nonce, bytes(ciphertext + tag), None)
+        return self._cipher.decrypt(self.nonce, data, None)
 
     @property
     def nonce(self):
@@ -92,67 +165,130 @@ class BaseAEADCipher(BaseCipher):
         return ret
 
     def encrypt(self, data: bytes) -> bytes:
-        ret = bytearray()
-        if self._subkey is None:
-            salt = self._make_random_salt()
-            self._subkey = self._derive_subkey(salt)
-            ret.extend(salt)
-        for i in range(0, len(data), self.PACKET_LIMIT):
-            buf = data[i : i + self.PACKET_LIMIT]
-            #  len_chunk, len_tag  + body_chunk + body_tag
-            ret.extend(self._encrypt(len(buf).to_bytes(2, "big")) + self._encrypt(buf))
-        return bytes(ret)
+        return b"".join(self.encrypt_chunks(data))
 
-    def decrypt(self, data: bytes) -> bytes:
-        ret = bytearray()
+    def encrypt_chunks(self, data: bytes) -> List[bytes]:
+        ret = []
         if self._subkey is None:
-            salt, data = data[: self.SALT_SIZE], data[self.SALT_SIZE :]
-            self._subkey = self._derive_subkey(salt)
+            self.salt = self._make_random_salt()
+            self._subkey = self._derive_subkey(self.salt)
+            ret.append(self.salt)
+        with memoryview(data) as view:
+            for i in range(0, len(view), self.PACKET_LIMIT):
+                buf = view[i : i + self.PACKET_LIMIT]
+                #  len_chunk, len_tag  + body_chunk + body_tag
+                ret.append(self._encrypt(len(buf).to_bytes(2, "big")))
+                ret.append(self._encrypt(buf))
+        return ret
 
-        self._buffer.extend(data)
+    @classmethod
+    def _identity_header_size(cls, password: str) -> int:
+        return 0
+
+    @classmethod
+    def _first_length_chunk_size(cls):
+        return 2 + cls.TAG_SIZE
+
+    def _length_chunk_size(self):
+        return 2 + self.TAG_SIZE
+
+    def _parse_length(self, plaintext: bytes) -> int:
+        length = int.from_bytes(plaintext, "big")
+        if length > self.PACKET_LIMIT:
+            raise RuntimeError(f"payload_len too long {length}")
+        return length
+
+    def _decrypt_length(self, chunk) -> int:
+        return self._parse_length(self._decrypt(chunk))
 
+    @classmethod
+    def probe(cls, password: str, first_data: bytes):
+        """
+        找用户用: 只派生subkey, 校验首包里第一个长度块的tag
+
+        成功返回已经解出长度块的cipher, 首包之后的数据直接接着decrypt, 失败返回None
+        NOTE 对不上的用户只有一次HKDF和一次tag校验, 不会创建cipher对象
+        """
+        salt = bytes(first_data[: cls.SALT_SIZE])
+        start = cls.SALT_SIZE + cls._identity_header_size(password)
+        end = start + cls._first_length_chunk_size()
+        subkey = cls.derive_subkey(cls.get_master_key(password), salt)
+        aead = cls.new_cipher(subkey)
+        try:
+            plaintext = aead.decrypt(
+                bytes(cls.NONCE_SIZE), bytes(first_data[start:end]), None
+            )
+        except InvalidTag:
+            return None
+        cipher = cls(password)
+        cipher.salt, cipher._subkey, cipher._cipher = salt, subkey, aead
+        cipher._counter = 1
+        cipher._payload_len = cipher._parse_length(plaintext)
+        cipher._buffer.extend(first_data[end:])
+        return cipher
+
+    def _decrypt_payload(self, chunk) -> bytes:
+        return self._decrypt(chunk)
+
+    def decrypt(self, data: bytes) -> bytes:
+        """
+        data可以是bytes或者memoryview, 返回的明文总是新的bytes
+
+        NOTE buffer里没有剩下的数据时直接在data上解密, 只把不完整的chunk拷贝进buffer
+        """
+        if self._subkey is None:
+            self.salt, data = bytes(data[: self.SALT_SIZE]), data[self.SALT_SIZE :]
+            self._subkey = self._derive_subkey(self.salt)
+
+        buffer = self._buffer
+        if not buffer:
+            with memoryview(data) as view:
+                ret, pos = self._decrypt_chunks(view, 0)
+                buffer.extend(view[pos:])
+            self._read_pos = 0
+            return b"".join(ret)
+
+        buffer.extend(data)
+        # NOTE 用游标读buffer, 切片都是memoryview, 不会拷贝数据
+        with memoryview(buffer) as view:
+            ret, pos = self._decrypt_chunks(view, self._read_pos)
+        end = len(buffer)
+        # NOTE 只有读完或者读过的数据足够多时才整理buffer
+        if pos == end:
+            buffer.clear()
+            pos = 0
+        elif pos >= self.COMPACT_THRESHOLD:
+            del buffer[:pos]
+            pos = 0
+        self._read_pos = pos
+        return b"".join(ret)
+
+    def _decrypt_chunks(self, view: memoryview, pos: int):
+        """从pos开始解出所有完整的chunk, 返回明文列表和读到的位置"""
+        ret, end = [], len(view)
         while True:
             if not self._payload_len:
                 # 从data里拿出payload_length
-                if len(self._buffer) < 2 + self.TAG_SIZE:
+                chunk_end = pos + self._length_chunk_size()
+                if chunk_end > end:
                     break
-                self._payload_len = int.from_bytes(
-                    self._decrypt(
-                        self._buffer[:2], self._buffer[2 : 2 + self.TAG_SIZE]
-                    ),
-                    "big",
-                )
-                if self._payload_len > self.PACKET_LIMIT:
-                    raise RuntimeError(f"payload_len too long {self.payload_len}")
-
-                del self._buffer[: 2 + self.TAG_SIZE]
+                self._payload_len = self._decrypt_length(view[pos:chunk_end])
+                pos = chunk_end
             else:
-                if len(self._buffer) < self._payload_len + self.TAG_SIZE:
+                chunk_end = pos + self._payload_len + self.TAG_SIZE
+                if chunk_end > end:
                     break
-                ret.extend(
-                    self._decrypt(
-                        self._buffer[: self._payload_len],
-                        self._buffer[
-                            self._payload_len : self._payload_len + self.TAG_SIZE
-                        ],
-                    )
-                )
-                del self._buffer[: self._payload_len + self.TAG_SIZE]
+                ret.append(self._decrypt_payload(view[pos:chunk_end]))
+                pos = chunk_end
                 self._payload_len = None
-
-        return bytes(ret)
+        return ret, pos
 
     def unpack(self, data: bytes) -> bytes:
         """解包udp"""
         ret = bytearray()
-        data_len = len(data)
-        salt, data, tag = (
-            data[: self.SALT_SIZE],
-            data[self.SALT_SIZE : data_len - self.TAG_SIZE],
-            data[data_len - self.TAG_SIZE :],
-        )
+        salt = data[: self.SALT_SIZE]
         self._subkey = self._derive_subkey(salt)
-        ret.extend(self._decrypt(data, tag))
+        ret.extend(self._decrypt(memoryview(data)[self.SALT_SIZE :]))
         return bytes(ret)
 
     def pack(self, data: bytes) -> bytes:
@@ -173,11 +309,12 @@ class NONE(BaseCipher):
     def new_cipher(self, key: bytes, iv: bytes):
         return
 
+    # NOTE tcp的data可能是接收buffer的memoryview, 返回之前要拷贝出来
     def encrypt(self, data: bytes):
-        return data
+        return bytes(data)
 
     def decrypt(self, data: bytes):
-        return data
+        return bytes(data)
 
     def unpack(self, data: bytes) -> bytes:
         return data
@@ -192,7 +329,8 @@ class CHACHA20IETFPOLY1305(BaseAEADCipher):
     NONCE_SIZE = 12
     TAG_SIZE = 16
 
-    def new_cipher(self, subkey: bytes):
+    @staticmethod
+    def new_cipher(subkey: bytes):
         return ChaCha20Poly1305(key=subkey)
 
 
@@ -202,7 +340,8 @@ class AES128GCM(BaseAEADCipher):
     NONCE_SIZE = 12
     TAG_SIZE = 16
 
-    def new_cipher(self, subkey: bytes):
+    @staticmethod
+    def new_cipher(subkey: bytes):
         return AESGCM(subkey)
 
 
@@ -213,6 +352,261 @@ class AES256GCM(AES128GCM):
     TAG_SIZE = 16
 
 
+class BaseSS2022Cipher(BaseAEADCipher):
+    """DOC: https://github.com/Shadowsocks-NET/shadowsocks-specs
+    TCP request: [salt][eih][fixed header chunk][variable header chunk][length chunk][payload chunk]...
+    TCP response: [salt][fixed header chunk][variable header chunk][length chunk][payload chunk]...
+    fixed header: request [type][timestamp][length] response [type][timestamp][request salt][length]
+    variable header: request [socks addr][padding length][padding][payload] response [payload]
+    UDP: [separate header][eih][encrypted body][tag]
+    separate header: [session id][packet id] 用psk做AES-ECB加密, 后12字节作为body的nonce
+    body: request [type][timestamp][padding length][padding][socks addr][payload]
+    body: response [type][timestamp][client session id][padding length][padding][socks addr][payload]
+
+    password 是base64编码的psk, 多用户端口的格式为 "<iPSK>:<uPSK>",
+    这时候请求会带上EIH(identity header), 可以直接定位到用户
+    """
+
+    SUBKEY_CONTEXT = "shadowsocks 2022 session subkey"
+    IDENTITY_SUBKEY_CONTEXT = "shadowsocks 2022 identity subkey"
+    PACKET_LIMIT = 0xFFFF
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    EIH_SIZE = 16
+    TIMESTAMP_WINDOW = 30
+    MAX_PADDING_LENGTH = 900
+    HEADER_TYPE_REQUEST = 0
+    HEADER_TYPE_RESPONSE = 1
+    IDENTITY_HEADER = True
+    UDP_SESSION = True
+    UDP_HEADER_SIZE = 16
+
+    def __init__(self, password: str):
+        super().__init__(password)
+        self.identity_key = self.get_identity_key(password)
+        self._header_stage = 0  # NOTE 0 fixed header 1 variable header 2 stream
+        # udp session
+        self._client_session_id = None
+        self._client_udp_cipher = None
+        self._packet_id_filter = None
+        self._server_session_id = None
+        self._server_udp_cipher = None
+        self._server_packet_id = 0
+
+    @staticmethod
+    def _split_password(password: str):
+        ipsk, _, upsk = password.rpartition(":")
+        return ipsk, upsk
+
+    @classmethod
+    def _decode_psk(cls, psk: str) -> bytes:
+        key = base64.b64decode(psk)
+        if len(key) != cls.KEY_SIZE:
+            raise ValueError(f"psk length must be {cls.KEY_SIZE}")
+        return key
+
+    @classmethod
+    def derive_master_key(cls, password: str) -> bytes:
+        return cls._decode_psk(cls._split_password(password)[1])
+
+    @classmethod
+    def get_identity_key(cls, password: str):
+        ipsk = cls._split_password(password)[0]
+        return cls._decode_psk(ipsk) if ipsk else None
+
+    @classmethod
+    def identity_hash(cls, password: str) -> bytes:
+        return blake3(cls.get_master_key(password)).digest()[:16]
+
+    @classmethod
+    def identify(
+        cls, identity_key: bytes, first_data: bytes, ts_protocol=flag.TRANSPORT_TCP
+    ) -> bytes:
+        """从首包的EIH里解出用户的identity_hash"""
+        if ts_protocol == flag.TRANSPORT_UDP:
+            # NOTE udp的EIH直接用iPSK加密, 明文和separate header做了异或
+            header = aes_ecb_decrypt(identity_key, first_data[: cls.UDP_HEADER_SIZE])
+            eih = aes_ecb_decrypt(
+                identity_key,
+                first_data[cls.UDP_HEADER_SIZE : cls.UDP_HEADER_SIZE + cls.EIH_SIZE],
+            )
+            return bytes(a ^ b for a, b in zip(eih, header))
+        salt = bytes(first_data[: cls.SALT_SIZE])
+        eih = first_data[cls.SALT_SIZE : cls.SALT_SIZE + cls.EIH_SIZE]
+        subkey = blake3(
+            identity_key + salt, derive_key_context=cls.IDENTITY_SUBKEY_CONTEXT
+        ).digest(length=cls.KEY_SIZE)
+        return aes_ecb_decrypt(subkey, eih)
+
+    @classmethod
+    def tcp_first_data_len(cls):
+        return cls.SALT_SIZE + cls.EIH_SIZE + 11 + cls.TAG_SIZE
+
+    @classmethod
+    def derive_subkey(cls, key: bytes, salt: bytes) -> bytes:
+        return blake3(key + salt, derive_key_context=cls.SUBKEY_CONTEXT).digest(
+            length=cls.KEY_SIZE
+        )
+
+    @classmethod
+    def _identity_header_size(cls, password: str) -> int:
+        return cls.EIH_SIZE if cls._split_password(password)[0] else 0
+
+    @classmethod
+    def _first_length_chunk_size(cls):
+        return 11 + cls.TAG_SIZE
+
+    @classmethod
+    def probe(cls, password: str, first_data: bytes):
+        identity_key = cls.get_identity_key(password)
+        if identity_key and cls.identify(identity_key, first_data) != (
+            cls.identity_hash(password)
+        ):
+            return None
+        return super().probe(password, first_data)
+
+    def _check_timestamp(self, timestamp: int):
+        if abs(time.time() - timestamp) > self.TIMESTAMP_WINDOW:
+            raise RuntimeError(f"timestamp out of window {timestamp}")
+
+    def _length_chunk_size(self):
+        if self._header_stage == 0:
+            return 11 + self.TAG_SIZE
+        return 2 + self.TAG_SIZE
+
+    def _parse_length(self, header: bytes) -> int:
+        if self._header_stage != 0:
+            return super()._parse_length(header)
+        if header[0] != self.HEADER_TYPE_REQUEST:
+            raise RuntimeError(f"invalid header type {header[0]}")
+        self._check_timestamp(int.from_bytes(header[1:9], "big"))
+        self._header_stage = 1
+        return int.from_bytes(header[9:11], "big")
+
+    def _decrypt_payload(self, chunk) -> bytes:
+        if self._header_stage != 1:
+            return self._decrypt(chunk)
+        # NOTE 去掉padding, 只留下socks addr和payload给上层
+        header = self._decrypt(chunk)
+        _, _, _, header_length = parse_header(header)
+        if not header_length:
+            raise RuntimeError("invalid variable header")
+        padding_len = int.from_bytes(header[header_length : header_length + 2], "big")
+        if padding_len > self.MAX_PADDING_LENGTH:
+            raise RuntimeError(f"padding too long {padding_len}")
+        self._header_stage = 2
+        return header[:header_length] + header[header_length + 2 + padding_len :]
+
+    def decrypt(self, data: bytes) -> bytes:
+        if self._subkey is None:
+            self.salt, data = bytes(data[: self.SALT_SIZE]), data[self.SALT_SIZE :]
+            if self.identity_key:
+                eih, data = data[: self.EIH_SIZE], data[self.EIH_SIZE :]
+                if self.identify(self.identity_key, self.salt + eih) != (
+                    blake3(self.key).digest()[:16]
+                ):
+                    raise RuntimeError("identity header not match")
+            self._subkey = self._derive_subkey(self.salt)
+        return super().decrypt(data)
+
+    def encrypt_chunks(self, data: bytes) -> List[bytes]:
+        if self._subkey is not None:
+            return super().encrypt_chunks(data)
+        if self.request_salt is None:
+            raise RuntimeError("request salt is required for response")
+        self.salt = self._make_random_salt()
+        self._subkey = self._derive_subkey(self.salt)
+        with memoryview(data) as view:
+            first, rest = view[: self.PACKET_LIMIT], view[self.PACKET_LIMIT :]
+            header = b"".join(
+                [
+                    self.HEADER_TYPE_RESPONSE.to_bytes(1, "big"),
+                    int(time.time()).to_bytes(8, "big"),
+                    self.request_salt,
+                    len(first).to_bytes(2, "big"),
+                ]
+            )
+            ret = [self.salt, self._encrypt(header), self._encrypt(first)]
+            if rest:
+                ret.extend(super().encrypt_chunks(rest))
+        return ret
+
+    def unpack(self, data: bytes) -> bytes:
+        """解包udp, 同一个client session只派生一次subkey"""
+        header_key = self.identity_key or self.key
+        header = aes_ecb_decrypt(header_key, data[: self.UDP_HEADER_SIZE])
+        session_id, packet_id = header[:8], int.from_bytes(header[8:], "big")
+        pos = self.UDP_HEADER_SIZE + (self.EIH_SIZE if self.identity_key else 0)
+
+        if session_id == self._client_session_id:
+            udp_cipher, packet_id_filter = (
+                self._client_udp_cipher,
+                self._packet_id_filter,
+            )
+        else:
+            # NOTE 新session才需要校验EIH, 之后的包由session的AEAD保证
+            if (
+                self.identity_key
+                and self.identify(self.identity_key, data, flag.TRANSPORT_UDP)
+                != blake3(self.key).digest()[:16]
+            ):
+                raise RuntimeError("identity header not match")
+            udp_cipher = self.new_cipher(self._derive_subkey(session_id))
+            packet_id_filter = SlidingWindowFilter()
+        body = udp_cipher.decrypt(header[4:], memoryview(data)[pos:], None)
+        if not packet_id_filter.add(packet_id):
+            raise RuntimeError(f"repeated packet id {packet_id}")
+        # NOTE 解密成功之后才切换session, 伪造的包不会重置防重放窗口
+        self._client_session_id = session_id
+        self._client_udp_cipher = udp_cipher
+        self._packet_id_filter = packet_id_filter
+        if body[0] != self.HEADER_TYPE_REQUEST:
+            raise RuntimeError(f"invalid header type {body[0]}")
+        self._check_timestamp(int.from_bytes(body[1:9], "big"))
+        padding_len = int.from_bytes(body[9:11], "big")
+        if padding_len > self.MAX_PADDING_LENGTH:
+            raise RuntimeError(f"padding too long {padding_len}")
+        return body[11 + padding_len :]
+
+    def pack(self, data: bytes) -> bytes:
+        """压udp包, 响应的separate header用uPSK加密"""
+        if self._client_session_id is None:
+            raise RuntimeError("client session is required for response")
+        if self._server_session_id is None:
+            self._server_session_id = os.urandom(8)
+            self._server_udp_cipher = self.new_cipher(
+                self._derive_subkey(self._server_session_id)
+            )
+        header = self._server_session_id + self._server_packet_id.to_bytes(8, "big")
+        self._server_packet_id += 1
+        body = b"".join(
+            [
+                self.HEADER_TYPE_RESPONSE.to_bytes(1, "big"),
+                int(time.time()).to_bytes(8, "big"),
+                self._client_session_id,
+                b"\x00\x00",  # NOTE padding length
+                data,
+            ]
+        )
+        return aes_ecb_encrypt(self.key, header) + self._server_udp_cipher.encrypt(
+            header[4:], body, None
+        )
+
+
+class SS2022AES128GCM(BaseSS2022Cipher):
+    KEY_SIZE = 16
+    SALT_SIZE = 16
+
+    @staticmethod
+    def new_cipher(subkey: bytes):
+        return AESGCM(subkey)
+
+
+class SS2022AES256GCM(SS2022AES128GCM):
+    KEY_SIZE = 32
+    SALT_SIZE = 32
+
+
 # NOTE 目前提供所有AEAD的加密方式，流式加密只提供None（不加密）
 # 但是所有流式加密的方式都不推荐使用了，生产环境请一律使用AEAD加密
 SUPPORT_METHODS = {
@@ -220,4 +614,6 @@ SUPPORT_METHODS = {
     "aes-128-gcm": AES128GCM,
     "aes-256-gcm": AES256GCM,
     "chacha20-ietf-poly1305": CHACHA20IETFPOLY1305,
+    "2022-blake3-aes-128-gcm": SS2022AES128GCM,
+    "2022-blake3-aes-256-gcm": SS2022AES256GCM,
 }
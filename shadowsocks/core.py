@@ -5,8 +5,21 @@ import struct
 import time
 
 from shadowsocks import protocol_flag as flag
+from shadowsocks.buffers import ReceiveBuffer
 from shadowsocks.cipherman import CipherMan
-from shadowsocks.metrics import ACTIVE_CONNECTION_COUNT, CONNECTION_MADE_COUNT
+from shadowsocks.metrics import (
+    ACTIVE_CONNECTION_COUNT,
+    CONNECT_HANDSHAKE_TIMEOUT_COUNT,
+    CONNECTION_MADE_COUNT,
+    IDLE_TIMEOUT_COUNT,
+    INIT_HANDSHAKE_TIMEOUT_COUNT,
+    LIFETIME_TIMEOUT_COUNT,
+    LOCAL_BACKPRESSURE_PAUSE_COUNT,
+    LOCAL_CONNECT_BUFFER_PAUSE_COUNT,
+    LOOKUP_HANDSHAKE_TIMEOUT_COUNT,
+    REMOTE_BACKPRESSURE_PAUSE_COUNT,
+)
+from shadowsocks.timer import TimerEntry, TimerWheel
 from shadowsocks.utils import parse_header
 
 
@@ -14,6 +27,7 @@ class LocalHandler:
     """
     事件循环一共处理五个状态
 
+    STAGE_LOOKUP 找用户 试解密首包, 期间暂停读取
     STAGE_INIT  初始状态 socket5握手
     STAGE_CONNECT 连接建立阶段 从本地获取addr 进行dns解析
     STAGE_STREAM 建立管道(pipe) 进行socket5传输
@@ -24,9 +38,55 @@ class LocalHandler:
     STAGE_INIT = 0
     STAGE_CONNECT = 1
     STAGE_STREAM = 2
+    STAGE_LOOKUP = 3
     STAGE_DESTROY = -1
     STAGE_ERROR = 255
 
+    # NOTE 暂停读客户端的原因, 所有原因都解除了才恢复读取
+    PAUSE_LOOKUP = "lookup"
+    PAUSE_CONNECT_BUFFER = "connect_buffer"
+    PAUSE_BACKPRESSURE = "backpressure"
+
+    # NOTE 由App根据配置设置, 写缓冲超过high暂停读对端, 降到low以下恢复
+    write_buffer_limits = (64 * 1024, 16 * 1024)
+    # NOTE {port: (high, low)} 单独配置的端口
+    port_write_buffer_limits = {}
+    # NOTE 连上游之前最多先存这么多数据, 超过了暂停读客户端
+    connect_buffer_limit = 64 * 1024
+
+    # NOTE 由App根据配置开启, 所有tcp连接的超时都挂在这一个时间轮上
+    timer_wheel: TimerWheel = None
+    # NOTE 两边都没有读到数据超过这么多秒就关掉, 0表示不限制
+    idle_timeout = 0
+    # NOTE 连接最长存活的秒数, 0表示不限制
+    max_lifetime = 0
+    # NOTE 从建立连接到解出header并连上上游最多这么多秒, 0表示不限制
+    handshake_timeout = 0
+    HANDSHAKE_TIMEOUT_COUNTS = {
+        STAGE_INIT: INIT_HANDSHAKE_TIMEOUT_COUNT,
+        STAGE_LOOKUP: LOOKUP_HANDSHAKE_TIMEOUT_COUNT,
+        STAGE_CONNECT: CONNECT_HANDSHAKE_TIMEOUT_COUNT,
+    }
+    # NOTE {user_id: {LocalHandler: None}} 解出header之后的tcp连接, 按建立的顺序
+    _user_conns = {}
+
+    @classmethod
+    def get_write_buffer_limits(cls, port):
+        return cls.port_write_buffer_limits.get(port, cls.write_buffer_limits)
+
+    @classmethod
+    def evict_idle_conn(cls, access_user) -> bool:
+        """
+        关掉这个用户最久没有数据的连接, 用于CipherMan.conn_evictor
+
+        NOTE 没开时间轮的时候没有最后活跃时间, 关掉最早建立的
+        """
+        conns = cls._user_conns.get(access_user.user_id)
+        if not conns:
+            return False
+        min(conns, key=lambda h: h._last_active).close()
+        return True
+
     def __init__(self, port):
         super().__init__()
 
@@ -40,12 +100,22 @@ class LocalHandler:
         self._transport_protocol = None
         self._is_closing = False
         self._connect_buffer = bytearray()
+        self._lookup_task = None
+        self._read_paused_by = set()
+        self._write_paused = False
+        self._timer_wheel = None
+        self._timer = None
+        self._created_tick = 0
+        self._last_active = 0
 
     def close(self):
         self._stage = self.STAGE_DESTROY
         if self._is_closing:
             return
         self._is_closing = True
+        self._lookup_task and self._lookup_task.cancel()
+        self._timer and self._timer_wheel.cancel(self._timer)
+        self._untrack_user_conn()
 
         if self._transport_protocol == flag.TRANSPORT_TCP:
             ACTIVE_CONNECTION_COUNT.inc(-1)
@@ -58,15 +128,130 @@ class LocalHandler:
         if self._transport_protocol == flag.TRANSPORT_TCP:
             if self._transport.is_closing():
                 return
-            self._transport.write(data)
+            # NOTE list是加密后的chunk, 直接writelines, 不需要再拼接一次
+            if type(data) is list:
+                self._transport.writelines(data)
+            else:
+                self._transport.write(data)
         else:
             self._transport.sendto(data, self._peername)
 
+    def pause_reading(self, reason):
+        if reason in self._read_paused_by:
+            return
+        if not self._read_paused_by and not self._is_closing:
+            self._transport.pause_reading()
+        self._read_paused_by.add(reason)
+        if reason == self.PAUSE_BACKPRESSURE:
+            LOCAL_BACKPRESSURE_PAUSE_COUNT.inc()
+        elif reason == self.PAUSE_CONNECT_BUFFER:
+            LOCAL_CONNECT_BUFFER_PAUSE_COUNT.inc()
+
+    def resume_reading(self, reason):
+        if reason not in self._read_paused_by:
+            return
+        self._read_paused_by.discard(reason)
+        if not self._read_paused_by and not self._is_closing:
+            self._transport.resume_reading()
+
+    def handle_pause_writing(self):
+        # NOTE 客户端收不过来了, 暂停读上游
+        self._write_paused = True
+        self._remote and self._remote.pause_reading()
+
+    def handle_resume_writing(self):
+        self._write_paused = False
+        self._remote and self._remote.resume_reading()
+
+    def handle_remote_connected(self, remote):
+        """上游连上之后先把连接期间收到的数据发出去, 之后的数据直接转发"""
+        if self._is_closing:
+            remote.close()
+            return
+        self._remote = remote
+        # NOTE 换一个新的bytearray, 发出去的这块不会再被修改
+        data, self._connect_buffer = self._connect_buffer, bytearray()
+        data and remote.write(data)
+        if self._stage == self.STAGE_CONNECT:
+            self._stage = self.STAGE_STREAM
+        if self._write_paused:
+            remote.pause_reading()
+        self.resume_reading(self.PAUSE_CONNECT_BUFFER)
+
+    def _track_user_conn(self):
+        user_id = self.cipher.access_user.user_id
+        self._user_conns.setdefault(user_id, {})[self] = None
+
+    def _untrack_user_conn(self):
+        access_user = self.cipher and self.cipher.access_user
+        if not access_user:
+            return
+        conns = self._user_conns.get(access_user.user_id)
+        if conns is None:
+            return
+        conns.pop(self, None)
+        if not conns:
+            del self._user_conns[access_user.user_id]
+
+    def touch(self):
+        """两边读到数据的时候调用, 只记一下时间, 不动时间轮"""
+        if self._timer_wheel is not None:
+            self._last_active = self._timer_wheel.now
+
+    def _next_deadline(self):
+        """返回最早的超时tick和原因, 没有超时限制返回(None, None)"""
+        wheel = self._timer_wheel
+        deadline, reason = None, None
+        if self.idle_timeout:
+            deadline = self._last_active + wheel.ticks(self.idle_timeout)
+            reason = IDLE_TIMEOUT_COUNT
+        if self.max_lifetime:
+            lifetime_deadline = self._created_tick + wheel.ticks(self.max_lifetime)
+            if deadline is None or lifetime_deadline < deadline:
+                deadline, reason = lifetime_deadline, LIFETIME_TIMEOUT_COUNT
+        # NOTE 握手完成之后就不再算握手的deadline, 不用专门去cancel
+        if self.handshake_timeout and self._stage in self.HANDSHAKE_TIMEOUT_COUNTS:
+            handshake_deadline = self._created_tick + wheel.ticks(
+                self.handshake_timeout
+            )
+            if deadline is None or handshake_deadline < deadline:
+                deadline = handshake_deadline
+                reason = self.HANDSHAKE_TIMEOUT_COUNTS[self._stage]
+        return deadline, reason
+
+    def _start_timer(self):
+        wheel = self._timer_wheel = self.timer_wheel
+        if wheel is None:
+            return
+        self._created_tick = self._last_active = wheel.now
+        deadline, _ = self._next_deadline()
+        if deadline is not None:
+            self._timer = TimerEntry(self._handle_timer)
+            wheel.schedule(self._timer, deadline)
+
+    def _handle_timer(self):
+        if self._is_closing:
+            return
+        deadline, reason = self._next_deadline()
+        if deadline is None:
+            return
+        # NOTE 期间有数据的话按最后活跃的时间重新schedule
+        if deadline > self._timer_wheel.now:
+            self._timer_wheel.schedule(self._timer, deadline)
+            return
+        reason.inc()
+        logging.debug(
+            f"connection timeout peer={self._peername} port={self.port} stage={self._stage}"
+        )
+        self.close()
+
     def handle_connection_made(self, transport, peername, protocol):
         self._stage = self.STAGE_INIT
         self._transport = transport
         self._peername = peername
         self._transport_protocol = protocol
+        if protocol == flag.TRANSPORT_TCP:
+            self._start_timer()
 
     def handle_eof_received(self):
         self.close()
@@ -75,25 +260,55 @@ class LocalHandler:
         self.close()
 
     def handle_data_received(self, data):
-        if not self.cipher or self._transport_protocol == flag.TRANSPORT_UDP:
+        """tcp的data是ReceiveBuffer里的memoryview, 只在这次调用里有效"""
+        if not self.cipher or (
+            self._transport_protocol == flag.TRANSPORT_UDP
+            and not self.cipher.udp_session
+        ):
             self.cipher = CipherMan.get_cipher_by_port(
                 self.port, self._transport_protocol, self._peername
             )
 
+        if self._stage == self.STAGE_LOOKUP:
+            # NOTE 暂停读取之前已经收到的数据先存起来, 找到用户之后一起解密
+            self.cipher.feed(data)
+            return
+        if self.cipher.needs_lookup:
+            self._stage = self.STAGE_LOOKUP
+            self.pause_reading(self.PAUSE_LOOKUP)
+            # NOTE 找用户要跨过await, 先从接收buffer里拷贝出来
+            self._lookup_task = asyncio.create_task(self._handle_lookup(bytes(data)))
+            return
+
+        self.cipher.decrypt_then(
+            data, self._handle_plain_data, self._handle_decrypt_error
+        )
+
+    async def _handle_lookup(self, data):
         try:
-            data = self.cipher.decrypt(data)
+            data = await self.cipher.decrypt_async(data)
         except Exception as e:
-            logging.warning(
-                f"decrypt data error:{e} remote:{self._peername},type:{self._transport_protocol}"
-            )
-            self.close()
+            self._handle_decrypt_error(e)
             return
+        finally:
+            self._lookup_task = None
+            if self._stage == self.STAGE_LOOKUP:
+                self._stage = self.STAGE_INIT
+                self.resume_reading(self.PAUSE_LOOKUP)
+        self._handle_plain_data(data)
+
+    def _handle_decrypt_error(self, e):
+        logging.warning(
+            f"decrypt data error:{e} remote:{self._peername},type:{self._transport_protocol}"
+        )
+        self.close()
 
+    def _handle_plain_data(self, data):
         if not data:
             return
 
         if self._stage == self.STAGE_INIT:
-            asyncio.create_task(self._handle_stage_init(data))
+            self._handle_stage_init(data)
         elif self._stage == self.STAGE_CONNECT:
             self._handle_stage_connect(data)
         elif self._stage == self.STAGE_STREAM:
@@ -106,7 +321,7 @@ class LocalHandler:
             logging.warning(f"unknown stage:{self._stage}")
             self.close()
 
-    async def _handle_stage_init(self, data):
+    def _handle_stage_init(self, data):
         atype, dst_addr, dst_port, header_length = parse_header(data)
         if not all([atype, dst_addr, dst_port, header_length]):
             logging.warning(
@@ -126,47 +341,51 @@ class LocalHandler:
             )
             payload = data[header_length:]
 
-        loop = asyncio.get_running_loop()
         if self._transport_protocol == flag.TRANSPORT_TCP:
+            self._track_user_conn()
+            # NOTE 在这里同步切到STAGE_CONNECT, 连上游期间后面的数据按顺序进_connect_buffer
             self._stage = self.STAGE_CONNECT
             self._handle_stage_connect(payload)
-            try:
-                task = loop.create_connection(
-                    lambda: RemoteTCP(self), dst_addr, dst_port
-                )
-                _, remote_tcp = await asyncio.wait_for(task, 5)
-            except Exception as e:
-                self._stage = self.STAGE_ERROR
-                self.close()
-                logging.warning(
-                    f"connection_failed, {type(e)} e: {dst_addr}:{dst_port}"
-                )
-            else:
-                self._remote = remote_tcp
+            asyncio.create_task(self._connect_remote_tcp(dst_addr, dst_port))
         else:
-            try:
-                task = loop.create_datagram_endpoint(
-                    lambda: RemoteUDP(dst_addr, dst_port, payload, self),
-                    remote_addr=(dst_addr, dst_port),
-                )
-                _, remote_udp = await asyncio.wait_for(task, 5)
-            except Exception as e:
-                self._stage = self.STAGE_ERROR
-                logging.warning(
-                    f"connection_failed, {type(e)} e: {dst_addr}:{dst_port}"
-                )
-                self.close()
-            else:
-                self._remote = remote_udp
-                self._stage = self.STAGE_STREAM
+            asyncio.create_task(self._connect_remote_udp(dst_addr, dst_port, payload))
+
+    async def _connect_remote_tcp(self, dst_addr, dst_port):
+        loop = asyncio.get_running_loop()
+        try:
+            task = loop.create_connection(lambda: RemoteTCP(self), dst_addr, dst_port)
+            # NOTE RemoteTCP在connection_made里通过handle_remote_connected接上
+            await asyncio.wait_for(task, 5)
+        except Exception as e:
+            self._stage = self.STAGE_ERROR
+            self.close()
+            logging.warning(f"connection_failed, {type(e)} e: {dst_addr}:{dst_port}")
+
+    async def _connect_remote_udp(self, dst_addr, dst_port, payload):
+        loop = asyncio.get_running_loop()
+        try:
+            task = loop.create_datagram_endpoint(
+                lambda: RemoteUDP(dst_addr, dst_port, payload, self),
+                remote_addr=(dst_addr, dst_port),
+            )
+            _, remote_udp = await asyncio.wait_for(task, 5)
+        except Exception as e:
+            self._stage = self.STAGE_ERROR
+            logging.warning(f"connection_failed, {type(e)} e: {dst_addr}:{dst_port}")
+            self.close()
+        else:
+            self._remote = remote_udp
+            self._stage = self.STAGE_STREAM
 
     def _handle_stage_connect(self, data):
         # 在握手之后，会耗费一定时间来来和remote建立连接,但是ss-client并不会等这个时间
-        if not self._remote or self._remote.ready == False:
-            self._connect_buffer.extend(data)
-        else:
+        if self._remote:
             self._stage = self.STAGE_STREAM
             self._handle_stage_stream(data)
+            return
+        self._connect_buffer.extend(data)
+        if len(self._connect_buffer) > self.connect_buffer_limit:
+            self.pause_reading(self.PAUSE_CONNECT_BUFFER)
 
     def _handle_stage_stream(self, data):
         if self._transport_protocol == flag.TRANSPORT_UDP:
@@ -176,7 +395,7 @@ class LocalHandler:
         self._remote.write(data)
 
 
-class LocalTCP(asyncio.Protocol):
+class LocalTCP(asyncio.BufferedProtocol):
     """
     Local Tcp Factory
     """
@@ -184,6 +403,7 @@ class LocalTCP(asyncio.Protocol):
     def __init__(self, port):
         self.port = port
         self._handler = None
+        self._recv_buffer = None
 
     def _init_handler(self):
         self._handler = LocalHandler(self.port)
@@ -194,45 +414,55 @@ class LocalTCP(asyncio.Protocol):
         return local
 
     def pause_writing(self):
-        # NOTE remote may not init
-        try:
-            self._handler._remote._transport.pause_reading()
-        except AttributeError:
-            pass
+        self._handler.handle_pause_writing()
 
     def resume_writing(self):
-        self._handler._remote._transport.resume_reading()
+        self._handler.handle_resume_writing()
 
     def connection_made(self, transport):
         self._transport = transport
+        transport.set_write_buffer_limits(
+            *LocalHandler.get_write_buffer_limits(self.port)
+        )
+        self._recv_buffer = ReceiveBuffer()
         peername = self._transport.get_extra_info("peername")
         self._handler.handle_connection_made(transport, peername, flag.TRANSPORT_TCP)
         CONNECTION_MADE_COUNT.inc()
         ACTIVE_CONNECTION_COUNT.inc()
 
-    def data_received(self, data):
-        self._handler.handle_data_received(data)
+    def get_buffer(self, sizehint):
+        return self._recv_buffer.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self._handler.touch()
+        self._handler.handle_data_received(self._recv_buffer.updated(nbytes))
 
     def eof_received(self):
         self._handler.handle_eof_received()
 
     def connection_lost(self, exc):
+        self._recv_buffer and self._recv_buffer.release()
+        self._recv_buffer = None
         self._handler.handle_connection_lost(exc)
 
 
-class RemoteTCP(asyncio.Protocol):
+class RemoteTCP(asyncio.BufferedProtocol):
     def __init__(self, local_handler):
         super().__init__()
 
         self.local = local_handler
         self.peername = None
         self._transport = None
-        self.ready = False
+        self._recv_buffer = None
 
         self._is_closing = False
 
     def write(self, data):
-        if not self._transport.is_closing():
+        if self._transport.is_closing():
+            return
+        if type(data) is list:
+            self._transport.writelines(data)
+        else:
             self._transport.write(data)
 
     def close(self):
@@ -246,28 +476,57 @@ class RemoteTCP(asyncio.Protocol):
 
     def connection_made(self, transport: asyncio.Transport):
         self._transport = transport
+        transport.set_write_buffer_limits(
+            *LocalHandler.get_write_buffer_limits(self.local.port)
+        )
+        self._recv_buffer = ReceiveBuffer()
         self.peername = self._transport.get_extra_info("peername")
         self.cipher = CipherMan(
-            access_user=self.local.cipher.access_user, peername=self.peername
+            access_user=self.local.cipher.access_user,
+            peername=self.peername,
+            request_salt=self.local.cipher.salt,
         )
-        transport.write(self.local._connect_buffer)
-        self.ready = True
         CONNECTION_MADE_COUNT.inc()
         ACTIVE_CONNECTION_COUNT.inc()
+        self.local.handle_remote_connected(self)
+
+    def get_buffer(self, sizehint):
+        return self._recv_buffer.get_buffer()
 
-    def data_received(self, data):
-        self.local.write(self.cipher.encrypt(data))
+    def buffer_updated(self, nbytes):
+        self.local.touch()
+        self.cipher.encrypt_chunks_then(
+            self._recv_buffer.updated(nbytes),
+            self.local.write,
+            self._handle_encrypt_error,
+        )
+
+    def _handle_encrypt_error(self, e):
+        logging.warning(f"encrypt data error:{e} remote:{self.peername}")
+        self.close()
 
     def pause_reading(self):
-        self.local._transport.pause_reading()
+        if self._is_closing:
+            return
+        self._transport.pause_reading()
+        REMOTE_BACKPRESSURE_PAUSE_COUNT.inc()
 
     def resume_reading(self):
-        self.local._transport.resume_reading()
+        self._is_closing or self._transport.resume_reading()
+
+    def pause_writing(self):
+        # NOTE 上游收不过来了, 暂停读客户端
+        self.local.pause_reading(self.local.PAUSE_BACKPRESSURE)
+
+    def resume_writing(self):
+        self.local.resume_reading(self.local.PAUSE_BACKPRESSURE)
 
     def eof_received(self):
         self.close()
 
     def connection_lost(self, exc):
+        self._recv_buffer and self._recv_buffer.release()
+        self._recv_buffer = None
         self.close()
 
 
@@ -330,8 +589,11 @@ class RemoteUDP(asyncio.DatagramProtocol):
         self.local = local_hander
         self.peername = None
         self._transport = None
+        local_cipher = self.local.cipher
         self.cipher = CipherMan(
-            access_user=self.local.cipher.access_user, ts_protocol=flag.TRANSPORT_UDP
+            access_user=local_cipher.access_user,
+            ts_protocol=flag.TRANSPORT_UDP,
+            cipher=local_cipher.cipher if local_cipher.udp_session else None,
         )
         self._is_closing = False
 
@@ -1,9 +1,8 @@
-import json
-from typing import Set
-
 import peewee as pw
 from playhouse import shortcuts
 
+from shadowsocks.utils import IPTracker
+
 db = pw.SqliteDatabase(":memory:")
 
 
@@ -39,17 +38,15 @@ class BaseModel(pw.Model):
         return shortcuts.model_to_dict(self, **kw)
 
 
-class IPSetField(pw.CharField):
-    def db_value(self, value) -> str:
-        if type(value) is not set:
-            value = []
-        data = json.dumps(list(value))
-        if len(data) > self.max_length:
-            raise ValueError("Data too long for field {}.".format(self.name))
-        return data
+class IPTrackerField(pw.BlobField):
+    """ip按打包之后的二进制存, 数量有上限, 不会再因为ip太多写不进去"""
+
+    def db_value(self, value) -> bytes:
+        if not isinstance(value, IPTracker):
+            value = IPTracker(value or ())
+        return super().db_value(value.to_bytes())
 
-    def python_value(self, value) -> Set[str]:
+    def python_value(self, value) -> IPTracker:
         if value is None:
             return value
-        l = json.loads(value)
-        return set(l)
+        return IPTracker.from_bytes(value)
@@ -1,38 +1,87 @@
 from __future__ import annotations
 
+import asyncio
+import itertools
 import logging
+import threading
 import time
-from typing import List
+from typing import List, Optional, Tuple
 
 import peewee as pw
 from cryptography.exceptions import InvalidTag
 
 from shadowsocks import protocol_flag as flag
-from shadowsocks.ciphers import SUPPORT_METHODS
-from shadowsocks.mdb import BaseModel, IPSetField, db
-from shadowsocks.metrics import FIND_ACCESS_USER_TIME
+from shadowsocks.ciphers import SUPPORT_METHODS, BaseCipher, invalidate_master_keys
+from shadowsocks.mdb import BaseModel, IPTrackerField, db
+from shadowsocks.mdb.registry import UserRecord, UserRegistry
+from shadowsocks.metrics import (
+    FIND_ACCESS_USER_TIME,
+    TRIAL_DECRYPTION_SAVED_COUNT,
+    USER_AFFINITY_CACHE_HIT_COUNT,
+    USER_AFFINITY_CACHE_MISS_COUNT,
+)
+from shadowsocks.utils import IPTracker, TTLCache
+
+
+class SyncReport:
+    """一次用户同步里新建/更新/删除的user_id"""
+
+    __slots__ = ("created", "updated", "deleted")
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.deleted = []
+
+    def __str__(self):
+        return "created_user_cnt={} updated_user_cnt={} deleted_user_cnt={}".format(
+            len(self.created), len(self.updated), len(self.deleted)
+        )
 
 
 class User(BaseModel):
 
     __attr_protected__ = {"user_id"}
-    __attr_accessible__ = {"port", "method", "password", "enable", "speed_limit"}
+    __attr_accessible__ = {
+        "port",
+        "method",
+        "password",
+        "enable",
+        "speed_limit",
+        "tcp_conn_limit",
+    }
 
     user_id = pw.IntegerField(primary_key=True, unique=True)
     port = pw.IntegerField(index=True)
     method = pw.CharField()
     password = pw.CharField(unique=True)
     enable = pw.BooleanField(default=True)
-    access_order = pw.BigIntegerField(
-        index=True, default=0
-    )  # NOTE find_access_user order
+    # NOTE 单个用户的tcp连接数上限, 为空的时候用节点的SS_TCP_CONN_LIMIT, 0表示不限制
+    tcp_conn_limit = pw.IntegerField(null=True)
+    # NOTE 已经不再写入, 查找顺序见UserRegistry, 保留字段是为了兼容表结构和proto
+    access_order = pw.BigIntegerField(index=True, default=0)
     need_sync = pw.BooleanField(default=False, index=True)
     # metrics field
-    ip_list = IPSetField(default=set())
+    ip_list = IPTrackerField(default=IPTracker)
     tcp_conn_num = pw.IntegerField(default=0)
     upload_traffic = pw.BigIntegerField(default=0)
     download_traffic = pw.BigIntegerField(default=0)
 
+    # NOTE 建立连接的时候只读registry, 同步用户的时候和数据库一起更新
+    registry = UserRegistry()
+    # NOTE {port: (identity_key, {identity_hash: UserRecord})} 2022多用户端口通过EIH直接找到用户
+    _identity_index = {}
+    # NOTE {(port, ip): (user_id, scan_cnt)} 同一个ip短时间内重连的大概率还是同一个用户
+    # scan_cnt是当时扫描试解密的次数, 用来估算命中缓存省掉的试解密次数
+    _affinity_cache = TTLCache(max_size=10000, ttl=600)
+    # NOTE 同步用户时对比和写入的字段, 顺序和UserRegistry.upsert的参数一致
+    # tcp_conn_limit是可选的, 放在最后
+    SYNC_FIELDS = ("user_id", "port", "method", "password", "enable", "tcp_conn_limit")
+    # NOTE 不用线程池找用户的时候, 每试解密这么多个用户就让出一次事件循环
+    LOOKUP_BATCH_SIZE = 64
+    # NOTE 全量同步的时候每次写入这么多个用户, 用户列表可以是流式解析出来的迭代器
+    SYNC_BATCH_SIZE = 1000
+
     def __str__(self):
         return f"<User{self.user_id}>"
 
@@ -44,58 +93,179 @@ class User(BaseModel):
             user.update_from_dict(data)
             user.save()
         logging.debug(f"正在创建/更新用户:{user}的数据")
+        cls.registry.upsert(*(getattr(user, f) for f in cls.SYNC_FIELDS))
+        cls._identity_index.clear()
+        cls._invalidate_affinity([user_id])
         return user
 
     @classmethod
     def list_by_port(cls, port):
-        return cls.select().where(cls.port == port).order_by(cls.access_order.desc())
+        return cls.select().where(cls.port == port)
+
+    @classmethod
+    def create_or_update_by_user_data_list(cls, user_data_list) -> SyncReport:
+        """
+        全量同步: 按SYNC_BATCH_SIZE分批INSERT ... ON CONFLICT更新,
+        不在列表里的用户通过临时表批量删除
+
+        NOTE registry和数据库是一起更新的, 直接和registry对比, 不用查一遍全表
+        """
+        try:
+            return cls._sync_all_users(user_data_list)
+        except Exception:
+            # NOTE 数据库已经回滚了, 前面几批写进registry的用户要恢复回去
+            cls._restore_registry()
+            raise
 
     @classmethod
     @db.atomic("EXCLUSIVE")
-    def create_or_update_by_user_data_list(cls, user_data_list):
+    def _sync_all_users(cls, user_data_list) -> SyncReport:
         if not cls.select().first():
-            # bulk create
-            users = [
-                cls(
-                    user_id=u["user_id"],
-                    enable=u["enable"],
-                    method=u["method"],
-                    password=u["password"],
-                    port=u["port"],
-                )
-                for u in user_data_list
-            ]
-            cls.bulk_create(users, batch_size=500)
-        else:
-            db_user_dict = {
-                u.user_id: u
-                for u in cls.select(
-                    cls.user_id, cls.enable, cls.method, cls.password, cls.port
-                )
-            }
-            enable_user_ids = []
-            need_update_or_create_users = []
-            for user_data in user_data_list:
-                user_id = user_data["user_id"]
-                enable_user_ids.append(user_id)
-                db_user = db_user_dict.get(user_id)
+            cls._affinity_cache.clear()
+            cls.registry.clear()
+
+        report, stale_passwords = SyncReport(), []
+        cls._reset_sync_user_ids()
+        user_data_iter = iter(user_data_list)
+        while True:
+            batch = list(itertools.islice(user_data_iter, cls.SYNC_BATCH_SIZE))
+            if not batch:
+                break
+            cls._add_sync_user_ids(
+                cls._upsert_user_data(batch, report, stale_passwords)
+            )
+        deleted_user_ids = [
+            user_id
+            for (user_id,) in db.execute_sql(
+                'SELECT user_id FROM "{}" WHERE user_id NOT IN '
+                "(SELECT user_id FROM sync_user_ids)".format(cls._meta.table_name)
+            )
+        ]
+        cls._delete_by_sync_user_ids(keep=True)
+        deleted_users = [
+            u for u in map(cls.registry.remove, deleted_user_ids) if u is not None
+        ]
+        return cls._finish_sync(report, deleted_users, stale_passwords)
+
+    @classmethod
+    def _restore_registry(cls):
+        """按数据库里的用户重建registry, 已有用户的顺序和没flush的metrics不变"""
+        user_ids = set()
+        for row in cls.select(*(getattr(cls, f) for f in cls.SYNC_FIELDS)).tuples():
+            cls.registry.upsert(*row)
+            user_ids.add(row[0])
+        for user in cls.registry:
+            if user.user_id not in user_ids:
+                cls.registry.remove(user.user_id)
+        cls._identity_index.clear()
+        cls._affinity_cache.clear()
+
+    @classmethod
+    @db.atomic("EXCLUSIVE")
+    def apply_user_delta(cls, changed_user_data_list, deleted_user_ids) -> SyncReport:
+        """增量同步: 只更新变化了的用户, 删除指定的用户"""
+        report, stale_passwords = SyncReport(), []
+        cls._upsert_user_data(changed_user_data_list, report, stale_passwords)
+        deleted_user_ids = set(deleted_user_ids)
+        cls._reset_sync_user_ids()
+        cls._add_sync_user_ids(deleted_user_ids)
+        cls._delete_by_sync_user_ids(keep=False)
+        deleted_users = [
+            u for u in map(cls.registry.remove, deleted_user_ids) if u is not None
+        ]
+        return cls._finish_sync(report, deleted_users, stale_passwords)
+
+    @classmethod
+    def _upsert_user_data(cls, user_data_list, report, stale_passwords) -> set:
+        """写入新建和配置变化了的用户, 返回所有同步过来的user_id"""
+        rows, sync_user_ids = [], set()
+        for user_data in user_data_list:
+            user_id = user_data["user_id"]
+            sync_user_ids.add(user_id)
+            row = tuple(user_data[f] for f in cls.SYNC_FIELDS[:-1]) + (
+                user_data.get("tcp_conn_limit"),
+            )
+            user = cls.registry.get(user_id)
+            if not user:
+                report.created.append(user_id)
+            elif row != tuple(getattr(user, f) for f in cls.SYNC_FIELDS):
                 # 找到配置变化了的用户
-                if (
-                    not db_user
-                    or db_user.port != user_data["port"]
-                    or db_user.enable != user_data["enable"]
-                    or db_user.method != user_data["method"]
-                    or db_user.password != user_data["password"]
+                report.updated.append(user_id)
+                if (user.password, user.method) != (
+                    user_data["password"],
+                    user_data["method"],
                 ):
-                    need_update_or_create_users.append(user_data)
-            for user_data in need_update_or_create_users:
-                cls._create_or_update_user_from_data(user_data)
-            sync_msg = "sync users: enable_user_cnt={} updated_user_cnt={} deleted_user_cnt={}".format(
-                len(enable_user_ids),
-                len(need_update_or_create_users),
-                cls.delete().where(cls.user_id.not_in(enable_user_ids)).execute(),
+                    stale_passwords.append(user.password)
+            else:
+                continue
+            rows.append(row)
+
+        cls._bulk_upsert(rows)
+        for row in rows:
+            cls.registry.upsert(*row)
+        return sync_user_ids
+
+    @classmethod
+    def _finish_sync(cls, report, deleted_users, stale_passwords) -> SyncReport:
+        report.deleted.extend(u.user_id for u in deleted_users)
+        stale_passwords.extend(u.password for u in deleted_users)
+        cls._identity_index.clear()
+        cls._invalidate_affinity(report.updated + report.deleted)
+        invalidate_master_keys(stale_passwords)
+        logging.info(f"sync users: user_cnt={len(cls.registry)} {report}")
+        return report
+
+    @classmethod
+    def _bulk_upsert(cls, rows):
+        """
+        INSERT ... ON CONFLICT DO UPDATE, 只更新SYNC_FIELDS, metrics字段保持不变
+
+        NOTE 用户多的时候peewee拼sql比执行还慢, 这里直接executemany
+        """
+        extra_fields = [
+            f for f in cls._meta.sorted_fields if f.name not in cls.SYNC_FIELDS
+        ]
+        defaults = tuple(
+            f.db_value(f.default() if callable(f.default) else f.default)
+            for f in extra_fields
+        )
+        columns = [*cls.SYNC_FIELDS, *(f.column_name for f in extra_fields)]
+        sql = 'INSERT INTO "{}" ({}) VALUES ({}) ON CONFLICT (user_id) DO UPDATE SET {}'.format(
+            cls._meta.table_name,
+            ", ".join(f'"{c}"' for c in columns),
+            ", ".join("?" * len(columns)),
+            ", ".join(f'"{c}" = excluded."{c}"' for c in cls.SYNC_FIELDS[1:]),
+        )
+        db.cursor().executemany(sql, (row + defaults for row in rows))
+
+    @classmethod
+    def _reset_sync_user_ids(cls):
+        """
+        要保留或者删除的user_id放在临时表里
+
+        NOTE 用户多的时候IN (?, ?, ...)会超出sqlite的参数上限
+        """
+        db.execute_sql(
+            "CREATE TEMP TABLE IF NOT EXISTS sync_user_ids (user_id INTEGER PRIMARY KEY)"
+        )
+        db.execute_sql("DELETE FROM sync_user_ids")
+
+    @classmethod
+    def _add_sync_user_ids(cls, user_ids):
+        db.cursor().executemany(
+            "INSERT OR IGNORE INTO sync_user_ids (user_id) VALUES (?)",
+            ((i,) for i in user_ids),
+        )
+
+    @classmethod
+    def _delete_by_sync_user_ids(cls, keep) -> int:
+        """keep为True时删掉不在临时表里的用户, 否则删掉在临时表里的用户"""
+        cursor = db.execute_sql(
+            'DELETE FROM "{}" WHERE user_id {} (SELECT user_id FROM sync_user_ids)'.format(
+                cls._meta.table_name, "NOT IN" if keep else "IN"
             )
-            logging.info(sync_msg)
+        )
+        return cursor.rowcount
 
     @classmethod
     @db.atomic("EXCLUSIVE")
@@ -110,59 +280,337 @@ class User(BaseModel):
         return list(User.select(*fields).where(User.need_sync == True))
 
     @classmethod
-    def reset_need_sync_user_traffic(cls):
-        empyt_set = set()
-        User.update(
-            ip_list=empyt_set, upload_traffic=0, download_traffic=0, need_sync=False
-        ).where(User.need_sync == True).execute()
+    def flush_metrics(cls) -> int:
+        """
+        把registry里累计的流量/ip/连接数在一个事务里合并进数据库, 返回更新的用户数
+
+        NOTE 事务提交之后才从registry里减掉写进去的量, 写失败了留到下次再合并
+        """
+        users = [u for u in cls.registry if u.need_flush]
+        flushed = [
+            (u, u.upload_traffic, u.download_traffic, u.tcp_conn_num) for u in users
+        ]
+        cnt = cls._write_metrics(users)
+        for user, upload, download, tcp_conn_num in flushed:
+            user.upload_traffic -= upload
+            user.download_traffic -= download
+            user.flushed_tcp_conn_num = tcp_conn_num
+            # NOTE 和写数据库在同一个线程里同步执行, 中间不会有新的ip
+            user.ip_list.clear()
+        return cnt
 
     @classmethod
-    @FIND_ACCESS_USER_TIME.time()
-    def find_access_user(cls, port, method, ts_protocol, first_data) -> User:
-        cipher_cls = SUPPORT_METHODS[method]
-        access_user = None
+    @db.atomic("EXCLUSIVE")
+    def _write_metrics(cls, users) -> int:
+        ip_user_ids = [u.user_id for u in users if u.ip_list]
+        db_ip_lists = {}
+        for batch in pw.chunked(ip_user_ids, 500):
+            db_ip_lists.update(
+                cls.select(cls.user_id, cls.ip_list)
+                .where(cls.user_id.in_(batch))
+                .tuples()
+            )
         cnt = 0
-        t1 = time.time()
-        for user in cls.list_by_port(port).iterator():
-            cnt += 1
-            try:
-                cipher = cipher_cls(user.password)
-                if ts_protocol == flag.TRANSPORT_TCP:
-                    cipher.decrypt(first_data)
-                else:
-                    cipher.unpack(first_data)
-                access_user = user
+        for user in users:
+            fields = {
+                "download_traffic": cls.download_traffic + user.download_traffic,
+                "upload_traffic": cls.upload_traffic + user.upload_traffic,
+                "tcp_conn_num": user.tcp_conn_num,
+                "need_sync": True,
+            }
+            if user.ip_list:
+                ip_list = db_ip_lists.get(user.user_id) or IPTracker()
+                ip_list.merge(user.ip_list)
+                fields["ip_list"] = ip_list
+            cnt += cls.update(**fields).where(cls.user_id == user.user_id).execute()
+        return cnt
+
+    @classmethod
+    @db.atomic("EXCLUSIVE")
+    def reset_need_sync_user_traffic(cls, reported_users: List[User]):
+        """
+        上报成功之后只减掉已经报上去的量
+
+        NOTE 上报期间flush_metrics_cron可能又合并进来新的流量, 留到下次上报
+        """
+        for reported in reported_users:
+            user = cls.get_or_none(cls.user_id == reported.user_id)
+            if user is None:
+                continue
+            ip_list = user.ip_list
+            ip_list.difference_update(reported.ip_list)
+            upload = user.upload_traffic - reported.upload_traffic
+            download = user.download_traffic - reported.download_traffic
+            cls.update(
+                ip_list=ip_list,
+                upload_traffic=upload,
+                download_traffic=download,
+                need_sync=bool(upload or download or ip_list),
+            ).where(cls.user_id == user.user_id).execute()
+
+    @classmethod
+    def _invalidate_affinity(cls, user_ids):
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        for key, (user_id, _) in cls._affinity_cache.items():
+            if user_id in user_ids:
+                cls._affinity_cache.pop(key)
+
+    def delete_instance(self, *args, **kwargs):
+        User.registry.remove(self.user_id)
+        User._identity_index.pop(self.port, None)
+        User._invalidate_affinity([self.user_id])
+        return super().delete_instance(*args, **kwargs)
+
+    @classmethod
+    def _get_identity_index(cls, port, cipher_cls):
+        index = cls._identity_index.get(port)
+        if index is None:
+            identity_key, identity_hashes = None, {}
+            for user in cls.registry.list_by_port(port):
+                try:
+                    identity_key = identity_key or cipher_cls.get_identity_key(
+                        user.password
+                    )
+                    identity_hashes[cipher_cls.identity_hash(user.password)] = user
+                except ValueError as e:
+                    logging.warning(f"invalid 2022 password user={user} e={e}")
+            index = cls._identity_index[port] = (identity_key, identity_hashes)
+        return index
+
+    @classmethod
+    def _list_by_identity(
+        cls, port, cipher_cls, ts_protocol, first_data
+    ) -> List[UserRecord]:
+        identity_key, identity_hashes = cls._get_identity_index(port, cipher_cls)
+        if not identity_key:
+            return []
+        user = identity_hashes.get(
+            cipher_cls.identify(identity_key, first_data, ts_protocol)
+        )
+        return [user] if user else []
+
+    @staticmethod
+    def _try_decrypt(cipher_cls, password, ts_protocol, first_data):
+        """试解密成功返回cipher, 失败返回None"""
+        if ts_protocol == flag.TRANSPORT_TCP and cipher_cls.AEAD_CIPHER:
+            return cipher_cls.probe(password, first_data)
+        try:
+            cipher = cipher_cls(password)
+            if ts_protocol == flag.TRANSPORT_TCP:
+                cipher.decrypt(first_data)
+            else:
+                cipher.unpack(first_data)
+            return cipher
+        except InvalidTag:
+            return None
+
+    @classmethod
+    def _find_by_affinity(cls, affinity_key, cipher_cls, ts_protocol, first_data):
+        """先试一下这个ip上次认证成功的用户, 返回(user, cipher, 试过的user_id)"""
+        cached = cls._affinity_cache.get(affinity_key)
+        if not cached:
+            USER_AFFINITY_CACHE_MISS_COUNT.inc()
+            return None, None, None
+        user_id, scan_cnt = cached
+        user = cls.registry.get(user_id)
+        if user and user.port != affinity_key[0]:
+            user = None
+        cipher = user and cls._try_decrypt(
+            cipher_cls, user.password, ts_protocol, first_data
+        )
+        if cipher:
+            USER_AFFINITY_CACHE_HIT_COUNT.inc()
+            TRIAL_DECRYPTION_SAVED_COUNT.inc(scan_cnt - 1)
+            # NOTE 命中了也要刷新过期时间, scan_cnt保持第一次扫描时的次数
+            cls._affinity_cache.set(affinity_key, cached)
+            return user, cipher, user_id
+        USER_AFFINITY_CACHE_MISS_COUNT.inc()
+        return None, None, user_id
+
+    @classmethod
+    def _scan_partition(
+        cls, cipher_cls, candidates, ts_protocol, first_data, offset, step, found
+    ):
+        """
+        在线程池里跑的一个分片, 其他分片找到用户之后提前退出
+
+        返回(user, cipher, 串行扫描时的位置, 试解密次数)
+        NOTE 这里不能访问数据库, 内存数据库的连接是线程独立的
+        """
+        cnt = 0
+        for i in range(offset, len(candidates), step):
+            if found.is_set():
                 break
-            except InvalidTag:
-                pass
+            cnt += 1
+            user = candidates[i]
+            cipher = cls._try_decrypt(
+                cipher_cls, user.password, ts_protocol, first_data
+            )
+            if cipher:
+                found.set()
+                return user, cipher, i + 1, cnt
+        return None, None, None, cnt
+
+    @classmethod
+    async def _scan_cooperatively(
+        cls, cipher_cls, candidates, ts_protocol, first_data, found
+    ):
+        """
+        在事件循环里分批试解密, 每批之间让出事件循环, 返回值和_scan_partition一样
+
+        NOTE 一次扫完几千个用户要上百ms, 这期间其他连接都得等着
+        """
+        cnt = 0
+        for start in range(0, len(candidates), cls.LOOKUP_BATCH_SIZE):
+            batch = candidates[start : start + cls.LOOKUP_BATCH_SIZE]
+            user, cipher, pos, batch_cnt = cls._scan_partition(
+                cipher_cls, batch, ts_protocol, first_data, 0, 1, found
+            )
+            cnt += batch_cnt
+            if user is not None:
+                return user, cipher, start + pos, cnt
+            await asyncio.sleep(0)
+        return None, None, None, cnt
+
+    @classmethod
+    def _prepare_find(cls, port, cipher_cls, ts_protocol, first_data, peer_ip):
+        """返回(缓存命中的用户, cipher, affinity_key, 试过的user_id)"""
+        # NOTE 2022通过EIH直接定位用户, 不需要缓存
+        if not peer_ip or cipher_cls.IDENTITY_HEADER:
+            return None, None, None, None
+        affinity_key = (port, peer_ip)
+        access_user, cipher, tried_user_id = cls._find_by_affinity(
+            affinity_key, cipher_cls, ts_protocol, first_data
+        )
+        return access_user, cipher, affinity_key, tried_user_id
+
+    @classmethod
+    def _finish_find(
+        cls, access_user, cipher, ts_protocol, affinity_key, scan_cnt, cnt, t1
+    ) -> Tuple[Optional[UserRecord], Optional[BaseCipher]]:
+        """
+        返回(user, cipher)
+
+        NOTE tcp的cipher已经解出了首包的长度块, CipherMan可以直接接着用,
+        是每个连接自己的状态, 不能挂在共用的UserRecord上
+        """
+        if ts_protocol != flag.TRANSPORT_TCP:
+            cipher = None
         if access_user:
+            if affinity_key and scan_cnt:
+                cls._affinity_cache.set(affinity_key, (access_user.user_id, scan_cnt))
             # NOTE 记下成功访问的用户，下次优先找到他
-            access_user.access_order += 1
-            access_user.save(only=[cls.access_order])
+            cls.registry.move_to_front(access_user)
         logging.info(
             f"find_access_user user={access_user} cnt={cnt} duration={int(round((time.time()-t1) * 1000))}ms"
         )
-        return access_user
+        return access_user, (cipher if access_user else None)
 
-    @db.atomic("EXCLUSIVE")
-    def record_ip(self, peername):
-        if not peername:
-            return
-        self.ip_list.add(peername[0])
-        User.update(ip_list=self.ip_list, need_sync=True).where(
-            User.user_id == self.user_id
-        ).execute()
+    @classmethod
+    @FIND_ACCESS_USER_TIME.time()
+    def find_access_user(
+        cls, port, method, ts_protocol, first_data, peer_ip=None
+    ) -> Tuple[Optional[UserRecord], Optional[BaseCipher]]:
+        cipher_cls = SUPPORT_METHODS[method]
+        t1 = time.time()
+        access_user, cipher, affinity_key, tried_user_id = cls._prepare_find(
+            port, cipher_cls, ts_protocol, first_data, peer_ip
+        )
+        cnt = int(tried_user_id is not None)
+        scan_cnt = 0
+        if not access_user:
+            if cipher_cls.IDENTITY_HEADER:
+                users = cls._list_by_identity(port, cipher_cls, ts_protocol, first_data)
+            else:
+                users = cls.registry.list_by_port(port)
+            for user in users:
+                if user.user_id == tried_user_id:
+                    continue
+                scan_cnt += 1
+                cipher = cls._try_decrypt(
+                    cipher_cls, user.password, ts_protocol, first_data
+                )
+                if cipher:
+                    access_user = user
+                    break
+            cnt += scan_cnt
+        return cls._finish_find(
+            access_user, cipher, ts_protocol, affinity_key, scan_cnt, cnt, t1
+        )
 
-    @db.atomic("EXCLUSIVE")
-    def record_traffic(self, used_u, used_d):
-        User.update(
-            download_traffic=User.download_traffic + used_d,
-            upload_traffic=User.upload_traffic + used_u,
-            need_sync=True,
-        ).where(User.user_id == self.user_id).execute()
+    @classmethod
+    async def find_access_user_async(
+        cls,
+        port,
+        method,
+        ts_protocol,
+        first_data,
+        peer_ip=None,
+        executor=None,
+        partitions=1,
+        parallel_threshold=0,
+    ) -> Tuple[Optional[UserRecord], Optional[BaseCipher]]:
+        """
+        找用户的时候不阻塞事件循环
 
-    @db.atomic("EXCLUSIVE")
-    def incr_tcp_conn_num(self, num):
-        User.update(tcp_conn_num=User.tcp_conn_num + num, need_sync=True).where(
-            User.user_id == self.user_id
-        ).execute()
+        没有线程池或者用户数不到parallel_threshold的时候在事件循环里分批试解密,
+        否则把试解密分片丢到线程池里并行跑
+        NOTE 分片按registry里的顺序交错切分, 每个分片都是从最常用的用户开始试
+        """
+        cipher_cls = SUPPORT_METHODS[method]
+        # NOTE 2022通过EIH直接定位用户, 只需要试解密一次
+        if cipher_cls.IDENTITY_HEADER:
+            return cls.find_access_user(port, method, ts_protocol, first_data, peer_ip)
+
+        t1 = time.time()
+        access_user, cipher, affinity_key, tried_user_id = cls._prepare_find(
+            port, cipher_cls, ts_protocol, first_data, peer_ip
+        )
+        if access_user:
+            FIND_ACCESS_USER_TIME.observe(time.time() - t1)
+            return cls._finish_find(
+                access_user, cipher, ts_protocol, affinity_key, 0, 1, t1
+            )
+
+        candidates = [
+            u for u in cls.registry.list_by_port(port) if u.user_id != tried_user_id
+        ]
+        found = threading.Event()
+        first_data = bytes(first_data)
+        if executor is None or len(candidates) < parallel_threshold:
+            results = [
+                await cls._scan_cooperatively(
+                    cipher_cls, candidates, ts_protocol, first_data, found
+                )
+            ]
+        else:
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        executor,
+                        cls._scan_partition,
+                        cipher_cls,
+                        candidates,
+                        ts_protocol,
+                        first_data,
+                        offset,
+                        partitions,
+                        found,
+                    )
+                    for offset in range(partitions)
+                ]
+            )
+        cnt = int(tried_user_id is not None) + sum(r[3] for r in results)
+        access_user, cipher, scan_cnt, _ = next(
+            (r for r in results if r[0] is not None), (None, None, 0, 0)
+        )
+        # NOTE 等待的时候用户可能已经被删掉了
+        if access_user and cls.registry.get(access_user.user_id) is not access_user:
+            access_user = None
+        FIND_ACCESS_USER_TIME.observe(time.time() - t1)
+        return cls._finish_find(
+            access_user, cipher, ts_protocol, affinity_key, scan_cnt, cnt, t1
+        )
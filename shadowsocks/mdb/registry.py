@@ -0,0 +1,153 @@
+"""
+进程内的用户表, core/cipherman建立连接的时候只读这里, 不访问数据库
+
+NOTE 只在事件循环的线程里修改, 线程池里试解密用的是list_by_port拷贝出来的列表,
+所以不需要加锁. 数据库里的用户表只留给grpc查询和上报metrics用
+"""
+from collections import OrderedDict
+from typing import List, Optional
+
+from shadowsocks.utils import IPTracker
+
+
+class UserRecord:
+    """一个用户的配置和还没合并进数据库的metrics, 每次读写只需要改属性"""
+
+    __slots__ = (
+        "user_id",
+        "port",
+        "method",
+        "password",
+        "enable",
+        "tcp_conn_limit",
+        "upload_traffic",
+        "download_traffic",
+        "tcp_conn_num",
+        "flushed_tcp_conn_num",
+        "ip_list",
+    )
+
+    def __init__(
+        self, user_id, port, method, password, enable=True, tcp_conn_limit=None
+    ):
+        self.user_id = user_id
+        self.port = port
+        self.method = method
+        self.password = password
+        self.enable = enable
+        self.tcp_conn_limit = tcp_conn_limit
+        self.upload_traffic = 0
+        self.download_traffic = 0
+        # NOTE 当前的连接数, 和上次写进数据库的不一样才需要flush
+        self.tcp_conn_num = 0
+        self.flushed_tcp_conn_num = 0
+        self.ip_list = IPTracker()
+
+    def __str__(self):
+        return f"<User{self.user_id}>"
+
+    __repr__ = __str__
+
+    @property
+    def need_flush(self) -> bool:
+        return bool(
+            self.upload_traffic
+            or self.download_traffic
+            or self.ip_list
+            or self.tcp_conn_num != self.flushed_tcp_conn_num
+        )
+
+    def record_ip(self, peername):
+        if not peername:
+            return
+        self.ip_list.add(peername[0])
+
+    def record_traffic(self, used_u, used_d):
+        self.upload_traffic += used_u
+        self.download_traffic += used_d
+
+    def incr_tcp_conn_num(self, num):
+        self.tcp_conn_num += num
+
+
+class UserRegistry:
+    """
+    user_id -> UserRecord 和 port -> 用户 两个索引
+
+    NOTE 每个端口的用户按试解密的顺序排好, 最近认证成功的排在最前面
+    """
+
+    def __init__(self):
+        self._users = {}
+        # NOTE {port: OrderedDict(user_id: UserRecord)}
+        self._ports = {}
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(list(self._users.values()))
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def get(self, user_id) -> Optional[UserRecord]:
+        return self._users.get(user_id)
+
+    def ports(self) -> List[int]:
+        return list(self._ports)
+
+    def list_by_port(self, port) -> List[UserRecord]:
+        users = self._ports.get(port)
+        return list(users.values()) if users else []
+
+    def first_by_port(self, port) -> Optional[UserRecord]:
+        users = self._ports.get(port)
+        return next(iter(users.values()), None) if users else None
+
+    def count_by_port(self, port) -> int:
+        return len(self._ports.get(port, ()))
+
+    def upsert(
+        self, user_id, port, method, password, enable=True, tcp_conn_limit=None
+    ) -> UserRecord:
+        """
+        已有的用户原地更新, 保持在端口里的位置, 连接持有的record也能看到新配置
+
+        NOTE 新用户和换了端口的用户排在端口的最后
+        """
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = UserRecord(
+                user_id, port, method, password, enable, tcp_conn_limit
+            )
+        elif user.port != port:
+            self._remove_from_port(user)
+            user.port = port
+        user.method, user.password, user.enable = method, password, enable
+        user.tcp_conn_limit = tcp_conn_limit
+        self._ports.setdefault(port, OrderedDict())[user_id] = user
+        return user
+
+    def remove(self, user_id) -> Optional[UserRecord]:
+        user = self._users.pop(user_id, None)
+        if user:
+            self._remove_from_port(user)
+        return user
+
+    def move_to_front(self, user: UserRecord):
+        users = self._ports.get(user.port)
+        if users and user.user_id in users:
+            users.move_to_end(user.user_id, last=False)
+
+    def clear(self):
+        self._users.clear()
+        self._ports.clear()
+
+    def _remove_from_port(self, user: UserRecord):
+        users = self._ports.get(user.port)
+        if users is None:
+            return
+        users.pop(user.user_id, None)
+        if not users:
+            del self._ports[user.port]
@@ -0,0 +1,115 @@
+"""
+用户表的本地快照, 重启之后不用等api同步成功就能先把端口开起来
+
+NOTE 快照里的用户按registry里的顺序保存, 恢复之后找用户的顺序不变
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+
+from shadowsocks.mdb.models import User
+from shadowsocks.utils import IPTracker
+
+
+class UserSnapshot:
+
+    VERSION = 1
+    USER_FIELDS = ("user_id", "port", "method", "password", "enable", "tcp_conn_limit")
+
+    def __init__(self, path):
+        self.path = path
+        self._saving = False
+
+    def collect(self) -> dict:
+        """
+        用户配置和还没上报的metrics
+
+        NOTE 要访问数据库, 只能在事件循环的线程里调用
+        """
+        db_metrics = {
+            user_id: (upload, download, ip_list)
+            for user_id, upload, download, ip_list in User.select(
+                User.user_id, User.upload_traffic, User.download_traffic, User.ip_list
+            )
+            .where(User.need_sync == True)
+            .tuples()
+        }
+        users = []
+        for port in User.registry.ports():
+            for user in User.registry.list_by_port(port):
+                upload, download, ip_list = db_metrics.get(user.user_id, (0, 0, None))
+                ip_list = ip_list or IPTracker()
+                ip_list.merge(user.ip_list)
+                data = {f: getattr(user, f) for f in self.USER_FIELDS}
+                data["upload_traffic"] = upload + user.upload_traffic
+                data["download_traffic"] = download + user.download_traffic
+                data["ip_list"] = base64.b64encode(ip_list.to_bytes()).decode()
+                users.append(data)
+        return {"version": self.VERSION, "time": int(time.time()), "users": users}
+
+    def write(self, data: dict):
+        """先写临时文件再rename, 进程中途挂掉也不会留下写了一半的快照"""
+        tmp_path = f"{self.path}.tmp"
+        # NOTE 快照里有用户的密码, 只给当前用户读写
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        """序列化和写文件丢到线程池里, 不阻塞事件循环"""
+        if self._saving:
+            return
+        self._saving = True
+        try:
+            data = self.collect()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.write, data)
+            logging.debug(f"snapshot saved users={len(data['users'])}")
+        except Exception as e:
+            logging.warning(f"save snapshot error: {e}")
+        finally:
+            self._saving = False
+
+    def save_sync(self):
+        try:
+            self.write(self.collect())
+        except Exception as e:
+            logging.warning(f"save snapshot error: {e}")
+
+    def load(self) -> int:
+        """数据库还是空的时候从快照恢复, 返回恢复的用户数"""
+        if User.select().first():
+            return 0
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logging.warning(f"load snapshot error: {e}")
+            return 0
+        if data.get("version") != self.VERSION:
+            logging.warning(f"unknown snapshot version: {data.get('version')}")
+            return 0
+
+        users = data["users"]
+        User.create_or_update_by_user_data_list(
+            # NOTE 旧版本的快照里没有tcp_conn_limit
+            [{f: u[f] for f in self.USER_FIELDS if f in u} for u in users]
+        )
+        # NOTE 没上报的metrics放回registry, 下次flush_metrics的时候写进数据库
+        for u in users:
+            user = User.registry.get(u["user_id"])
+            user.upload_traffic = u["upload_traffic"]
+            user.download_traffic = u["download_traffic"]
+            user.ip_list = IPTracker.from_bytes(base64.b64decode(u["ip_list"]))
+        logging.info(
+            f"load snapshot users={len(users)} age={int(time.time()) - data['time']}s"
+        )
+        return len(users)
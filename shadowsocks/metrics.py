@@ -66,3 +66,185 @@ FIND_ACCESS_USER_TIME = Histogram(
     ],
 )
 FIND_ACCESS_USER_TIME = FIND_ACCESS_USER_TIME.labels(ss_node=NODE_HOST_NAME)
+
+
+MASTER_KEY_CACHE_HIT_COUNT = Counter(
+    "master_key_cache_hit_count",
+    "master key cache hit number",
+    labelnames=[
+        "ss_node",
+    ],
+)
+MASTER_KEY_CACHE_HIT_COUNT = MASTER_KEY_CACHE_HIT_COUNT.labels(ss_node=NODE_HOST_NAME)
+
+
+MASTER_KEY_CACHE_MISS_COUNT = Counter(
+    "master_key_cache_miss_count",
+    "master key cache miss number",
+    labelnames=[
+        "ss_node",
+    ],
+)
+MASTER_KEY_CACHE_MISS_COUNT = MASTER_KEY_CACHE_MISS_COUNT.labels(ss_node=NODE_HOST_NAME)
+
+
+CRYPTO_OFFLOAD_QUEUE_DEPTH = Gauge(
+    "crypto_offload_queue_depth",
+    "crypto jobs waiting or running in the offload executor",
+    labelnames=[
+        "ss_node",
+    ],
+)
+CRYPTO_OFFLOAD_QUEUE_DEPTH = CRYPTO_OFFLOAD_QUEUE_DEPTH.labels(ss_node=NODE_HOST_NAME)
+
+
+CRYPTO_BUFFER_COUNT = Counter(
+    "crypto_buffer_count",
+    "crypto buffer number by mode(inline/offload)",
+    labelnames=[
+        "ss_node",
+        "mode",
+    ],
+)
+CRYPTO_INLINE_BUFFER_COUNT = CRYPTO_BUFFER_COUNT.labels(
+    ss_node=NODE_HOST_NAME, mode="inline"
+)
+CRYPTO_OFFLOAD_BUFFER_COUNT = CRYPTO_BUFFER_COUNT.labels(
+    ss_node=NODE_HOST_NAME, mode="offload"
+)
+
+
+USER_AFFINITY_CACHE_HIT_COUNT = Counter(
+    "user_affinity_cache_hit_count",
+    "source ip affinity cache hit number",
+    labelnames=[
+        "ss_node",
+    ],
+)
+USER_AFFINITY_CACHE_HIT_COUNT = USER_AFFINITY_CACHE_HIT_COUNT.labels(
+    ss_node=NODE_HOST_NAME
+)
+
+
+USER_AFFINITY_CACHE_MISS_COUNT = Counter(
+    "user_affinity_cache_miss_count",
+    "source ip affinity cache miss number",
+    labelnames=[
+        "ss_node",
+    ],
+)
+USER_AFFINITY_CACHE_MISS_COUNT = USER_AFFINITY_CACHE_MISS_COUNT.labels(
+    ss_node=NODE_HOST_NAME
+)
+
+
+TRIAL_DECRYPTION_SAVED_COUNT = Counter(
+    "trial_decryption_saved_count",
+    "trial decryptions saved by source ip affinity cache",
+    labelnames=[
+        "ss_node",
+    ],
+)
+TRIAL_DECRYPTION_SAVED_COUNT = TRIAL_DECRYPTION_SAVED_COUNT.labels(
+    ss_node=NODE_HOST_NAME
+)
+
+
+RECEIVE_BUFFER_ALLOC_COUNT = Counter(
+    "receive_buffer_alloc_count",
+    "tcp receive buffer allocations by reason(new/grow/shrink)",
+    labelnames=[
+        "ss_node",
+        "reason",
+    ],
+)
+RECEIVE_BUFFER_NEW_COUNT = RECEIVE_BUFFER_ALLOC_COUNT.labels(
+    ss_node=NODE_HOST_NAME, reason="new"
+)
+RECEIVE_BUFFER_GROW_COUNT = RECEIVE_BUFFER_ALLOC_COUNT.labels(
+    ss_node=NODE_HOST_NAME, reason="grow"
+)
+RECEIVE_BUFFER_SHRINK_COUNT = RECEIVE_BUFFER_ALLOC_COUNT.labels(
+    ss_node=NODE_HOST_NAME, reason="shrink"
+)
+
+
+RECEIVE_BUFFER_BYTES = Gauge(
+    "receive_buffer_bytes",
+    "bytes held by tcp receive buffers",
+    labelnames=[
+        "ss_node",
+    ],
+)
+RECEIVE_BUFFER_BYTES = RECEIVE_BUFFER_BYTES.labels(ss_node=NODE_HOST_NAME)
+
+
+FLOW_CONTROL_PAUSE_COUNT = Counter(
+    "flow_control_pause_count",
+    "tcp reading paused by flow control, side(local/remote) is the paused side",
+    labelnames=[
+        "ss_node",
+        "side",
+        "reason",
+    ],
+)
+LOCAL_BACKPRESSURE_PAUSE_COUNT = FLOW_CONTROL_PAUSE_COUNT.labels(
+    ss_node=NODE_HOST_NAME, side="local", reason="backpressure"
+)
+LOCAL_CONNECT_BUFFER_PAUSE_COUNT = FLOW_CONTROL_PAUSE_COUNT.labels(
+    ss_node=NODE_HOST_NAME, side="local", reason="connect_buffer"
+)
+REMOTE_BACKPRESSURE_PAUSE_COUNT = FLOW_CONTROL_PAUSE_COUNT.labels(
+    ss_node=NODE_HOST_NAME, side="remote", reason="backpressure"
+)
+
+
+CONNECTION_TIMEOUT_COUNT = Counter(
+    "connection_timeout_count",
+    "tcp connections closed by timeout, reason(idle/lifetime)",
+    labelnames=[
+        "ss_node",
+        "reason",
+    ],
+)
+IDLE_TIMEOUT_COUNT = CONNECTION_TIMEOUT_COUNT.labels(
+    ss_node=NODE_HOST_NAME, reason="idle"
+)
+LIFETIME_TIMEOUT_COUNT = CONNECTION_TIMEOUT_COUNT.labels(
+    ss_node=NODE_HOST_NAME, reason="lifetime"
+)
+
+
+HANDSHAKE_TIMEOUT_COUNT = Counter(
+    "handshake_timeout_count",
+    "tcp connections closed before handshake finished, stage(init/lookup/connect)",
+    labelnames=[
+        "ss_node",
+        "stage",
+    ],
+)
+INIT_HANDSHAKE_TIMEOUT_COUNT = HANDSHAKE_TIMEOUT_COUNT.labels(
+    ss_node=NODE_HOST_NAME, stage="init"
+)
+LOOKUP_HANDSHAKE_TIMEOUT_COUNT = HANDSHAKE_TIMEOUT_COUNT.labels(
+    ss_node=NODE_HOST_NAME, stage="lookup"
+)
+CONNECT_HANDSHAKE_TIMEOUT_COUNT = HANDSHAKE_TIMEOUT_COUNT.labels(
+    ss_node=NODE_HOST_NAME, stage="connect"
+)
+
+
+TCP_CONN_LIMIT_COUNT = Counter(
+    "tcp_conn_limit_count",
+    "tcp connections over user limit, action(reject/evict)",
+    labelnames=[
+        "ss_node",
+        "action",
+    ],
+)
+TCP_CONN_LIMIT_REJECT_COUNT = TCP_CONN_LIMIT_COUNT.labels(
+    ss_node=NODE_HOST_NAME, action="reject"
+)
+TCP_CONN_LIMIT_EVICT_COUNT = TCP_CONN_LIMIT_COUNT.labels(
+    ss_node=NODE_HOST_NAME, action="evict"
+)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from shadowsocks.ciphers import SUPPORT_METHODS
+from shadowsocks.metrics import (
+    CRYPTO_INLINE_BUFFER_COUNT,
+    CRYPTO_OFFLOAD_BUFFER_COUNT,
+    CRYPTO_OFFLOAD_QUEUE_DEPTH,
+)
+
+
+class CryptoOffloader:
+    """
+    把大块数据的加解密丢到线程池里
+
+    NOTE cryptography的AEAD在加解密的时候会释放GIL,
+    小块数据的线程切换开销比加解密本身还大, 所以只有超过阈值的才会offload
+    """
+
+    MIN_THRESHOLD = 4 * 1024
+    MAX_THRESHOLD = 1024 * 1024
+    CALIBRATE_SIZES = [4 * 1024 * (2 ** i) for i in range(9)]
+    CALIBRATE_ROUNDS = 50
+
+    def __init__(self, max_workers: int, threshold: int = None):
+        self.max_workers = max_workers
+        # NOTE 排队的任务太多说明线程池已经跑满了, 这时候直接inline跑
+        self.max_pending = max_workers * 4
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ss-crypto"
+        )
+        if threshold:
+            self.thresholds = {cls: threshold for cls in self._aead_classes()}
+        else:
+            self.thresholds = self.calibrate()
+
+    @staticmethod
+    def _aead_classes():
+        return {cls for cls in SUPPORT_METHODS.values() if cls.AEAD_CIPHER}
+
+    def _dispatch_cost(self) -> float:
+        """一次线程池往返的耗时"""
+        self.executor.submit(time.perf_counter).result()
+        t = time.perf_counter()
+        for _ in range(self.CALIBRATE_ROUNDS):
+            self.executor.submit(time.perf_counter).result()
+        return (time.perf_counter() - t) / self.CALIBRATE_ROUNDS
+
+    def calibrate(self) -> dict:
+        """
+        启动的时候跑一个小benchmark:
+        加密耗时超过两倍线程池往返耗时的最小buffer就是这个加密方式的阈值
+        """
+        dispatch_cost = self._dispatch_cost()
+        thresholds = {}
+        for cipher_cls in self._aead_classes():
+            # NOTE 只测AEAD原语本身, 不需要密码和派生key
+            aead = cipher_cls.new_cipher(os.urandom(cipher_cls.KEY_SIZE))
+            nonce = bytes(cipher_cls.NONCE_SIZE)
+            threshold = self.MAX_THRESHOLD
+            for size in self.CALIBRATE_SIZES:
+                buf = os.urandom(size)
+                t = time.perf_counter()
+                for _ in range(3):
+                    aead.encrypt(nonce, buf, None)
+                if (time.perf_counter() - t) / 3 >= dispatch_cost * 2:
+                    threshold = size
+                    break
+            thresholds[cipher_cls] = min(
+                max(threshold, self.MIN_THRESHOLD), self.MAX_THRESHOLD
+            )
+        logging.info(
+            "crypto offload calibrated dispatch_cost={:.1f}us thresholds={}".format(
+                dispatch_cost * 1e6,
+                {cls.__name__: v for cls, v in thresholds.items()},
+            )
+        )
+        return thresholds
+
+    def should_offload(self, cipher_cls, data_len: int) -> bool:
+        threshold = self.thresholds.get(cipher_cls)
+        return (
+            threshold is not None
+            and data_len >= threshold
+            and self.pending < self.max_pending
+        )
+
+    async def run(self, fn, data):
+        self.pending += 1
+        CRYPTO_OFFLOAD_QUEUE_DEPTH.inc()
+        CRYPTO_OFFLOAD_BUFFER_COUNT.inc()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, data)
+        finally:
+            self.pending -= 1
+            CRYPTO_OFFLOAD_QUEUE_DEPTH.dec()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class CryptoLane:
+    """
+    同一个连接同一个方向的加解密任务按顺序执行, 按顺序回调
+
+    NOTE 只要前面还有没跑完的任务, 小块数据也得排队, 不然顺序就乱了
+    """
+
+    def __init__(self, offloader: CryptoOffloader, cipher_cls):
+        self.offloader = offloader
+        self.cipher_cls = cipher_cls
+        self._jobs = deque()
+        self._task = None
+
+    @property
+    def busy(self):
+        return self._task is not None
+
+    def submit(self, fn, data, callback, errback):
+        if not self.busy and not self.offloader.should_offload(
+            self.cipher_cls, len(data)
+        ):
+            CRYPTO_INLINE_BUFFER_COUNT.inc()
+            try:
+                ret = fn(data)
+            except Exception as e:
+                errback(e)
+            else:
+                callback(ret)
+            return
+
+        # NOTE data可能是连接的接收buffer, 下次read之前就会被覆盖, 排队之前先拷贝
+        self._jobs.append((fn, bytes(data), callback, errback))
+        if not self._task:
+            self._task = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while self._jobs:
+                fn, data, callback, errback = self._jobs.popleft()
+                try:
+                    if self.offloader.should_offload(self.cipher_cls, len(data)):
+                        ret = await self.offloader.run(fn, data)
+                    else:
+                        CRYPTO_INLINE_BUFFER_COUNT.inc()
+                        ret = fn(data)
+                except Exception as e:
+                    # NOTE 出错之后cipher的状态已经不可信了, 后面的任务也不用跑了
+                    self._jobs.clear()
+                    errback(e)
+                    return
+                callback(ret)
+        finally:
+            self._task = None
+
+    def close(self):
+        self._jobs.clear()
+        self._task and self._task.cancel()
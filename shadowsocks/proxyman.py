@@ -1,12 +1,16 @@
 import asyncio
-import json
 import logging
+import os
+import tempfile
 from collections import defaultdict
 
 import httpx
 
 from shadowsocks.core import LocalTCP, LocalUDP
 from shadowsocks.mdb.models import User
+from shadowsocks.mdb.registry import UserRecord
+from shadowsocks.mdb.snapshot import UserSnapshot
+from shadowsocks.utils import JSONObjectStream
 
 
 class ProxyMan:
@@ -20,48 +24,161 @@ class ProxyMan:
         "chacha20-ietf-poly1305",
         "aes-128-gcm",
         "aes-256-gcm",
+        "2022-blake3-aes-128-gcm",
+        "2022-blake3-aes-256-gcm",
     ]
+    # NOTE 拉用户的响应在内存里最多放这么大, 再大就写到临时文件里
+    SPOOL_MAX_SIZE = 1024 * 1024
 
-    def __init__(self, use_json, sync_time, listen_host, api_endpoint):
+    def __init__(
+        self,
+        use_json,
+        sync_time,
+        listen_host,
+        api_endpoint,
+        metrics_flush_time=5,
+        snapshot_path=None,
+        snapshot_time=60,
+    ):
         self.use_json = use_json
         self.sync_time = sync_time
+        self.metrics_flush_time = metrics_flush_time
+        self.snapshot = UserSnapshot(snapshot_path) if snapshot_path else None
+        self.snapshot_time = snapshot_time
+        self._snapshot_loaded = False
         self.listen_host = listen_host
         self.api_endpoint = api_endpoint
+        # NOTE 上次同步到的用户版本, 下次同步的时候带上, api只需要返回变化了的用户
+        self._user_version = None
+        self._user_etag = None
+        self._json_stat = None
         self.loop = asyncio.get_event_loop()
         # NOTE {"port":{"tcp":tcp_server,"udp":udp_server}}
         self.__running_servers__ = defaultdict(dict)
 
-    @staticmethod
-    def create_or_update_from_json(path):
-        with open(path, "r") as f:
-            data = json.load(f)
-            User.create_or_update_by_user_data_list(data["users"])
+    def create_or_update_from_json(self, path):
+        """json文件没改过就不用再读一遍"""
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self._json_stat:
+            return
+        with open(path, "rb") as f:
+            if "users" not in self.sync_users_from_json(f):
+                raise ValueError(f"no users in {path}")
+        self._json_stat = stat
 
     @staticmethod
-    async def get_user_from_remote(url):
+    def sync_users_from_json(fp) -> dict:
+        """
+        流式解析用户json, "users"里的用户边解析边分批写进数据库, 返回其余的字段
+
+        NOTE 增量同步的changed/deleted只和变化的用户数有关, 整个解析出来交给调用方
+        """
+        data = {}
+        for key, value in JSONObjectStream(fp, stream_keys=("users",)):
+            if key == "users":
+                data[key] = User.create_or_update_by_user_data_list(value)
+            else:
+                data[key] = value
+        return data
+
+    async def get_user_from_remote(self, url):
+        """
+        带上次的version和etag去拉用户:
+        1. 304: 用户没有变化
+        2. {"users": [...], "version": ...}: 全量同步
+        3. {"since": ..., "version": ..., "changed": [...], "deleted": [...]}: 增量同步
+
+        NOTE 增量的since和本地的version对不上, 说明中间漏了变更, 不带version重新拉全量
+        """
         async with httpx.AsyncClient() as client:
-            res = await client.get(url)
-            User.create_or_update_by_user_data_list(res.json()["users"])
+            res, fp = await self._fetch_users(client, url, self._user_version)
+            if fp is None:
+                logging.debug(f"users not modified version={self._user_version}")
+                return
+            with fp:
+                data = self.sync_users_from_json(fp)
+            if "users" not in data and data.get("since") != self._user_version:
+                logging.warning(
+                    "user version mismatch since={} local={}, resync all users".format(
+                        data.get("since"), self._user_version
+                    )
+                )
+                self._user_version = self._user_etag = None
+                res, fp = await self._fetch_users(client, url, None)
+                if fp is None:
+                    raise ValueError("full user list expected without since")
+                with fp:
+                    data = self.sync_users_from_json(fp)
+                if "users" not in data:
+                    raise ValueError("full user list expected without since")
+
+        if "users" not in data:
+            User.apply_user_delta(data.get("changed", []), data.get("deleted", []))
+        self._user_version = data.get("version")
+        self._user_etag = res.headers.get("etag")
+
+    async def _fetch_users(self, client, url, since):
+        """
+        响应先写进临时文件, 超过SPOOL_MAX_SIZE的部分落盘, 304的时候返回的文件是None
+
+        NOTE 收完再解析, 写数据库的事务不会跨过网络io
+        """
+        params, headers = {}, {}
+        if since is not None:
+            params["since"] = since
+        if self._user_etag:
+            headers["If-None-Match"] = self._user_etag
+        async with client.stream("GET", url, params=params, headers=headers) as res:
+            if res.status_code == 304:
+                return res, None
+            res.raise_for_status()
+            fp = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE)
+            try:
+                async for chunk in res.aiter_bytes():
+                    fp.write(chunk)
+            except BaseException:
+                fp.close()
+                raise
+        fp.seek(0)
+        return res, fp
 
     @staticmethod
     async def flush_metrics_to_remote(url):
+        User.flush_metrics()
+        users = User.get_need_sync_user_metrics()
         data = [
             {
                 "user_id": user.user_id,
                 "ip_list": list(user.ip_list),
+                "ip_count": user.ip_list.count(),
                 "tcp_conn_num": user.tcp_conn_num,
                 "upload_traffic": user.upload_traffic,
                 "download_traffic": user.download_traffic,
             }
-            for user in User.get_need_sync_user_metrics()
+            for user in users
         ]
         async with httpx.AsyncClient() as client:
             try:
-                await client.post(url, json={"data": data})
+                res = await client.post(url, json={"data": data})
+                res.raise_for_status()
             except Exception as e:
                 logging.warning(f"flush_metrics_to_remote error: {e}")
             else:
-                User.reset_need_sync_user_traffic()
+                User.reset_need_sync_user_traffic(users)
+
+    async def flush_metrics_cron(self):
+        while True:
+            await asyncio.sleep(self.metrics_flush_time)
+            try:
+                User.flush_metrics()
+            except Exception as e:
+                logging.warning(f"flush metrics error: {e}")
+
+    async def snapshot_cron(self):
+        while True:
+            await asyncio.sleep(self.snapshot_time)
+            await self.snapshot.save()
 
     async def sync_from_remote_cron(self):
         try:
@@ -69,6 +186,9 @@ class ProxyMan:
             await self.get_user_from_remote(self.api_endpoint)
         except Exception as e:
             logging.warning(f"sync error: {e}")
+        else:
+            # NOTE 上报之后马上存一次, 重启之后不会把已经上报的流量再报一次
+            self.snapshot and await self.snapshot.save()
 
     async def sync_from_json_cron(self):
         self.create_or_update_from_json("userconfigs.json")
@@ -82,24 +202,35 @@ class ProxyMan:
         TODO 关闭不需要的server
         """
 
+        # NOTE 第一次启动的时候先用快照把端口开起来, 再和api同步
+        if self.snapshot and not self._snapshot_loaded:
+            self._snapshot_loaded = True
+            if self.snapshot.load():
+                await self.init_servers()
+
         if self.use_json:
             await self.sync_from_json_cron()
         else:
             await self.sync_from_remote_cron()
 
-        for user in User.select().where(User.enable == True):
-            try:
-                await self.init_server(user)
-            except Exception as e:
-                logging.error(e)
-                self.loop.stop()
+        await self.init_servers()
         self.loop.call_later(
             self.sync_time,
             self.loop.create_task,
             self.start_and_check_ss_server(),
         )
 
-    async def init_server(self, user: User):
+    async def init_servers(self):
+        for user in User.registry:
+            if not user.enable:
+                continue
+            try:
+                await self.init_server(user)
+            except Exception as e:
+                logging.error(e)
+                self.loop.stop()
+
+    async def init_server(self, user: UserRecord):
 
         running_server = self.get_server_by_port(user.port)
         if running_server:
@@ -10,6 +10,11 @@ from shadowsocks.gen.async_protos.aioshadowsocks_pb2 import (
 from shadowsocks.mdb import models as m
 
 
+def _user_to_dict(user):
+    # NOTE proto里没有tcp_conn_limit
+    return user.to_dict(exclude=[m.User.tcp_conn_limit])
+
+
 class AioShadowsocksServicer(ssBase):
     def __init__(self) -> None:
         self.cipher_map = {}
@@ -24,7 +29,7 @@ class AioShadowsocksServicer(ssBase):
             "enable": request.enable,
         }
         user = m.User.create_or_update_user_from_data(data)
-        await stream.send_message(User(**user.to_dict()))
+        await stream.send_message(User(**_user_to_dict(user)))
 
     async def UpdateUser(self, stream):
         request = await stream.recv_message()
@@ -36,12 +41,12 @@ class AioShadowsocksServicer(ssBase):
             "enable": request.enable,
         }
         user = m.User.create_or_update_user_from_data(data)
-        await stream.send_message(User(**user.to_dict()))
+        await stream.send_message(User(**_user_to_dict(user)))
 
     async def GetUser(self, stream):
         request = await stream.recv_message()
         user = m.User.get_by_id(request.user_id)
-        await stream.send_message(User(**user.to_dict()))
+        await stream.send_message(User(**_user_to_dict(user)))
 
     async def DeleteUser(self, stream):
         request = await stream.recv_message()
@@ -53,7 +58,7 @@ class AioShadowsocksServicer(ssBase):
     async def ListUser(self, stream):
         request = await stream.recv_message()
         users = m.User.select().where(m.User.tcp_conn_num <= request.tcp_conn_num)
-        res = UserList(data=[user.to_dict() for user in users])
+        res = UserList(data=[_user_to_dict(user) for user in users])
         await stream.send_message(res)
 
     async def HealthCheck(self, stream):
@@ -63,12 +68,13 @@ class AioShadowsocksServicer(ssBase):
 
     async def FindAccessUser(self, stream):
         request = await stream.recv_message()
-        user = m.User.find_access_user(
+        user, _ = m.User.find_access_user(
             request.port, request.method, request.ts_protocol, request.data
         )
         if not user:
             raise Exception("not find")
-        await stream.send_message(User(**user.to_dict()))
+        user = m.User.get_by_id(user.user_id)
+        await stream.send_message(User(**_user_to_dict(user)))
 
     async def DecryptData(self, stream):
         request = await stream.recv_message()
@@ -0,0 +1,131 @@
+import asyncio
+
+
+class TimerEntry:
+    """时间轮里的一个定时器, 同一个entry可以反复schedule"""
+
+    __slots__ = ("callback", "deadline", "_slot")
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadline = None
+        self._slot = None
+
+    @property
+    def scheduled(self):
+        return self._slot is not None
+
+
+class TimerWheel:
+    """
+    分层时间轮, 所有连接共用一个, 整个事件循环只有一个call_later
+
+    LEVELS层, 每层SLOTS个槽, 第n层一个槽跨SLOTS**n个tick.
+    schedule和cancel都是O(1), 上层的槽转到的时候把里面的定时器往下一层挪
+
+    NOTE 时间用tick数表示, 连接每次读到数据只记一下now, 不用动时间轮,
+    到期的时候再看要不要按最后活跃的时间重新schedule
+    """
+
+    SLOTS = 64
+    LEVELS = 4
+    _BITS = 6
+    _MASK = SLOTS - 1
+    _MAX_DELTA = SLOTS ** LEVELS - 1
+
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.now = 0
+        self._wheels = [[set() for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self._count = 0
+        self._base = None
+        self._handle = None
+
+    def __len__(self):
+        return self._count
+
+    def ticks(self, seconds) -> int:
+        """秒数换算成tick, 向上取整"""
+        return max(int(-(-seconds // self.tick)), 1)
+
+    def schedule(self, entry: TimerEntry, deadline: int):
+        """deadline是绝对的tick数, 已经过了的在下一个tick触发"""
+        self.cancel(entry)
+        entry.deadline = deadline
+        self._insert(entry, self.now + 1)
+        self._count += 1
+        self._handle or self._start()
+
+    def schedule_in(self, entry: TimerEntry, seconds):
+        self.schedule(entry, self.now + self.ticks(seconds))
+
+    def cancel(self, entry: TimerEntry):
+        if entry._slot is None:
+            return
+        entry._slot.discard(entry)
+        entry._slot = None
+        self._count -= 1
+
+    def _insert(self, entry: TimerEntry, earliest: int):
+        deadline = max(entry.deadline, earliest)
+        delta = min(deadline - self.now, self._MAX_DELTA)
+        level = 0
+        while delta >= self.SLOTS:
+            delta >>= self._BITS
+            level += 1
+        if level:
+            # NOTE 超过最大跨度的先放在最上层, 转到的时候按真实的deadline重新放
+            deadline = min(deadline, self.now + self._MAX_DELTA)
+        slot = self._wheels[level][(deadline >> (self._BITS * level)) & self._MASK]
+        slot.add(entry)
+        entry._slot = slot
+
+    def advance(self):
+        """走一个tick, 触发到期的定时器"""
+        self.now += 1
+        now = self.now
+        # NOTE 低位都转了一圈的层要往下挪, 从最上层开始, 挪下来的可能正好这个tick到期
+        top = 1
+        while top < self.LEVELS and not now & ((1 << (self._BITS * top)) - 1):
+            top += 1
+        for level in range(top - 1, 0, -1):
+            index = (now >> (self._BITS * level)) & self._MASK
+            entries, self._wheels[level][index] = self._wheels[level][index], set()
+            for entry in entries:
+                self._insert(entry, now)
+
+        index = now & self._MASK
+        entries, self._wheels[0][index] = self._wheels[0][index], set()
+        for entry in entries:
+            if entry.deadline > now:
+                self._insert(entry, now + 1)
+                continue
+            entry._slot = None
+            self._count -= 1
+            entry.callback()
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        # NOTE 停过之后重新开始, tick数接着之前的算
+        self._base = loop.time() - self.now * self.tick
+        self._handle = loop.call_at(
+            self._base + (self.now + 1) * self.tick, self._on_tick
+        )
+
+    def _on_tick(self):
+        loop = asyncio.get_running_loop()
+        # NOTE 事件循环卡住的时候一次把落下的tick都补上
+        target = int((loop.time() - self._base) / self.tick)
+        while self.now < target and self._count:
+            self.advance()
+        if not self._count:
+            # NOTE 没有定时器的时候不用一直空转
+            self._handle = None
+            return
+        self._handle = loop.call_at(
+            self._base + (self.now + 1) * self.tick, self._on_tick
+        )
+
+    def stop(self):
+        self._handle and self._handle.cancel()
+        self._handle = None
@@ -1,6 +1,16 @@
+from __future__ import annotations
+
+import codecs
+import hashlib
+import json
 import logging
+import math
+import re
 import socket
 import struct
+import threading
+import time
+from collections import OrderedDict
 
 from bloom_filter import BloomFilter
 
@@ -64,3 +74,341 @@ class AutoResetBloomFilter:
 
     def __contains__(self, key):
         return key in self.bf
+
+
+class LRUCache:
+    """
+    容量有上限的LRU, 超出容量时淘汰最久没有用到的key
+
+    NOTE 找用户的试解密会在线程池里跑, 所以要加锁
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """带过期时间的LRU, 过期的key在访问到的时候才删掉"""
+
+    def __init__(self, max_size, ttl):
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def _is_expired(self, item):
+        return item[0] < time.monotonic()
+
+    def get(self, key, default=None):
+        item = super().get(key)
+        if item is None:
+            return default
+        if self._is_expired(item):
+            super().pop(key)
+            return default
+        return item[1]
+
+    def set(self, key, value):
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+    def pop(self, key, default=None):
+        item = super().pop(key)
+        return default if item is None else item[1]
+
+    def items(self):
+        with self._lock:
+            items = list(self._data.items())
+        return [(k, item[1]) for k, item in items if not self._is_expired(item)]
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and not self._is_expired(item)
+
+
+class SlidingWindowFilter:
+    """滑动窗口防重放, 记录最近WINDOW_SIZE个包的id"""
+
+    WINDOW_SIZE = 2048
+    _MASK = (1 << WINDOW_SIZE) - 1
+
+    def __init__(self):
+        self._last = -1
+        self._window = 0
+
+    def add(self, n: int) -> bool:
+        """没见过的id返回True, 重复或者太旧的id返回False"""
+        if n > self._last:
+            shift = n - self._last
+            if shift >= self.WINDOW_SIZE:
+                self._window = 1
+            else:
+                self._window = ((self._window << shift) | 1) & self._MASK
+            self._last = n
+            return True
+        offset = self._last - n
+        if offset >= self.WINDOW_SIZE or self._window >> offset & 1:
+            return False
+        self._window |= 1 << offset
+        return True
+
+
+class IPTracker:
+    """
+    记录一个用户的来源ip, ip用inet_pton打包成4/16字节存
+
+    NOTE 最多精确记录MAX_EXACT个ip, 超过之后只用HyperLogLog估算去重后的ip数
+    """
+
+    __slots__ = ("_ips", "_registers")
+
+    MAX_EXACT = 64
+    # NOTE 2**10个寄存器, 1KB内存, 误差3%左右
+    HLL_BITS = 10
+    _HLL_SIZE = 1 << HLL_BITS
+    _HLL_ALPHA = 0.7213 / (1 + 1.079 / _HLL_SIZE)
+    _V4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+    def __init__(self, ips=()):
+        self._ips = set()
+        self._registers = None
+        for ip in ips:
+            self.add(ip)
+
+    @classmethod
+    def pack_ip(cls, ip: str) -> bytes:
+        if ":" not in ip:
+            return socket.inet_pton(socket.AF_INET, ip)
+        # NOTE 去掉link-local地址的%scope, 双栈监听时ipv4会变成::ffff:a.b.c.d
+        packed = socket.inet_pton(socket.AF_INET6, ip.split("%", 1)[0])
+        if packed[:12] == cls._V4_MAPPED_PREFIX:
+            return packed[12:]
+        return packed
+
+    @staticmethod
+    def unpack_ip(packed: bytes) -> str:
+        family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+        return socket.inet_ntop(family, packed)
+
+    def add(self, ip: str):
+        packed = self.pack_ip(ip)
+        if packed in self._ips:
+            return
+        if len(self._ips) < self.MAX_EXACT:
+            self._ips.add(packed)
+            return
+        if self._registers is None:
+            self._registers = bytearray(self._HLL_SIZE)
+            for p in self._ips:
+                self._add_to_hll(p)
+        self._add_to_hll(packed)
+
+    def _add_to_hll(self, packed: bytes):
+        h = int.from_bytes(hashlib.blake2b(packed, digest_size=8).digest(), "big")
+        rest_bits = 64 - self.HLL_BITS
+        index, rest = h >> rest_bits, h & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def merge(self, other: IPTracker):
+        for p in other._ips:
+            self.add(self.unpack_ip(p))
+        if other._registers is not None:
+            if self._registers is None:
+                self._registers = bytearray(self._HLL_SIZE)
+                for p in self._ips:
+                    self._add_to_hll(p)
+            self._registers = bytearray(map(max, self._registers, other._registers))
+
+    def count(self) -> int:
+        """去重后的ip数, 超过MAX_EXACT之后是估算值"""
+        if self._registers is None:
+            return len(self._ips)
+        m = self._HLL_SIZE
+        estimate = self._HLL_ALPHA * m * m / sum(2.0 ** -r for r in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return max(int(round(estimate)), len(self._ips))
+
+    def clear(self):
+        self._ips.clear()
+        self._registers = None
+
+    def difference_update(self, other: IPTracker):
+        """
+        去掉已经上报过的ip
+
+        NOTE HyperLogLog减不了, 寄存器和上报的一样才清空, 否则下次会多报一些旧ip
+        """
+        self._ips -= other._ips
+        if self._registers == other._registers:
+            self._registers = None
+
+    def to_bytes(self) -> bytes:
+        """每个ip是1字节长度+地址, 有HyperLogLog的话寄存器接在最后"""
+        parts = [struct.pack("!?B", self._registers is not None, len(self._ips))]
+        for p in self._ips:
+            parts.append(bytes([len(p)]) + p)
+        if self._registers is not None:
+            parts.append(bytes(self._registers))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> IPTracker:
+        tracker = cls()
+        if not data:
+            return tracker
+        has_hll, n = struct.unpack_from("!?B", data)
+        pos = 2
+        for _ in range(n):
+            size = data[pos]
+            tracker._ips.add(bytes(data[pos + 1 : pos + 1 + size]))
+            pos += 1 + size
+        if has_hll:
+            tracker._registers = bytearray(data[pos : pos + cls._HLL_SIZE])
+        return tracker
+
+    def __iter__(self):
+        return (self.unpack_ip(p) for p in self._ips)
+
+    def __bool__(self):
+        return bool(self._ips)
+
+    def __eq__(self, other):
+        if isinstance(other, IPTracker):
+            return self._ips == other._ips and self._registers == other._registers
+        return set(self) == set(other)
+
+    def __repr__(self):
+        return f"<IPTracker count={self.count()}>"
+
+
+class JSONObjectStream:
+    """
+    流式解析最外层是object的json, 按文档里的顺序yield (key, value)
+
+    NOTE stream_keys里的数组不会整个解析出来, value是一个逐个yield元素的迭代器,
+    要在下一次next之前用完, 没用完的会被跳过. 内存只和单个元素的大小有关
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, fp, stream_keys=(), chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.stream_keys = set(stream_keys)
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size) -> bool:
+        if self._eof:
+            return False
+        if self._pos:
+            self._buf, self._pos = self._buf[self._pos :], 0
+        chunk = self.fp.read(size)
+        if isinstance(chunk, bytes):
+            chunk = self._text_decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf += chunk
+        return True
+
+    def _peek(self) -> str:
+        """跳过空白, 返回下一个字符, 读完了返回空字符串"""
+        while True:
+            pos = self._pos = self._WHITESPACE.match(self._buf, self._pos).end()
+            if pos < len(self._buf):
+                return self._buf[pos]
+            if not self._fill(self.chunk_size):
+                return ""
+
+    def _expect(self, chars) -> str:
+        c = self._peek()
+        if not c or c not in chars:
+            raise json.JSONDecodeError(f"expecting {chars!r}", self._buf, self._pos)
+        self._pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # NOTE 值被chunk截断了, 读到的数据翻倍, 避免大的值反复重新解析
+                if not self._fill(max(self.chunk_size, len(self._buf) - self._pos)):
+                    raise
+                continue
+            # NOTE 数字刚好在buf末尾的时候可能还没读完
+            if end < len(self._buf) or not self._fill(self.chunk_size):
+                self._pos = end
+                return value
+
+    def _items(self):
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("expecting key", self._buf, self._pos)
+            self._expect(":")
+            if key in self.stream_keys and self._peek() == "[":
+                self._pos += 1
+                items = self._items()
+                yield key, items
+                for _ in items:
+                    pass
+            else:
+                yield key, self._value()
+            if self._expect(",}") == "}":
+                return
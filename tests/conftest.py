@@ -0,0 +1,16 @@
+import pytest
+
+from shadowsocks.mdb.models import User
+
+
+@pytest.fixture
+def user_db():
+    """空的用户表和registry, 不管测试成功失败结束之后都清理掉"""
+    User.create_table()
+    User.delete().execute()
+    User.registry.clear()
+    yield User
+    User.delete().execute()
+    User.registry.clear()
+    User._identity_index.clear()
+    User._affinity_cache.clear()
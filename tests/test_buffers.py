@@ -0,0 +1,34 @@
+from shadowsocks.buffers import ReceiveBuffer
+
+
+def test_receive_buffer_adaptive_size():
+    recv_buffer = ReceiveBuffer()
+    assert len(recv_buffer) == ReceiveBuffer.INITIAL_SIZE
+
+    # NOTE 每次都读满说明数据很多, 翻倍直到MAX_SIZE
+    view = recv_buffer.get_buffer()
+    view[:3] = b"abc"
+    data = recv_buffer.updated(len(view))
+    assert len(recv_buffer) == ReceiveBuffer.INITIAL_SIZE * 2
+    # NOTE 扩容是换一块新内存, 上次返回的数据不会被覆盖
+    recv_buffer.get_buffer()[:3] = b"xyz"
+    assert data[:3] == b"abc"
+    while len(recv_buffer) < ReceiveBuffer.MAX_SIZE:
+        recv_buffer.updated(len(recv_buffer))
+    recv_buffer.updated(len(recv_buffer))
+    assert len(recv_buffer) == ReceiveBuffer.MAX_SIZE
+
+    # NOTE 偶尔读得少不会缩, 连续读得少才减半
+    recv_buffer.updated(1)
+    recv_buffer.updated(len(recv_buffer) // 2)
+    for _ in range(ReceiveBuffer.SHRINK_AFTER - 1):
+        recv_buffer.updated(1)
+    assert len(recv_buffer) == ReceiveBuffer.MAX_SIZE
+    recv_buffer.updated(1)
+    assert len(recv_buffer) == ReceiveBuffer.MAX_SIZE // 2
+
+    for _ in range(ReceiveBuffer.SHRINK_AFTER * 20):
+        recv_buffer.updated(1)
+    assert len(recv_buffer) == ReceiveBuffer.MIN_SIZE
+    recv_buffer.release()
+    assert len(recv_buffer) == 0
@@ -1,7 +1,34 @@
+import base64
 import os
 import time
 
-from shadowsocks.ciphers import SUPPORT_METHODS
+import pytest
+from blake3 import blake3
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from shadowsocks import protocol_flag as flag
+from shadowsocks.buffers import ReceiveBuffer
+from shadowsocks.ciphers import (
+    MASTER_KEY_CACHE,
+    SUPPORT_METHODS,
+    BaseSS2022Cipher,
+    aes_ecb_decrypt,
+    aes_ecb_encrypt,
+    evp_bytestokey,
+    invalidate_master_keys,
+)
+
+# NOTE 2022的请求和响应格式不一样, 不能用同一个cipher对称加解密
+SYMMETRIC_METHODS = {
+    method: cipher_cls
+    for method, cipher_cls in SUPPORT_METHODS.items()
+    if not issubclass(cipher_cls, BaseSS2022Cipher)
+}
+SS2022_METHODS = {
+    method: cipher_cls
+    for method, cipher_cls in SUPPORT_METHODS.items()
+    if issubclass(cipher_cls, BaseSS2022Cipher)
+}
 
 
 def _test_cipher(cipher_cls, size=32 * 1024, repeat=128):
@@ -19,7 +46,250 @@ def _test_cipher(cipher_cls, size=32 * 1024, repeat=128):
 
 
 def test_cipher():
-    for _, cipher_cls in SUPPORT_METHODS.items():
+    for _, cipher_cls in SYMMETRIC_METHODS.items():
         t = time.perf_counter()
         _test_cipher(cipher_cls, size=256000)
         print(cipher_cls, time.perf_counter() - t)
+
+
+def test_aead_decrypt_fragmented():
+    password = "i am password"
+    plain_text = os.urandom(256 * 1024)
+    for _, cipher_cls in SYMMETRIC_METHODS.items():
+        enc_text = cipher_cls(password).encrypt(plain_text)
+        # NOTE 第一次读到的数据至少要包含salt
+        first_len = getattr(cipher_cls, "SALT_SIZE", 0)
+        for read_size in (1, 7, 1500, 16 * 1024, 100 * 1024):
+            dep = cipher_cls(password)
+            dep_text = dep.decrypt(enc_text[: first_len + read_size]) + b"".join(
+                dep.decrypt(enc_text[i : i + read_size])
+                for i in range(first_len + read_size, len(enc_text), read_size)
+            )
+            assert dep_text == plain_text
+
+
+def test_decrypt_from_reused_buffer():
+    """和BufferedProtocol一样每次read都读进同一块buffer, 解密完马上被覆盖"""
+    password = "i am password"
+    plain_text = os.urandom(256 * 1024)
+    for _, cipher_cls in SYMMETRIC_METHODS.items():
+        enc_text = cipher_cls(password).encrypt(plain_text)
+        for read_size in (100, 1500, 64 * 1024):
+            recv_buffer = ReceiveBuffer(size=read_size)
+            dep, ret = cipher_cls(password), []
+            for i in range(0, len(enc_text), read_size):
+                chunk = enc_text[i : i + read_size]
+                recv_buffer.get_buffer()[: len(chunk)] = chunk
+                ret.append(dep.decrypt(recv_buffer.updated(len(chunk))))
+                recv_buffer.get_buffer()[:] = bytes(len(recv_buffer))
+            assert b"".join(ret) == plain_text
+            if cipher_cls.AEAD_CIPHER:
+                # NOTE salt要一直留着, 不能是buffer的view
+                assert type(dep.salt) is bytes
+                assert dep.salt == enc_text[: cipher_cls.SALT_SIZE]
+            recv_buffer.release()
+
+
+def test_aead_encrypt_chunks():
+    password = "i am password"
+    plain_text = os.urandom(100 * 1024)
+    for _, cipher_cls in SYMMETRIC_METHODS.items():
+        chunks = cipher_cls(password).encrypt_chunks(plain_text)
+        assert cipher_cls(password).decrypt(b"".join(chunks)) == plain_text
+
+
+def test_master_key_cache():
+    password = "i am cached password"
+    for _, cipher_cls in SYMMETRIC_METHODS.items():
+        cipher = cipher_cls(password)
+        assert (cipher_cls, password) in MASTER_KEY_CACHE
+        assert cipher.key == evp_bytestokey(password.encode(), cipher_cls.KEY_SIZE)
+        assert cipher_cls(password).key is cipher.key
+
+    invalidate_master_keys([password])
+    for _, cipher_cls in SYMMETRIC_METHODS.items():
+        assert (cipher_cls, password) not in MASTER_KEY_CACHE
+
+
+def test_derive_subkey():
+    # NOTE RFC 5869 A.4 HKDF-SHA1 test vector
+    class RFC5869Cipher(SUPPORT_METHODS["aes-128-gcm"]):
+        INFO = bytes.fromhex("f0f1f2f3f4f5f6f7f8f9")
+        KEY_SIZE = 42
+
+    key = bytes.fromhex("0b" * 11)
+    assert RFC5869Cipher.derive_subkey(key, bytearray(range(13))).hex() == (
+        "085a01ea1b10f36933068b56efa5ad81a4f14b822f5b091568a9"
+        "cdd4f155fda2c22e422478d305f3f896"
+    )
+
+
+def test_aead_probe():
+    plain_text = os.urandom(64 * 1024)
+    for _, cipher_cls in SYMMETRIC_METHODS.items():
+        if not cipher_cls.AEAD_CIPHER:
+            continue
+        enc_text = cipher_cls("i am password").encrypt(plain_text)
+        first_len = cipher_cls.tcp_first_data_len()
+        assert cipher_cls.probe("wrong password", enc_text[:first_len]) is None
+        dep = cipher_cls.probe("i am password", enc_text[:first_len])
+        assert dep.decrypt(enc_text[first_len:]) == plain_text
+
+    header = b"\x01\x7f\x00\x00\x01\x00\x50"
+    for _, cipher_cls in SS2022_METHODS.items():
+        for password in (
+            _new_psk(cipher_cls),
+            f"{_new_psk(cipher_cls)}:{_new_psk(cipher_cls)}",
+        ):
+            enc_text = _ss2022_request(cipher_cls, password, header, plain_text)
+            first_len = cipher_cls.tcp_first_data_len()
+            other = f"{password.rpartition(':')[0]}:{_new_psk(cipher_cls)}".lstrip(":")
+            assert cipher_cls.probe(other, enc_text[:first_len]) is None
+            dep = cipher_cls.probe(password, enc_text[:first_len])
+            assert dep.decrypt(enc_text[first_len:]) == header + plain_text
+
+
+def _new_psk(cipher_cls):
+    return base64.b64encode(os.urandom(cipher_cls.KEY_SIZE)).decode()
+
+
+def _ss2022_request(cipher_cls, password, header, payload, padding=b"\x00" * 16):
+    """模拟客户端构造2022的tcp请求"""
+    cipher = cipher_cls(password)
+    salt = os.urandom(cipher_cls.SALT_SIZE)
+    cipher._subkey = cipher._derive_subkey(salt)
+    ret = [salt]
+    if cipher.identity_key:
+        subkey = blake3(
+            cipher.identity_key + salt,
+            derive_key_context=cipher_cls.IDENTITY_SUBKEY_CONTEXT,
+        ).digest(length=cipher_cls.KEY_SIZE)
+        encryptor = Cipher(algorithms.AES(subkey), modes.ECB()).encryptor()
+        ret.append(
+            encryptor.update(cipher_cls.identity_hash(password)) + encryptor.finalize()
+        )
+    variable_header = header + len(padding).to_bytes(2, "big") + padding
+    fixed_header = (
+        b"\x00"
+        + int(time.time()).to_bytes(8, "big")
+        + len(variable_header).to_bytes(2, "big")
+    )
+    ret.append(cipher._encrypt(fixed_header))
+    ret.append(cipher._encrypt(variable_header))
+    ret.extend(cipher.encrypt_chunks(payload))
+    return b"".join(ret)
+
+
+def test_ss2022_request():
+    header = b"\x01\x7f\x00\x00\x01\x00\x50"
+    payload = os.urandom(100 * 1024)
+    for _, cipher_cls in SS2022_METHODS.items():
+        for password in (
+            _new_psk(cipher_cls),
+            f"{_new_psk(cipher_cls)}:{_new_psk(cipher_cls)}",
+        ):
+            enc_text = _ss2022_request(cipher_cls, password, header, payload)
+            first_len = cipher_cls.tcp_first_data_len()
+            dep = cipher_cls(password)
+            dep_text = dep.decrypt(enc_text[:first_len]) + b"".join(
+                dep.decrypt(enc_text[i : i + 1500])
+                for i in range(first_len, len(enc_text), 1500)
+            )
+            assert dep_text == header + payload
+
+            if dep.identity_key:
+                assert cipher_cls.identify(
+                    dep.identity_key, enc_text[:first_len]
+                ) == cipher_cls.identity_hash(password)
+                with pytest.raises(RuntimeError):
+                    other = f"{password.split(':')[0]}:{_new_psk(cipher_cls)}"
+                    cipher_cls(other).decrypt(enc_text)
+
+
+def test_ss2022_response():
+    payload = os.urandom(100 * 1024)
+    for _, cipher_cls in SS2022_METHODS.items():
+        password = _new_psk(cipher_cls)
+        request_salt = os.urandom(cipher_cls.SALT_SIZE)
+        enc = cipher_cls(password)
+        enc.request_salt = request_salt
+        enc_text = b"".join(enc.encrypt_chunks(payload))
+
+        dep = cipher_cls(password)
+        dep._subkey = dep._derive_subkey(enc_text[: cipher_cls.SALT_SIZE])
+        pos = cipher_cls.SALT_SIZE
+        header_end = pos + 11 + cipher_cls.SALT_SIZE + cipher_cls.TAG_SIZE
+        header = dep._decrypt(enc_text[pos:header_end])
+        assert header[0] == cipher_cls.HEADER_TYPE_RESPONSE
+        assert header[9 : 9 + cipher_cls.SALT_SIZE] == request_salt
+        first_len = int.from_bytes(header[-2:], "big")
+        first_end = header_end + first_len + cipher_cls.TAG_SIZE
+        dep_text = dep._decrypt(enc_text[header_end:first_end])
+        dep._header_stage = 2
+        dep_text += dep.decrypt(enc_text[first_end:])
+        assert dep_text == payload
+
+
+def test_ss2022_replay_timestamp():
+    for _, cipher_cls in SS2022_METHODS.items():
+        password = _new_psk(cipher_cls)
+        enc_text = _ss2022_request(
+            cipher_cls, password, b"\x01\x7f\x00\x00\x01\x00\x50", b""
+        )
+        cipher_cls.TIMESTAMP_WINDOW, window = -1, cipher_cls.TIMESTAMP_WINDOW
+        try:
+            with pytest.raises(RuntimeError):
+                cipher_cls(password).decrypt(enc_text)
+        finally:
+            cipher_cls.TIMESTAMP_WINDOW = window
+
+
+def _ss2022_udp_request(cipher_cls, password, session_id, packet_id, data):
+    """模拟客户端构造2022的udp包"""
+    cipher = cipher_cls(password)
+    header = session_id + packet_id.to_bytes(8, "big")
+    ret = [aes_ecb_encrypt(cipher.identity_key or cipher.key, header)]
+    if cipher.identity_key:
+        identity_hash = cipher_cls.identity_hash(password)
+        ret.append(
+            aes_ecb_encrypt(
+                cipher.identity_key, bytes(a ^ b for a, b in zip(identity_hash, header))
+            )
+        )
+    body = b"\x00" + int(time.time()).to_bytes(8, "big") + b"\x00\x03abc" + data
+    subkey = cipher._derive_subkey(session_id)
+    ret.append(cipher.new_cipher(subkey).encrypt(header[4:], body, None))
+    return b"".join(ret)
+
+
+def test_ss2022_udp():
+    data = b"\x01\x7f\x00\x00\x01\x00\x35" + os.urandom(512)
+    for _, cipher_cls in SS2022_METHODS.items():
+        for password in (
+            _new_psk(cipher_cls),
+            f"{_new_psk(cipher_cls)}:{_new_psk(cipher_cls)}",
+        ):
+            session_id = os.urandom(8)
+            server = cipher_cls(password)
+            packets = [
+                _ss2022_udp_request(cipher_cls, password, session_id, i, data)
+                for i in range(3)
+            ]
+            if server.identity_key:
+                assert cipher_cls.identify(
+                    server.identity_key, packets[0], flag.TRANSPORT_UDP
+                ) == cipher_cls.identity_hash(password)
+            for packet in reversed(packets):
+                assert server.unpack(packet) == data
+            with pytest.raises(RuntimeError):
+                server.unpack(packets[1])
+
+            # NOTE 解出响应的包
+            response = server.pack(data)
+            client = cipher_cls(password)
+            header = aes_ecb_decrypt(client.key, response[:16])
+            subkey = client._derive_subkey(header[:8])
+            body = client.new_cipher(subkey).decrypt(header[4:], response[16:], None)
+            assert body[0] == cipher_cls.HEADER_TYPE_RESPONSE
+            assert body[9:17] == session_id
+            assert body[19:] == data
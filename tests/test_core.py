@@ -0,0 +1,303 @@
+import asyncio
+import os
+import socket
+import struct
+
+import pytest
+
+from shadowsocks import protocol_flag as flag
+from shadowsocks.cipherman import CipherMan
+from shadowsocks.ciphers import SUPPORT_METHODS
+from shadowsocks.core import LocalHandler, LocalTCP
+from shadowsocks.mdb.models import User
+from shadowsocks.metrics import INIT_HANDSHAKE_TIMEOUT_COUNT
+from shadowsocks.timer import TimerWheel
+
+METHOD = "aes-128-gcm"
+PASSWORD = "i am password"
+
+
+def _setup_user(port):
+    User.create_or_update_by_user_data_list(
+        [dict(user_id=1, port=port, method=METHOD, password=PASSWORD, enable=True)]
+    )
+
+
+class FakeTransport:
+    def __init__(self):
+        self.paused = False
+        self.data = []
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.data.append(bytes(data))
+
+
+def test_connect_buffer_limit(monkeypatch):
+    monkeypatch.setattr(LocalHandler, "connect_buffer_limit", 1024)
+    handler = LocalHandler(10095)
+    transport = FakeTransport()
+    handler.handle_connection_made(transport, ("127.0.0.1", 1), flag.TRANSPORT_TCP)
+    handler._stage = handler.STAGE_CONNECT
+
+    handler._handle_plain_data(b"a" * 1000)
+    assert not transport.paused
+    handler._handle_plain_data(b"b" * 1000)
+    assert transport.paused
+
+    # NOTE 找用户结束不会把连接缓冲导致的暂停也恢复了
+    handler.pause_reading(handler.PAUSE_LOOKUP)
+    handler.resume_reading(handler.PAUSE_LOOKUP)
+    assert transport.paused
+
+    remote = FakeTransport()
+    remote.close = lambda: None
+    handler.handle_remote_connected(remote)
+    assert not transport.paused
+    assert handler._stage == handler.STAGE_STREAM
+    handler._handle_plain_data(b"c")
+    assert b"".join(remote.data) == b"a" * 1000 + b"b" * 1000 + b"c"
+
+
+def test_flow_control_slow_destination(user_db):
+    """客户端发得快, 上游不读, 节点里缓冲的数据不能一直涨"""
+    port = 10094
+    _setup_user(port)
+    total = 32 * 1024 * 1024
+    high, _ = LocalHandler.get_write_buffer_limits(port)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        upstream_protocols, local_protocols = [], []
+        upstream_received = [0]
+
+        class SlowUpstream(asyncio.Protocol):
+            def connection_made(self, transport):
+                self.transport = transport
+                transport.pause_reading()
+                upstream_protocols.append(self)
+
+            def data_received(self, data):
+                upstream_received[0] += len(data)
+
+        def local_factory():
+            protocol = LocalTCP(port)()
+            local_protocols.append(protocol)
+            return protocol
+
+        upstream = await loop.create_server(SlowUpstream, "127.0.0.1", 0)
+        upstream_port = upstream.sockets[0].getsockname()[1]
+        node = await loop.create_server(local_factory, "127.0.0.1", port)
+
+        cipher = SUPPORT_METHODS[METHOD](PASSWORD)
+        header = b"\x01" + socket.inet_aton("127.0.0.1")
+        header += struct.pack("!H", upstream_port)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+        async def send():
+            writer.write(cipher.encrypt(header))
+            for _ in range(total // (64 * 1024)):
+                writer.write(cipher.encrypt(os.urandom(64 * 1024)))
+                await writer.drain()
+
+        send_task = asyncio.create_task(send())
+        await asyncio.sleep(1)
+        assert not send_task.done()
+        handler = local_protocols[0]._handler
+        assert handler.PAUSE_BACKPRESSURE in handler._read_paused_by
+        # NOTE 节点写给上游的缓冲最多超过高水位一次read的量
+        remote_buffered = handler._remote._transport.get_write_buffer_size()
+        assert remote_buffered <= high + 256 * 1024
+
+        upstream_protocols[0].transport.resume_reading()
+        await asyncio.wait_for(send_task, 10)
+        for _ in range(200):
+            if upstream_received[0] >= total:
+                break
+            await asyncio.sleep(0.05)
+        assert upstream_received[0] == total
+        writer.close()
+        node.close()
+        upstream.close()
+
+    asyncio.run(run())
+
+
+def test_idle_timeout(monkeypatch, user_db):
+    port = 10093
+    _setup_user(port)
+    monkeypatch.setattr(LocalHandler, "timer_wheel", TimerWheel(tick=0.05))
+    monkeypatch.setattr(LocalHandler, "idle_timeout", 0.3)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        local_protocols = []
+
+        def local_factory():
+            protocol = LocalTCP(port)()
+            local_protocols.append(protocol)
+            return protocol
+
+        node = await loop.create_server(local_factory, "127.0.0.1", port)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        # NOTE 一直有数据的连接不会被关掉
+        for _ in range(10):
+            writer.write(b"\x00")
+            await asyncio.sleep(0.1)
+        assert not local_protocols[0]._handler._is_closing
+
+        assert await asyncio.wait_for(reader.read(), 2) == b""
+        assert local_protocols[0]._handler._is_closing
+        assert len(LocalHandler.timer_wheel) == 0
+        writer.close()
+        node.close()
+
+    asyncio.run(run())
+
+
+def test_handshake_timeout(monkeypatch, user_db):
+    """一直只发几个字节的连接, 空闲超时管不到, 到了握手的deadline要关掉"""
+    port = 10096
+    _setup_user(port)
+    monkeypatch.setattr(LocalHandler, "timer_wheel", TimerWheel(tick=0.05))
+    monkeypatch.setattr(LocalHandler, "idle_timeout", 10)
+    monkeypatch.setattr(LocalHandler, "handshake_timeout", 0.3)
+    before = INIT_HANDSHAKE_TIMEOUT_COUNT._value.get()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        node = await loop.create_server(LocalTCP(port), "127.0.0.1", port)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+        async def trickle():
+            while not writer.is_closing():
+                writer.write(b"\x00")
+                await asyncio.sleep(0.05)
+
+        task = asyncio.create_task(trickle())
+        assert await asyncio.wait_for(reader.read(), 2) == b""
+        task.cancel()
+        writer.close()
+        node.close()
+
+    asyncio.run(run())
+    assert INIT_HANDSHAKE_TIMEOUT_COUNT._value.get() == before + 1
+
+
+def test_tcp_conn_limit(monkeypatch, user_db):
+    single_port, multi_port = 10097, 10098
+    user_data_list = [
+        dict(user_id=1, port=single_port, password=PASSWORD, tcp_conn_limit=2),
+        dict(user_id=2, port=multi_port, password="pwd-2", tcp_conn_limit=2),
+        dict(user_id=3, port=multi_port, password="pwd-3"),
+    ]
+    for user_data in user_data_list:
+        user_data.update(method=METHOD, enable=True)
+    User.create_or_update_by_user_data_list([dict(u) for u in user_data_list])
+    users = {u["user_id"]: User.registry.get(u["user_id"]) for u in user_data_list}
+    assert users[1].tcp_conn_limit == 2 and users[3].tcp_conn_limit is None
+    header = b"\x01" + socket.inet_aton("127.0.0.1") + struct.pack("!H", 80)
+
+    def connect(user_id):
+        """和LocalHandler一样通过get_cipher_by_port拿cipher, 第一次解密的时候认证"""
+        user_data = user_data_list[user_id - 1]
+        port = user_data["port"]
+        handler = LocalHandler(port)
+        transport = FakeTransport()
+        transport.close = lambda: None
+        handler.handle_connection_made(transport, ("127.0.0.1", 1), flag.TRANSPORT_TCP)
+        handler.cipher = CipherMan.get_cipher_by_port(
+            port, flag.TRANSPORT_TCP, handler._peername
+        )
+        cipher = SUPPORT_METHODS[METHOD](user_data["password"])
+        try:
+            assert handler.cipher.decrypt(cipher.encrypt(header)) == header
+        except Exception:
+            handler.close()
+            raise
+        handler._track_user_conn()
+        return handler
+
+    # NOTE 用户数据里的上限优先于节点的配置, 单用户端口不用找用户也要检查
+    monkeypatch.setattr(CipherMan, "tcp_conn_limit", 100)
+    conns = {}
+    for user_id in (1, 2):
+        conns[user_id] = [connect(user_id), connect(user_id)]
+        with pytest.raises(RuntimeError):
+            connect(user_id)
+        # NOTE 被拒绝的连接关掉的时候不会多减一次
+        assert users[user_id].tcp_conn_num == 2
+        assert set(users[user_id].ip_list) == {"127.0.0.1"}
+    conns[3] = [connect(3), connect(3), connect(3)]
+    assert users[3].tcp_conn_num == 3
+
+    monkeypatch.setattr(
+        CipherMan, "tcp_conn_limit_policy", CipherMan.TCP_CONN_LIMIT_EVICT
+    )
+    monkeypatch.setattr(CipherMan, "conn_evictor", LocalHandler.evict_idle_conn)
+    for user_id in (1, 2):
+        first, second = conns[user_id]
+        first._last_active, second._last_active = 10, 5
+        third = connect(user_id)
+        assert second._is_closing and not first._is_closing
+        assert users[user_id].tcp_conn_num == 2
+        assert list(LocalHandler._user_conns[user_id]) == [first, third]
+        conns[user_id] = [first, second, third]
+
+    for handler in sum(conns.values(), []):
+        handler.close()
+    assert [u.tcp_conn_num for u in users.values()] == [0, 0, 0]
+    assert not LocalHandler._user_conns
+
+    # NOTE 只改了上限也算配置变化
+    user_data_list[0]["tcp_conn_limit"] = None
+    report = User.create_or_update_by_user_data_list(user_data_list)
+    assert report.updated == [1] and users[1].tcp_conn_limit is None
+
+
+def test_single_user_port_auth_before_count(user_db):
+    """单用户端口上没通过校验的数据不能占连接数, 也不能记ip"""
+    port = 10099
+    User.create_or_update_by_user_data_list(
+        [
+            dict(
+                user_id=1,
+                port=port,
+                method=METHOD,
+                password=PASSWORD,
+                enable=True,
+                tcp_conn_limit=1,
+            )
+        ]
+    )
+    user = User.registry.get(1)
+    first_data_len = SUPPORT_METHODS[METHOD].tcp_first_data_len()
+    for i, garbage in enumerate([b"\x00", os.urandom(first_data_len)]):
+        cipher = CipherMan.get_cipher_by_port(
+            port, flag.TRANSPORT_TCP, (f"6.6.6.{i}", 1)
+        )
+        if len(garbage) < first_data_len:
+            assert cipher.decrypt(garbage) is None
+        else:
+            with pytest.raises(RuntimeError):
+                cipher.decrypt(garbage)
+        cipher.close()
+    assert user.tcp_conn_num == 0 and not user.ip_list
+
+    # NOTE 真正的用户不会被扫描的连接挤掉
+    header = b"\x01" + socket.inet_aton("127.0.0.1") + struct.pack("!H", 80)
+    cipher = CipherMan.get_cipher_by_port(port, flag.TRANSPORT_TCP, ("1.1.1.1", 1))
+    data = SUPPORT_METHODS[METHOD](PASSWORD).encrypt(header)
+    assert cipher.decrypt(data[:10]) is None
+    assert cipher.decrypt(data[10:]) == header
+    assert user.tcp_conn_num == 1 and set(user.ip_list) == {"1.1.1.1"}
+    cipher.close()
+    assert user.tcp_conn_num == 0
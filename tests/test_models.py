@@ -1,6 +1,11 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
+from shadowsocks import protocol_flag as flag
 from shadowsocks.app import App
+from shadowsocks.ciphers import SUPPORT_METHODS
 from shadowsocks.mdb.models import User
 
 
@@ -16,3 +21,230 @@ def test_find_access_user(app):
     users = User.select(User.port == 1025, User.method == "chacha20-ietf-poly1305")
     first_user = users.first()
     print(first_user)
+
+
+def test_find_access_user_affinity(user_db):
+    method, port = "aes-128-gcm", 10086
+    user_data = [
+        dict(user_id=i, port=port, method=method, password=f"pwd-{i}", enable=True)
+        for i in range(1, 11)
+    ]
+    User.create_or_update_by_user_data_list([dict(u) for u in user_data])
+    cipher_cls = SUPPORT_METHODS[method]
+
+    def first_data(password):
+        data = cipher_cls(password).encrypt(b"\x01\x7f\x00\x00\x01\x00\x50")
+        return data[: cipher_cls.tcp_first_data_len()]
+
+    key = (port, "1.1.1.1")
+    user, _ = User.find_access_user(
+        port, method, flag.TRANSPORT_TCP, first_data("pwd-3"), "1.1.1.1"
+    )
+    assert user.user_id == 3
+    assert User._affinity_cache.get(key)[0] == 3
+    # NOTE 命中缓存会刷新过期时间, 省掉的次数还是按第一次扫描算
+    cached = User._affinity_cache.get(key)
+    expire_at = User._affinity_cache._data[key][0]
+    user, _ = User.find_access_user(
+        port, method, flag.TRANSPORT_TCP, first_data("pwd-3"), "1.1.1.1"
+    )
+    assert user.user_id == 3
+    assert User._affinity_cache.get(key) == cached
+    assert User._affinity_cache._data[key][0] > expire_at
+    # NOTE 同一个ip换了用户也能找到, 并且更新缓存
+    user, _ = User.find_access_user(
+        port, method, flag.TRANSPORT_TCP, first_data("pwd-5"), "1.1.1.1"
+    )
+    assert user.user_id == 5
+    assert User._affinity_cache.get(key)[0] == 5
+
+    # NOTE 用户更新之后缓存失效
+    user_data[4]["password"] = "pwd-5-new"
+    User.create_or_update_by_user_data_list([dict(u) for u in user_data])
+    assert key not in User._affinity_cache
+
+
+def test_find_access_user_async(user_db):
+    method, port = "aes-128-gcm", 10087
+    User.create_or_update_by_user_data_list(
+        [
+            dict(user_id=i, port=port, method=method, password=f"pwd-{i}", enable=True)
+            for i in range(1, 51)
+        ]
+    )
+    cipher_cls = SUPPORT_METHODS[method]
+    first_data = cipher_cls("pwd-42").encrypt(b"\x01\x7f\x00\x00\x01\x00\x50")
+    first_data = first_data[: cipher_cls.tcp_first_data_len()]
+
+    async def find():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            return await User.find_access_user_async(
+                port,
+                method,
+                flag.TRANSPORT_TCP,
+                first_data,
+                executor=executor,
+                partitions=3,
+            )
+
+    user, cipher = asyncio.run(find())
+    assert user.user_id == 42 and cipher is not None
+    # NOTE 没有线程池的时候在事件循环里分批找
+    user, _ = asyncio.run(
+        User.find_access_user_async(port, method, flag.TRANSPORT_TCP, first_data)
+    )
+    assert user.user_id == 42
+
+
+def test_port_order_move_to_front(user_db):
+    method, port = "aes-128-gcm", 10088
+    user_data = [
+        dict(user_id=i, port=port, method=method, password=f"pwd-{i}", enable=True)
+        for i in range(1, 6)
+    ]
+    User.create_or_update_by_user_data_list([dict(u) for u in user_data])
+    cipher_cls = SUPPORT_METHODS[method]
+    first_data = cipher_cls("pwd-4").encrypt(b"\x01\x7f\x00\x00\x01\x00\x50")
+    first_data = first_data[: cipher_cls.tcp_first_data_len()]
+
+    def user_ids():
+        return [u.user_id for u in User.registry.list_by_port(port)]
+
+    assert user_ids() == [1, 2, 3, 4, 5]
+    user, _ = User.find_access_user(port, method, flag.TRANSPORT_TCP, first_data)
+    assert user.user_id == 4
+    assert user_ids() == [4, 1, 2, 3, 5]
+
+    # NOTE 同步用户的时候增量更新, 不打乱已有的顺序
+    user_data[2]["password"] = "pwd-3-new"
+    user_data.append(
+        dict(user_id=6, port=port, method=method, password="pwd-6", enable=True)
+    )
+    User.create_or_update_by_user_data_list([dict(u) for u in user_data[1:]])
+    assert user_ids() == [4, 2, 3, 5, 6]
+    assert User.registry.get(3).password == "pwd-3-new"
+    assert User.registry.get(1) is None
+
+
+def test_flush_metrics(user_db):
+    User.create_or_update_by_user_data_list(
+        [
+            dict(
+                user_id=1,
+                port=10089,
+                method="aes-128-gcm",
+                password="pwd-1",
+                enable=True,
+            )
+        ]
+    )
+    user = User.registry.get(1)
+    for _ in range(10):
+        user.record_traffic(100, 200)
+    user.record_ip(("1.1.1.1", 1234))
+    user.incr_tcp_conn_num(2)
+    assert User.get_by_id(1).upload_traffic == 0
+
+    assert User.flush_metrics() == 1
+    db_user = User.get_by_id(1)
+    assert (db_user.upload_traffic, db_user.download_traffic) == (1000, 2000)
+    assert (db_user.ip_list, db_user.tcp_conn_num) == ({"1.1.1.1"}, 2)
+    assert db_user.need_sync
+    # NOTE 已经合并过的不会重复计算, ip是累加的
+    assert User.flush_metrics() == 0
+    user.record_ip(("2.2.2.2", 1234))
+    user.incr_tcp_conn_num(-1)
+    assert User.flush_metrics() == 1
+    db_user = User.get_by_id(1)
+    assert db_user.upload_traffic == 1000
+    assert (db_user.ip_list, db_user.tcp_conn_num) == ({"1.1.1.1", "2.2.2.2"}, 1)
+
+
+def test_flush_metrics_update_failed(monkeypatch, user_db):
+    User.create_or_update_by_user_data_list(
+        [
+            dict(
+                user_id=1,
+                port=10089,
+                method="aes-128-gcm",
+                password="pwd-1",
+                enable=True,
+            )
+        ]
+    )
+    user = User.registry.get(1)
+    user.record_traffic(100, 200)
+    user.record_ip(("1.1.1.1", 1234))
+
+    def update(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    # NOTE 写数据库失败的时候registry里的流量不能丢
+    with monkeypatch.context() as m:
+        m.setattr(User, "update", update)
+        with pytest.raises(RuntimeError):
+            User.flush_metrics()
+    assert (user.upload_traffic, user.download_traffic) == (100, 200)
+    assert set(user.ip_list) == {"1.1.1.1"}
+
+    assert User.flush_metrics() == 1
+    assert (user.upload_traffic, user.download_traffic) == (0, 0)
+    db_user = User.get_by_id(1)
+    assert (db_user.upload_traffic, db_user.download_traffic) == (100, 200)
+
+
+def test_sync_report(user_db):
+    def user_data(user_ids, password="pwd"):
+        return [
+            dict(
+                user_id=i,
+                port=10091,
+                method="aes-128-gcm",
+                password=f"{password}-{i}",
+                enable=True,
+            )
+            for i in user_ids
+        ]
+
+    report = User.create_or_update_by_user_data_list(user_data([1, 2, 3]))
+    assert (report.created, report.updated, report.deleted) == ([1, 2, 3], [], [])
+    User.registry.get(2).record_traffic(10, 20)
+    User.flush_metrics()
+
+    report = User.create_or_update_by_user_data_list(
+        user_data([1]) + user_data([2], "new") + user_data([4])
+    )
+    assert (report.created, report.updated, report.deleted) == ([4], [2], [3])
+    user = User.get_by_id(2)
+    assert user.password == "new-2"
+    # NOTE 更新配置不会影响metrics字段
+    assert (user.upload_traffic, user.download_traffic) == (10, 20)
+    assert User.get_or_none(User.user_id == 3) is None
+    assert User.get_by_id(4).ip_list.count() == 0
+
+
+def test_apply_user_delta(user_db):
+    user_data = [
+        dict(
+            user_id=i,
+            port=10092,
+            method="aes-128-gcm",
+            password=f"pwd-{i}",
+            enable=True,
+        )
+        for i in range(1, 4)
+    ]
+    User.create_or_update_by_user_data_list(user_data)
+
+    report = User.apply_user_delta(
+        [
+            dict(user_data[1], password="new-2"),
+            dict(user_data[0], user_id=4, password="pwd-4"),
+        ],
+        [3, 5],
+    )
+    assert (report.created, report.updated, report.deleted) == ([4], [2], [3])
+    # NOTE 增量里没提到的用户不会被删
+    assert [u.user_id for u in User.registry.list_by_port(10092)] == [1, 2, 4]
+    assert User.get_by_id(2).password == "new-2"
+    assert User.get_or_none(User.user_id == 3) is None
@@ -0,0 +1,41 @@
+import asyncio
+import os
+
+from shadowsocks.ciphers import AES128GCM
+from shadowsocks.offload import CryptoLane, CryptoOffloader
+
+
+def test_crypto_lane_keep_order():
+    async def run():
+        offloader = CryptoOffloader(max_workers=2, threshold=1024)
+        encryptor = AES128GCM("password")
+        decryptor = AES128GCM("password")
+        lane = CryptoLane(offloader, AES128GCM)
+
+        # NOTE 大小块交替, 大块走线程池, 小块要排在它后面
+        payloads = [os.urandom(10 if i % 2 else 4096) for i in range(20)]
+        ret, errors = [], []
+        for p in payloads:
+            lane.submit(encryptor.encrypt, p, ret.append, errors.append)
+        while lane.busy:
+            await asyncio.sleep(0.01)
+        offloader.close()
+
+        assert not errors
+        assert decryptor.decrypt(b"".join(ret)) == b"".join(payloads)
+
+    asyncio.run(run())
+
+
+def test_crypto_offloader_calibrate():
+    offloader = CryptoOffloader(max_workers=1)
+    try:
+        for threshold in offloader.thresholds.values():
+            assert (
+                CryptoOffloader.MIN_THRESHOLD
+                <= threshold
+                <= CryptoOffloader.MAX_THRESHOLD
+            )
+        assert AES128GCM in offloader.thresholds
+    finally:
+        offloader.close()
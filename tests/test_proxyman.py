@@ -0,0 +1,161 @@
+import asyncio
+import io
+import json
+
+import httpx
+import pytest
+
+from shadowsocks.mdb.models import User
+from shadowsocks.proxyman import ProxyMan
+
+
+def _user(user_id, password="pwd"):
+    return dict(
+        user_id=user_id,
+        port=10093,
+        method="aes-128-gcm",
+        password=f"{password}-{user_id}",
+        enable=True,
+    )
+
+
+def test_get_user_from_remote_incremental(monkeypatch, user_db):
+    requests = []
+
+    def handler(request):
+        since = request.url.params.get("since")
+        etag = request.headers.get("if-none-match")
+        requests.append((since, etag))
+        if since is None:
+            body = {"users": [_user(1), _user(2)], "version": 2}
+        elif etag == '"v3"':
+            return httpx.Response(304)
+        elif since == "2":
+            body = {"since": 2, "version": 3, "changed": [_user(2, "new")]}
+            body["deleted"] = [1]
+        else:
+            body = {"since": 1, "version": 4, "changed": [], "deleted": []}
+        return httpx.Response(200, json=body, headers={"ETag": f'"v{body["version"]}"'})
+
+    client_cls = httpx.AsyncClient
+    monkeypatch.setattr(
+        httpx,
+        "AsyncClient",
+        lambda: client_cls(transport=httpx.MockTransport(handler)),
+    )
+
+    async def run():
+        proxyman = ProxyMan(False, 60, "127.0.0.1", "http://api/users")
+        await proxyman.get_user_from_remote(proxyman.api_endpoint)
+        assert [u.user_id for u in User.registry] == [1, 2]
+
+        await proxyman.get_user_from_remote(proxyman.api_endpoint)
+        assert [u.user_id for u in User.registry] == [2]
+        assert User.registry.get(2).password == "new-2"
+
+        await proxyman.get_user_from_remote(proxyman.api_endpoint)
+        assert proxyman._user_version == 3
+
+        # NOTE 增量的since对不上, 重新拉全量
+        proxyman._user_version, proxyman._user_etag = 5, None
+        await proxyman.get_user_from_remote(proxyman.api_endpoint)
+        assert [u.user_id for u in User.registry] == [2, 1]
+        assert proxyman._user_version == 2
+
+    asyncio.run(run())
+    assert requests == [
+        (None, None),
+        ("2", '"v2"'),
+        ("3", '"v3"'),
+        ("5", None),
+        (None, None),
+    ]
+
+
+def test_create_or_update_from_json_skip_unchanged(tmp_path, user_db):
+    path = tmp_path / "userconfigs.json"
+    path.write_text(json.dumps({"users": [_user(1)]}))
+
+    async def run():
+        proxyman = ProxyMan(True, 60, "127.0.0.1", None)
+        proxyman.create_or_update_from_json(path)
+        User.registry.remove(1)
+        proxyman.create_or_update_from_json(path)
+        assert 1 not in User.registry
+        path.write_text(json.dumps({"users": [_user(1), _user(2)]}))
+        proxyman.create_or_update_from_json(path)
+        assert [u.user_id for u in User.registry] == [1, 2]
+
+    asyncio.run(run())
+
+
+def test_sync_users_from_json_stream(monkeypatch, user_db):
+    monkeypatch.setattr(User, "SYNC_BATCH_SIZE", 2)
+    users = [_user(i) for i in range(1, 6)]
+    raw = json.dumps({"users": users, "version": 1}).encode()
+
+    data = ProxyMan.sync_users_from_json(io.BytesIO(raw))
+    assert data["version"] == 1
+    assert data["users"].created == [1, 2, 3, 4, 5]
+
+    # NOTE 解析到一半出错, 已经写进去的批次跟着数据库一起回滚
+    users[0]["password"] = "changed"
+    raw = json.dumps({"users": users + [_user(6)]}).encode()[:-20]
+    with pytest.raises(ValueError):
+        ProxyMan.sync_users_from_json(io.BytesIO(raw))
+    assert User.registry.get(1).password == "pwd-1"
+    assert User.get_by_id(1).password == "pwd-1"
+    assert [u.user_id for u in User.registry] == [1, 2, 3, 4, 5]
+
+
+def test_flush_metrics_to_remote_keeps_new_traffic(monkeypatch, user_db):
+    User.create_or_update_by_user_data_list([_user(1)])
+    user = User.registry.get(1)
+    user.record_traffic(100, 200)
+    user.record_ip(("1.1.1.1", 1234))
+    posted = []
+
+    def handler(request):
+        posted.append(json.loads(request.content)["data"])
+        # NOTE 上报期间flush_metrics_cron又合并进来新的流量和ip
+        user.record_traffic(10, 20)
+        user.record_ip(("2.2.2.2", 1234))
+        User.flush_metrics()
+        return httpx.Response(200)
+
+    client_cls = httpx.AsyncClient
+    monkeypatch.setattr(
+        httpx,
+        "AsyncClient",
+        lambda: client_cls(transport=httpx.MockTransport(handler)),
+    )
+    asyncio.run(ProxyMan.flush_metrics_to_remote("http://api/metrics"))
+    assert [(u["upload_traffic"], u["ip_list"]) for u in posted[0]] == [
+        (100, ["1.1.1.1"])
+    ]
+    db_user = User.get_by_id(1)
+    assert (db_user.upload_traffic, db_user.download_traffic) == (10, 20)
+    assert set(db_user.ip_list) == {"2.2.2.2"} and db_user.need_sync
+
+    # NOTE 上报失败的时候什么都不减
+    monkeypatch.setattr(
+        httpx,
+        "AsyncClient",
+        lambda: client_cls(
+            transport=httpx.MockTransport(lambda r: httpx.Response(500))
+        ),
+    )
+    asyncio.run(ProxyMan.flush_metrics_to_remote("http://api/metrics"))
+    assert User.get_by_id(1).upload_traffic == 10
+
+    monkeypatch.setattr(
+        httpx,
+        "AsyncClient",
+        lambda: client_cls(
+            transport=httpx.MockTransport(lambda r: httpx.Response(200))
+        ),
+    )
+    asyncio.run(ProxyMan.flush_metrics_to_remote("http://api/metrics"))
+    db_user = User.get_by_id(1)
+    assert (db_user.upload_traffic, db_user.need_sync) == (0, False)
+    assert not db_user.ip_list
@@ -0,0 +1,41 @@
+from shadowsocks.mdb.models import User
+from shadowsocks.mdb.snapshot import UserSnapshot
+
+
+def test_snapshot_round_trip(tmp_path, user_db):
+    port = 10090
+    User.create_or_update_by_user_data_list(
+        [
+            dict(
+                user_id=i,
+                port=port,
+                method="aes-128-gcm",
+                password=f"pwd-{i}",
+                enable=True,
+            )
+            for i in range(1, 4)
+        ]
+    )
+    user = User.registry.get(3)
+    User.registry.move_to_front(user)
+    user.record_traffic(10, 20)
+    user.record_ip(("2001:db8::1", 1234))
+    User.flush_metrics()
+    user.record_traffic(1, 2)
+
+    snapshot = UserSnapshot(str(tmp_path / "users.json"))
+    snapshot.save_sync()
+    assert not (tmp_path / "users.json.tmp").exists()
+    # NOTE 快照里有密码, 其他用户不能读
+    assert (tmp_path / "users.json").stat().st_mode & 0o777 == 0o600
+
+    # NOTE 模拟重启
+    User.delete().execute()
+    User.registry.clear()
+    assert snapshot.load() == 3
+    assert [u.user_id for u in User.registry.list_by_port(port)] == [3, 1, 2]
+    user = User.registry.get(3)
+    assert (user.upload_traffic, user.download_traffic) == (11, 22)
+    assert set(user.ip_list) == {"2001:db8::1"}
+    # NOTE 数据库里已经有用户了就不再恢复
+    assert snapshot.load() == 0
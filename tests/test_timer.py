@@ -0,0 +1,50 @@
+import random
+
+from shadowsocks.timer import TimerEntry, TimerWheel
+
+
+def _wheel():
+    wheel = TimerWheel()
+    # NOTE 测试里手动advance, 不挂到事件循环上
+    wheel._start = lambda: None
+    return wheel
+
+
+def test_timer_wheel_fire_order():
+    wheel = _wheel()
+    fired = []
+    rnd = random.Random(0)
+    deadlines = [rnd.randint(1, 64 ** 3) for _ in range(2000)] + [64, 4096, 262144]
+    for deadline in deadlines:
+        entry = TimerEntry(lambda d=deadline: fired.append((d, wheel.now)))
+        wheel.schedule(entry, deadline)
+    assert len(wheel) == len(deadlines)
+
+    while len(wheel):
+        wheel.advance()
+    assert len(fired) == len(deadlines)
+    assert all(deadline == now for deadline, now in fired)
+
+
+def test_timer_wheel_cancel_and_reschedule():
+    wheel = _wheel()
+    fired = []
+    a = TimerEntry(lambda: fired.append("a"))
+    b = TimerEntry(lambda: fired.append("b"))
+    wheel.schedule(a, 10)
+    wheel.schedule(b, 10)
+    wheel.cancel(a)
+    assert not a.scheduled and len(wheel) == 1
+
+    # NOTE 重新schedule会先从原来的槽里拿出来
+    wheel.schedule(b, 100)
+    for _ in range(99):
+        wheel.advance()
+    assert fired == []
+    wheel.advance()
+    assert fired == ["b"] and len(wheel) == 0
+
+    # NOTE 已经过了的deadline在下一个tick触发
+    wheel.schedule(a, 1)
+    wheel.advance()
+    assert fired == ["b", "a"]
@@ -0,0 +1,88 @@
+import io
+import json
+
+import pytest
+
+from shadowsocks.utils import (
+    IPTracker,
+    JSONObjectStream,
+    LRUCache,
+    SlidingWindowFilter,
+    TTLCache,
+)
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.pop("a") == 1
+    assert len(cache) == 1
+
+
+def test_sliding_window_filter():
+    f = SlidingWindowFilter()
+    assert f.add(0)
+    assert f.add(5)
+    assert f.add(3)
+    assert not f.add(3)
+    assert not f.add(5)
+    assert f.add(5 + f.WINDOW_SIZE)
+    assert not f.add(5)
+    assert f.add(6)
+
+
+def test_ttl_cache():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") == 1 and "a" in cache
+    cache.ttl = -1
+    cache.set("b", 2)
+    assert cache.get("b") is None and "b" not in cache
+    assert cache.items() == [("a", 1)]
+
+
+def test_ip_tracker():
+    tracker = IPTracker(["1.1.1.1", "::ffff:1.1.1.1", "2001:db8::1", "fe80::1%eth0"])
+    assert set(tracker) == {"1.1.1.1", "2001:db8::1", "fe80::1"}
+    assert tracker.count() == 3
+
+    # NOTE 超过上限之后只保留部分ip, 数量是估算的
+    for i in range(5000):
+        tracker.add(f"10.0.{i >> 8}.{i & 255}")
+    assert len(list(tracker)) == IPTracker.MAX_EXACT
+    assert abs(tracker.count() - 5003) < 5003 * 0.1
+    assert IPTracker.from_bytes(tracker.to_bytes()) == tracker
+
+    merged = IPTracker(["8.8.8.8"])
+    merged.merge(tracker)
+    assert abs(merged.count() - 5004) < 5004 * 0.1
+
+
+def test_json_object_stream():
+    doc = {
+        "version": 12,
+        "users": [{"user_id": i, "password": "密码" * (i % 3)} for i in range(100)],
+        "deleted": [1, 2],
+        "total": 123456789,
+    }
+    raw = json.dumps(doc, ensure_ascii=False).encode()
+    # NOTE chunk很小的时候数字, 字符串和utf8字符都会被截断
+    for chunk_size in (1, 3, 4096):
+        data = {}
+        for key, value in JSONObjectStream(io.BytesIO(raw), ["users"], chunk_size):
+            data[key] = list(value) if key == "users" else value
+        assert data == doc
+
+    # NOTE 没用完的数组会被跳过
+    keys = [k for k, _ in JSONObjectStream(io.BytesIO(raw), ["users"], 16)]
+    assert keys == ["version", "users", "deleted", "total"]
+
+    for bad in ('{"users": [1, 2', '{"users": [1 2]}', "[1]", '{"a": 1'):
+        with pytest.raises(ValueError):
+            for key, value in JSONObjectStream(io.StringIO(bad), ["users"], 2):
+                list(value) if key == "users" else value